@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Finds the fastest safe batch_size per backend, model and resolution.
+# A backend is probed with growing batch sizes at the story's width, height
+# and steps until it runs out of memory or throughput stops improving; the
+# winner is cached in settings/batch_tuning.json and used on later runs to
+# split "Number of Images" into batch_size x n_iter. The same file keeps the
+# limits learned from out-of-memory errors (see degradation.py).
+
+import os
+import json
+import time
+import threading
+
+from lazy_imports import lazy_import
+from sd_client import get_client, is_oom_error
+
+requests = lazy_import('requests')
+
+DEFAULT_CACHE_PATH = os.path.join('settings', 'batch_tuning.json')
+PROBE_BATCH_SIZES = (1, 2, 4, 8, 16)
+MIN_GAIN = 1.05  # A larger batch must be at least 5% faster to be worth it
+
+def tuning_key(endpoint, model, width, height):
+    return f"{endpoint}|{model}|{width}x{height}"
+
+def tighten_limits(learned, limits):
+    # Keeps the tighter of each limit in `learned`, which is updated in place
+    for name, value in limits.items():
+        known = learned.get(name)
+        if name == 'resolution':
+            if known is None or value[0] * value[1] < known[0] * known[1]:
+                learned[name] = value
+        elif known is None or value < known:
+            learned[name] = value
+    return learned
+
+class BatchTuningCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def get(self, endpoint, model, width, height):
+        entry = self.entries.get(tuning_key(endpoint, model, width, height))
+        return entry.get('batch_size') if entry else None
+
+    def put(self, endpoint, model, width, height, entry):
+        with self.lock:
+            key = tuning_key(endpoint, model, width, height)
+            limits = self.entries.get(key, {}).get('limits')
+            self.entries[key] = dict(entry, limits=limits) if limits else entry
+            self.save()
+
+    def limits(self, endpoint, model, width, height):
+        # {'max_batch_size', 'max_n_iter', 'resolution'}, each only once learned
+        entry = self.entries.get(tuning_key(endpoint, model, width, height))
+        return dict(entry.get('limits') or {}) if entry else {}
+
+    def learn(self, endpoint, model, width, height, limits):
+        # Only ever tightens what was learned before
+        with self.lock:
+            learned = self.entries.setdefault(tuning_key(endpoint, model, width, height), {}).setdefault('limits', {})
+            tighten_limits(learned, limits)
+            learned['learned_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+def probe_payload(settings, batch_size):
+    return {
+        "prompt": "calibration probe",
+        "steps": settings["sampling_steps"],
+        "cfg_scale": settings["cfg_scale"],
+        "width": settings["width"],
+        "height": settings["height"],
+        "sampler_name": settings["sampling_method"],
+        "scheduler": settings["scheduler"],
+        "seed": 1,
+        "batch_size": batch_size,
+        "n_iter": 1,
+        "save_images": False,
+        "send_images": False,  # Only the timing matters
+        "override_settings": {
+            "sd_model_checkpoint": settings["model"]
+        }
+    }
+
+def probe_backend(endpoint, settings, batch_sizes=PROBE_BATCH_SIZES):
+    client = get_client(endpoint)
+    # Warm-up request so model loading does not count against batch_size 1
+    try:
+        client.post('/sdapi/v1/txt2img', json=probe_payload(settings, 1))
+    except requests.exceptions.RequestException as e:
+        print(f"  warm-up request failed ({e})")
+        return None
+
+    results = []
+    best = None
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        try:
+            response = client.post('/sdapi/v1/txt2img', json=probe_payload(settings, batch_size))
+        except requests.exceptions.RequestException as e:
+            print(f"  batch_size {batch_size}: request failed ({e})")
+            break
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            reason = 'out of memory' if is_oom_error(response.text) else f'HTTP {response.status_code}'
+            print(f"  batch_size {batch_size}: {reason}")
+            results.append({'batch_size': batch_size, 'error': reason})
+            break
+        rate = batch_size / elapsed
+        print(f"  batch_size {batch_size}: {rate:.2f} images/s")
+        results.append({'batch_size': batch_size, 'images_per_second': round(rate, 4)})
+        if best is not None and rate < best['images_per_second'] * MIN_GAIN:
+            break
+        if best is None or rate > best['images_per_second']:
+            best = results[-1]
+
+    if best is None:
+        return None
+    return {
+        'batch_size': best['batch_size'],
+        'images_per_second': best['images_per_second'],
+        'steps': settings['sampling_steps'],
+        'probes': results,
+        'tuned_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+def autotune(endpoints, settings, cache, force=False):
+    for endpoint in endpoints:
+        known = cache.get(endpoint, settings['model'], settings['width'], settings['height'])
+        if known is not None and not force:
+            print(f"{endpoint}: using cached batch_size {known}")
+            continue
+        print(f"Auto-tuning batch_size on {endpoint} at {settings['width']}x{settings['height']}, {settings['sampling_steps']} steps...")
+        entry = probe_backend(endpoint, settings)
+        if entry is None:
+            print(f"{endpoint}: auto-tune failed, keeping batch_size 1")
+            continue
+        cache.put(endpoint, settings['model'], settings['width'], settings['height'], entry)
+        print(f"{endpoint}: batch_size {entry['batch_size']} ({entry['images_per_second']:.2f} images/s)")
+
+def split_batches(num_images, batch_size):
+    # Returns (batch_size, n_iter) groups that add up to exactly num_images
+    batch_size = max(1, min(batch_size, num_images))
+    groups = []
+    full = num_images // batch_size
+    if full:
+        groups.append((batch_size, full))
+    if num_images % batch_size:
+        groups.append((num_images % batch_size, 1))
+    return groups
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Throughput of the serial request loop vs. the asyncio engine against
+# local mock backends.
+#   python benchmarks/bench_engine.py --jobs 40 --latency 0.05 --image-kb 1500
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main as automator
+
+def make_jobs(out_dir, count, images_per_job):
+    jobs = []
+    for n in range(count):
+        iteration_dir = os.path.join(out_dir, f'item_{n}', 'Iteration_1')
+        os.makedirs(iteration_dir, exist_ok=True)
+        jobs.append({
+            'prompt_type': 'scene',
+            'item_name': f'item_{n}',
+            'iteration': 1,
+            'iteration_dir': iteration_dir,
+            'base_seed': n,
+            'indices': list(range(1, images_per_job + 1)),
+            'lora': '',
+            'payload': {
+                'prompt': f'benchmark {n}', 'negative_prompt': '', 'steps': 20, 'cfg_scale': 7,
+                'width': 512, 'height': 512, 'sampler_name': 'Euler a', 'scheduler': 'automatic',
+                'seed': n, 'batch_size': 1, 'n_iter': images_per_job,
+                'override_settings': {'sd_model_checkpoint': 'mock.safetensors [0000000000]'},
+                'override_settings_restore_afterwards': False,
+            },
+        })
+    return jobs
+
+def timed(label, fn, images):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+    print(f"{label:>22}: {images / elapsed:7.2f} images/s ({elapsed:.2f}s)")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the serial loop with the asyncio engine.')
+    parser.add_argument('--jobs', type=int, default=40)
+    parser.add_argument('--images-per-job', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.05, help='Mock seconds per image')
+    parser.add_argument('--image-kb', type=int, default=1500)
+    parser.add_argument('--backends', type=int, default=1)
+    parser.add_argument('--in-flight', type=int, default=2)
+    parser.add_argument('--base-port', type=int, default=7880)
+    args = parser.parse_args()
+
+    ports = [args.base_port + i for i in range(args.backends)]
+    endpoints = [f'http://127.0.0.1:{port}' for port in ports]
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'mock_server.py'), '--ports'] + [str(p) for p in ports]
+                              + ['--latency', str(args.latency), '--image-kb', str(args.image_kb)], stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        images = args.jobs * args.images_per_job
+        print(f"{args.jobs} jobs x {args.images_per_job} images, {args.backends} backend(s), ~{args.image_kb} KiB per image")
+        with tempfile.TemporaryDirectory() as out_dir:
+            serial_jobs = make_jobs(os.path.join(out_dir, 'serial'), args.jobs, args.images_per_job)
+            serial = timed('serial', lambda: automator.run_jobs(serial_jobs, endpoints[0]), images)
+            async_jobs = make_jobs(os.path.join(out_dir, 'async'), args.jobs, args.images_per_job)
+            pipelined = timed(f'async (in-flight {args.in_flight})', lambda: automator.run_jobs_async(async_jobs, endpoints, args.in_flight), images)
+        print(f"Speed-up: {serial / pipelined:.2f}x")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    main()
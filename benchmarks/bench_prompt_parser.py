@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Compares the old read-and-split prompt loading with the streaming parser
+# on a synthetic scenes file: time until the first prompt is available,
+# total parse time and peak RSS, each measured in a fresh process.
+#   python benchmarks/bench_prompt_parser.py --size-mb 1024
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BLOCK = ("Name: Scene {n}\n"
+         "Positive prompt: Scene {n}, Dr. Jonathan Reeves stands confidently at the front of a sterile laboratory room,\n"
+         "holding a clipboard, white tiled floors, bright fluorescent lamps, comic book style --- dark and gritty.\n"
+         "Negative prompt: Cartoonish features, supernatural elements, bright colors, text.\n"
+         "---\n")
+
+def write_prompt_file(path, size_mb):
+    target = size_mb * 1024 * 1024
+    written = 0
+    n = 0
+    with open(path, 'w') as f:
+        while written < target:
+            chunk = ''.join(BLOCK.format(n=n + i) for i in range(1000))
+            f.write(chunk)
+            written += len(chunk)
+            n += 1000
+    return n
+
+def run_legacy(path):
+    # Mirrors the original load_prompts + parse_prompt_block
+    with open(path, 'r') as f:
+        content = f.read()
+    blocks = [block.strip() for block in content.split('---') if block.strip()]
+    first = None
+    prompts = []
+    for block in blocks:
+        data = {}
+        current_key = None
+        for line in block.strip().split('\n'):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                current_key = key.strip()
+                data[current_key] = value.strip()
+            elif current_key:
+                data[current_key] += ' ' + line.strip()
+        if first is None:
+            first = time.perf_counter()
+        prompts.append(data)
+    return len(prompts), first
+
+def run_stream(path):
+    from prompt_parser import iter_prompts
+    count = 0
+    first = None
+    for data in iter_prompts(path, on_problem=lambda problem: None):
+        if first is None:
+            first = time.perf_counter()
+        count += 1
+    return count, first
+
+def child(mode, path):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    count, first = run_legacy(path) if mode == 'legacy' else run_stream(path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': mode, 'blocks': count, 'seconds': elapsed, 'first_seconds': (first or start) - start,
+                      'peak_rss_kb': peak, 'baseline_rss_kb': baseline}))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the streaming prompt-file parser.')
+    parser.add_argument('--size-mb', type=int, default=1024, help='Size of the synthetic scenes file')
+    parser.add_argument('--skip-legacy', action='store_true', help='Only run the streaming parser (the old loader needs several times the file size in RAM)')
+    parser.add_argument('--role', choices=['legacy', 'stream'], help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role:
+        child(args.role, args.path)
+        return
+
+    script = os.path.abspath(__file__)
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'scenes.txt')
+        blocks = write_prompt_file(path, args.size_mb)
+        print(f"Prompt file: {os.path.getsize(path) / 1024 / 1024:.0f} MiB, {blocks} blocks")
+        modes = ['stream'] if args.skip_legacy else ['legacy', 'stream']
+        for mode in modes:
+            out = subprocess.run([sys.executable, script, '--role', mode, '--path', path], capture_output=True, text=True)
+            if out.returncode != 0:
+                print(f"{mode:>7}: failed ({out.stderr.strip().splitlines()[-1] if out.stderr.strip() else out.returncode})")
+                continue
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            growth = (r['peak_rss_kb'] - r['baseline_rss_kb']) / 1024
+            print(f"{r['mode']:>7}: {r['blocks']} blocks, first after {r['first_seconds'] * 1000:.0f} ms, "
+                  f"total {r['seconds']:.2f}s, peak RSS {r['peak_rss_kb'] / 1024:.0f} MiB (+{growth:.0f} MiB)")
+
+if __name__ == '__main__':
+    main()
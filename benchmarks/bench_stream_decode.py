@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Compares peak RSS of the old "response.json() + b64decode" save loop with
+# the streaming decoder, against a local server returning a large batch.
+#   python benchmarks/bench_stream_decode.py --images 50 --image-kb 1500
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import resource
+import tempfile
+import importlib
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def serve(port, images, image_kb):
+    encoded = base64.b64encode(os.urandom(image_kb * 1024))
+    head = b'{"images": ['
+    tail = b'], "parameters": {}, "info": "{\\"seed\\": 1}"}'
+    length = len(head) + len(tail) + images * (len(encoded) + 2) + max(images - 1, 0)
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            self.wfile.write(head)
+            for i in range(images):
+                self.wfile.write((b',"' if i else b'"') + encoded + b'"')
+            self.wfile.write(tail)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print('ready', flush=True)
+    server.serve_forever()
+
+def run_legacy(url, out_dir):
+    # Mirrors the original generate_images body
+    import requests
+    response = requests.post(url, json={})
+    response.raise_for_status()
+    r = response.json()
+    for idx, img_data in enumerate(r['images']):
+        img_bytes = base64.b64decode(img_data)
+        with open(os.path.join(out_dir, f'legacy_{idx + 1}.png'), 'wb') as img_file:
+            img_file.write(img_bytes)
+    return len(r['images'])
+
+def run_stream(url, out_dir):
+    from sd_client import get_client
+    from stream_decode import stream_txt2img_response
+    response = get_client(url.rsplit('/sdapi', 1)[0]).post('/sdapi/v1/txt2img', json={}, stream=True)
+    response.raise_for_status()
+    fields = stream_txt2img_response(response, lambda idx: open(os.path.join(out_dir, f'stream_{idx + 1}.png'), 'wb'))
+    return fields['images']
+
+def child(mode, url):
+    importlib.import_module('requests')  # Loaded before measuring so both modes pay the same import cost
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        count = run_legacy(url, out_dir) if mode == 'legacy' else run_stream(url, out_dir)
+        elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': mode, 'images': count, 'seconds': elapsed, 'peak_rss_kb': peak, 'baseline_rss_kb': baseline}))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streaming txt2img decoding.')
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--image-kb', type=int, default=1500, help='Decoded size of each image in KiB')
+    parser.add_argument('--port', type=int, default=7870)
+    parser.add_argument('--role', choices=['server', 'legacy', 'stream'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    url = f'http://127.0.0.1:{args.port}/sdapi/v1/txt2img'
+    if args.role == 'server':
+        serve(args.port, args.images, args.image_kb)
+        return
+    if args.role:
+        child(args.role, url)
+        return
+
+    script = os.path.abspath(__file__)
+    common = ['--images', str(args.images), '--image-kb', str(args.image_kb), '--port', str(args.port)]
+    server = subprocess.Popen([sys.executable, script, '--role', 'server'] + common, stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        results = []
+        for mode in ('legacy', 'stream'):
+            out = subprocess.run([sys.executable, script, '--role', mode] + common, capture_output=True, text=True, check=True)
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+
+    total_mb = args.images * args.image_kb / 1024
+    print(f"Batch: {args.images} images, {total_mb:.0f} MiB decoded")
+    for r in results:
+        growth = (r['peak_rss_kb'] - r['baseline_rss_kb']) / 1024
+        print(f"{r['mode']:>7}: peak RSS {r['peak_rss_kb'] / 1024:.0f} MiB (+{growth:.0f} MiB during the request), {r['seconds']:.2f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# End-to-end overhead benchmark of the main.py pipeline against the mock
+# web UI. For each story size a fresh process builds synthetic prompt files,
+# runs prompt parsing, prompt.json generation, planning and the request loop,
+# then reports images/s, client CPU time and peak RSS. Results are checked
+# against benchmarks/thresholds.json and the run exits with status 1 when
+# any threshold is exceeded. The limits sit about 2x away from the values
+# measured on a quiet machine, since a 10-item run lasts a fraction of a
+# second and its per-image numbers are mostly startup noise.
+#   python benchmarks/run_benchmarks.py --sizes 10 100 1000 10000
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(os.path.join(__file__, '..')))
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_THRESHOLDS = os.path.join(HERE, 'thresholds.json')
+
+def write_story_files(directory, items):
+    characters = items // 2
+    with open(os.path.join(directory, 'characters.txt'), 'w') as f:
+        for n in range(characters):
+            f.write(f"Name: Character {n}\n")
+            f.write(f"Positive prompt: Full-body view of character {n}, comic book style, dark and gritty.\n")
+            f.write("Negative prompt: Cartoonish features, bright colors.\n---\n")
+    with open(os.path.join(directory, 'scenes.txt'), 'w') as f:
+        for n in range(items - characters):
+            f.write(f"Name: Scene {n}\n")
+            f.write(f"Positive prompt: Scene {n}, a sterile laboratory lit by fluorescent lamps.\n")
+            f.write("Negative prompt: Text, watermark.\n---\n")
+
+def run_child(items, endpoint, engine, in_flight):
+    sys.path.insert(0, ROOT)
+    import main as automator
+
+    settings = {
+        'model': 'mock.safetensors', 'lora': '', 'lora_weight': 1.0, 'sampling_method': 'Euler a',
+        'scheduler': 'automatic', 'sampling_steps': 20, 'width': 512, 'height': 768,
+        'cfg_scale': 7.5, 'seed': 1, 'api_endpoint': endpoint,
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        write_story_files(work_dir, items)
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            for prompt_type in ('character', 'scene'):
+                automator.generate_json_files(automator.create_prompts(prompt_type), prompt_type, 'story', settings['seed'])
+            jobs = automator.plan_jobs(settings, 'character', 'story') + automator.plan_jobs(settings, 'scene', 'story')
+            ordered = automator.plan_by_affinity(jobs)
+            planned = [job for _, group in ordered for job in group]
+            if engine == 'async':
+                automator.run_jobs_async(planned, [endpoint], in_flight)
+            else:
+                automator.run_jobs(planned, endpoint)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        images = sum(1 for _, _, files in os.walk('story') for name in files if name.endswith('.png'))
+        os.chdir(ROOT)
+    print(json.dumps({
+        'items': items,
+        'images': images,
+        'seconds': round(wall, 3),
+        'images_per_second': round(images / wall, 2) if wall else 0.0,
+        'cpu_ms_per_image': round(cpu * 1000 / images, 3) if images else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+def check(result, limits):
+    failures = []
+    if 'min_images_per_second' in limits and result['images_per_second'] < limits['min_images_per_second']:
+        failures.append(f"images/s {result['images_per_second']} < {limits['min_images_per_second']}")
+    if 'max_cpu_ms_per_image' in limits and (result['cpu_ms_per_image'] or 0) > limits['max_cpu_ms_per_image']:
+        failures.append(f"CPU {result['cpu_ms_per_image']} ms/image > {limits['max_cpu_ms_per_image']}")
+    if 'max_peak_rss_mb' in limits and result['peak_rss_mb'] > limits['max_peak_rss_mb']:
+        failures.append(f"peak RSS {result['peak_rss_mb']} MiB > {limits['max_peak_rss_mb']}")
+    if result['images'] != result['items']:
+        failures.append(f"expected {result['items']} images, got {result['images']}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the automator pipeline against the mock web UI.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='Story sizes (items) to run')
+    parser.add_argument('--engine', choices=['serial', 'async'], default='serial')
+    parser.add_argument('--in-flight', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0, help='Mock seconds per image (0 measures pure client overhead)')
+    parser.add_argument('--image-kb', type=int, default=0)
+    parser.add_argument('--port', type=int, default=7899)
+    parser.add_argument('--thresholds', default=DEFAULT_THRESHOLDS, help='JSON file with per-size regression limits')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    endpoint = f'http://127.0.0.1:{args.port}'
+    if args.child is not None:
+        run_child(args.child, endpoint, args.engine, args.in_flight)
+        return
+
+    thresholds = {}
+    if args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds, 'r') as f:
+            thresholds = json.load(f)
+
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'mock_server.py'), '--ports', str(args.port),
+                               '--latency', str(args.latency), '--image-kb', str(args.image_kb)],
+                              stdout=subprocess.PIPE, text=True)
+    results = []
+    failed = False
+    try:
+        server.stdout.readline()
+        print(f"{'items':>8} {'images/s':>10} {'CPU ms/img':>11} {'peak RSS':>10}  status")
+        for size in args.sizes:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', str(size), '--engine', args.engine,
+                                  '--in-flight', str(args.in_flight), '--port', str(args.port)],
+                                 capture_output=True, text=True)
+            if out.returncode != 0:
+                print(f"{size:>8}  benchmark process failed:\n{out.stderr}")
+                failed = True
+                continue
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            limits = thresholds.get(args.engine, {}).get(str(size), {})
+            failures = check(result, limits)
+            result['failures'] = failures
+            results.append(result)
+            failed = failed or bool(failures)
+            status = 'ok' if not failures else 'FAIL: ' + '; '.join(failures)
+            print(f"{size:>8} {result['images_per_second']:>10.1f} {result['cpu_ms_per_image'] or 0:>11.2f} "
+                  f"{result['peak_rss_mb']:>8.1f}MB  {status}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# Adaptive in-flight limits per backend (AIMD). A background thread samples
+# every backend's /sdapi/v1/progress (is the GPU busy, how much of the
+# current request is left) and /sdapi/v1/memory (VRAM use, CUDA OOM
+# events), and the request path reports latency and errors. Every
+# interval, per backend:
+#   OOM, errors or VRAM above VRAM_HIGH  -> limit halved; at the minimum
+#                                            the backend gets no new work
+#                                            for a growing hold period
+#   latency per unit of work above LATENCY_TOLERANCE x the best seen
+#                                         -> limit halved
+#   queue depth (from /progress, batches waiting on the backend) up by
+#   QUEUE_GROWTH or more since the last interval, other than right after
+#   an increase                         -> limit halved, or at the minimum
+#                                            no increase
+#   work held back by the limit while the GPU was seen idle, or while
+#   latency stayed below INCREASE_BELOW x the best seen (the backend
+#   renders requests side by side), and the queue not growing -> limit + 1
+# A CUDA OOM reported by a request is acted on at once rather than at the
+# next interval; OOMs of requests sent before the last decrease are left
+# out, since they were sent under the old limit. The limit an OOM happened
+# at becomes a ceiling the limit stays below for CEILING_SECONDS.
+# Every change is passed to on_decision (the event log in main.py) with the
+# signals behind it, so the constants can be tuned against mock_server.py.
+
+import time
+import threading
+
+from lazy_imports import lazy_import
+from sd_client import get_client, is_oom_error
+
+requests = lazy_import('requests')
+
+DEFAULT_INITIAL_LIMIT = 2
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 8
+DEFAULT_INTERVAL = 2.0  # Seconds between decisions
+SAMPLES_PER_INTERVAL = 4  # /progress samples per decision, to catch idle gaps
+VRAM_HIGH = 0.92  # Fraction of VRAM in use that counts as pressure
+LATENCY_TOLERANCE = 2.5
+INCREASE_BELOW = 1.6
+DECREASE_FACTOR = 0.5
+HOLD_SECONDS = 15.0  # First hold period; doubles while the backend keeps struggling
+CEILING_SECONDS = 120.0
+SMOOTHING = 0.3  # Weight of the newest latency in the moving average
+BASELINE_DRIFT = 1.02  # Lets the best-seen latency creep up at the minimum limit, e.g. after a model change
+QUEUE_GROWTH = 2.0  # Rise of the mean queue depth between intervals that counts as backpressure
+
+def work_units(job):
+    # Megapixel-steps of a request, so latencies of different sizes compare
+    payload = job['payload']
+    return max(1e-6, len(job['indices']) * payload['width'] * payload['height'] * payload['steps'] / 1e6)
+
+class BackendHealth:
+    def __init__(self, url, limit):
+        self.url = url
+        self.limit = limit
+        self.latency = None  # Seconds per work unit, moving average
+        self.baseline = None  # Best latency seen
+        self.errors = 0  # Since the last decision
+        self.ooms = 0
+        self.oom_events = None  # Last cuda.events.oom reported by /memory
+        self.vram = None  # Fraction in use
+        self.queue = 0  # Images left in the running request, plus ours waiting
+        self.queue_total = 0  # Sum and count of the queue samples since the last decision
+        self.queue_samples = 0
+        self.last_depth = None  # Mean queue depth of the previous interval
+        self.increased = False  # The last decision raised the limit
+        self.idle_samples = 0
+        self.limited = False  # Work was held back by the limit since the last decision
+        self.in_flight = 0
+        self.hold_until = 0.0
+        self.last_cut = 0.0  # Time of the last decrease or hold
+        self.ceiling = None  # Limit an OOM happened at
+        self.ceiling_until = 0.0
+        self.holds = 0  # Consecutive holds
+        self.held = 0
+        self.increases = 0
+        self.decreases = 0
+
+class ConcurrencyController:
+    def __init__(self, endpoints, initial=DEFAULT_INITIAL_LIMIT, min_limit=DEFAULT_MIN_LIMIT, max_limit=DEFAULT_MAX_LIMIT,
+                 interval=DEFAULT_INTERVAL, on_decision=None):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.interval = interval
+        self.on_decision = on_decision
+        self.lock = threading.Lock()
+        self.backends = {url: BackendHealth(url, min(max(initial, min_limit), self.max_limit)) for url in endpoints}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # Admission
+
+    def admits(self, url, in_flight):
+        # Whether a backend that has `in_flight` requests may get one more
+        with self.lock:
+            health = self.backends[url]
+            health.in_flight = in_flight
+            if time.time() < health.hold_until:
+                return False
+            if in_flight >= health.limit:
+                health.limited = True
+                return False
+            return True
+
+    def limit(self, url):
+        with self.lock:
+            return self.backends[url].limit
+
+    # Feedback from the request path
+
+    def record(self, url, job, latency, error=None):
+        if error is not None:
+            self._record_error(url, error, time.time() - latency)
+            return
+        with self.lock:
+            health = self.backends[url]
+            per_unit = latency / work_units(job)
+            health.latency = per_unit if health.latency is None else SMOOTHING * per_unit + (1 - SMOOTHING) * health.latency
+            if health.baseline is None or health.latency < health.baseline:
+                health.baseline = health.latency
+
+    def _record_error(self, url, error, sent):
+        oom = is_oom_error(str(error)) or is_oom_error(getattr(getattr(error, 'response', None), 'text', '') or '')
+        with self.lock:
+            health = self.backends[url]
+            if not oom:
+                health.errors += 1
+                return
+            if health.oom_events is not None:
+                health.oom_events += 1  # /memory counts it too; only count it once
+            if sent < health.last_cut:
+                return
+            health.ooms += 1
+        self._decide(url)
+
+    # Sampling and decisions
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='concurrency-controller', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        sample = 0
+        while not self.stop_event.wait(self.interval / SAMPLES_PER_INTERVAL):
+            for url in self.backends:
+                self._sample_progress(url)
+            sample += 1
+            if sample % SAMPLES_PER_INTERVAL == 0:
+                for url in self.backends:
+                    self._sample_memory(url)
+                    self._decide(url)
+
+    def _sample_progress(self, url):
+        try:
+            response = get_client(url).get('/sdapi/v1/progress?skip_current_image=true', timeout=2, retries=0)
+            state = response.json().get('state') or {}
+        except (requests.exceptions.RequestException, ValueError):
+            return
+        busy = state.get('job_count', 0) > 0
+        with self.lock:
+            health = self.backends[url]
+            waiting = max(0, health.in_flight - (1 if busy else 0))
+            health.queue = waiting + max(0, state.get('job_count', 0) - state.get('job_no', 0) - 1)
+            health.queue_total += health.queue
+            health.queue_samples += 1
+            if not busy:
+                health.idle_samples += 1
+
+    def _sample_memory(self, url):
+        try:
+            response = get_client(url).get('/sdapi/v1/memory', timeout=2, retries=0)
+            response.raise_for_status()
+            cuda = response.json().get('cuda') or {}
+        except (requests.exceptions.RequestException, ValueError):
+            return  # Older web UIs have no /memory; latency and errors still count
+        system = cuda.get('system') or {}
+        oom_events = (cuda.get('events') or {}).get('oom')
+        with self.lock:
+            health = self.backends[url]
+            if system.get('total'):
+                health.vram = system.get('used', 0) / system['total']
+            if oom_events is not None:
+                if health.oom_events is not None and oom_events > health.oom_events:
+                    health.ooms += oom_events - health.oom_events
+                health.oom_events = oom_events
+
+    def _decide(self, url):
+        now = time.time()
+        with self.lock:
+            health = self.backends[url]
+            before = health.limit
+            if health.ceiling is not None and now >= health.ceiling_until:
+                health.ceiling = None
+            ceiling = min(health.ceiling or self.max_limit + 1, self.max_limit + 1)
+            depth = health.queue_total / health.queue_samples if health.queue_samples else None
+            # A raised limit lets more of our requests wait, which is no backpressure
+            queue_growing = (depth is not None and health.last_depth is not None and not health.increased
+                             and depth >= health.last_depth + QUEUE_GROWTH)
+            action = None
+            if health.ooms or health.errors or (health.vram is not None and health.vram >= VRAM_HIGH):
+                health.last_cut = now
+                if health.ooms:
+                    health.ceiling = health.limit if health.ceiling is None else min(health.ceiling, health.limit)
+                    health.ceiling_until = now + CEILING_SECONDS
+                if health.limit <= self.min_limit:
+                    health.hold_until = now + HOLD_SECONDS * 2 ** health.holds
+                    health.holds += 1
+                    health.held += 1
+                    action = 'hold'
+                else:
+                    health.limit = max(self.min_limit, int(health.limit * DECREASE_FACTOR))
+                    action = 'decrease'
+                reason = 'oom' if health.ooms else 'errors' if health.errors else 'vram'
+            elif health.latency is not None and health.latency > health.baseline * LATENCY_TOLERANCE and health.limit > self.min_limit:
+                health.limit = max(self.min_limit, int(health.limit * DECREASE_FACTOR))
+                health.last_cut = now
+                action, reason = 'decrease', 'latency'
+            elif queue_growing and health.limit > self.min_limit:
+                health.limit = max(self.min_limit, int(health.limit * DECREASE_FACTOR))
+                health.last_cut = now
+                action, reason = 'decrease', 'queue'
+            elif health.limited and not queue_growing and health.limit + 1 < ceiling and (
+                    health.idle_samples or (health.latency is not None and health.latency <= health.baseline * INCREASE_BELOW)):
+                health.limit += 1
+                action, reason = 'increase', 'gpu idle' if health.idle_samples else 'latency ok'
+            else:
+                health.holds = 0
+            if action == 'increase':
+                health.increases += 1
+            elif action == 'decrease':
+                health.decreases += 1
+            decision = None
+            if action is not None:
+                decision = {
+                    'endpoint': url, 'action': action, 'reason': reason,
+                    'limit_before': before, 'limit': health.limit, 'ceiling': health.ceiling,
+                    'hold_seconds': round(health.hold_until - now, 1) if action == 'hold' else 0,
+                    'in_flight': health.in_flight, 'queue': health.queue, 'idle_samples': health.idle_samples,
+                    'queue_depth': round(depth, 2) if depth is not None else None,
+                    'last_queue_depth': round(health.last_depth, 2) if health.last_depth is not None else None,
+                    'vram': round(health.vram, 3) if health.vram is not None else None,
+                    'ooms': health.ooms, 'errors': health.errors,
+                    'latency': round(health.latency, 4) if health.latency is not None else None,
+                    'baseline': round(health.baseline, 4) if health.baseline is not None else None,
+                }
+            health.ooms = health.errors = health.idle_samples = 0
+            health.limited = False
+            health.increased = action == 'increase'
+            if depth is not None:
+                health.last_depth = depth
+            health.queue_total = health.queue_samples = 0
+            if health.baseline is not None and health.limit <= self.min_limit:
+                # Above the minimum, queueing alone raises latency
+                health.baseline *= BASELINE_DRIFT
+        if decision is not None and self.on_decision is not None:
+            self.on_decision(decision)
+
+    def summary(self):
+        with self.lock:
+            return [{'url': h.url, 'limit': h.limit, 'increases': h.increases, 'decreases': h.decreases, 'holds': h.held}
+                    for h in self.backends.values()]
+
+def print_concurrency_report(controller):
+    print("\nAdaptive concurrency:")
+    for backend in controller.summary():
+        print(f"  {backend['url']}: final limit {backend['limit']}, {backend['increases']} increases, "
+              f"{backend['decreases']} decreases, {backend['holds']} holds")
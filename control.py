@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Cooperative control of a running generation: pause, resume, skip the
+# current item, skip the current image and cancel. The state lives in
+# threading Events, so the request loops block on them instead of polling
+# and continue the moment they change. Pause, skip-item and cancel send
+# /sdapi/v1/interrupt to the backends right away (and again while one of
+# our requests is still running there, since a web UI starts the next
+# queued request after an interrupt). An interrupt stops whichever request
+# the backend is rendering, so every request in flight there counts as
+# interrupted. The web UI returns the images it already finished, which are
+# kept; the rest is sent again (after resume, when paused) unless its item
+# was skipped or the run cancelled. skip-image asks the web UI (/sdapi/v1/skip) to
+# abandon the image it is sampling and move on to the next.
+# "priority ITEM N" passes a new priority to the job scheduler of the run,
+# or to the job queue's table when the run works off a queue.
+# Commands come from the keyboard (main.py) or, one per line, from a local
+# Unix socket (--control-socket), which answers every line with the state
+# as JSON; send them with "python main.py --control COMMAND".
+
+import os
+import json
+import time
+import threading
+
+from lazy_imports import lazy_import
+from sd_client import get_client
+
+requests = lazy_import('requests')
+socket = lazy_import('socket')  # Only loaded for --control-socket and --control
+socketserver = lazy_import('socketserver')
+
+COMMANDS = ('pause', 'resume', 'toggle', 'skip-item', 'skip-image', 'cancel', 'status', 'priority')
+DEFAULT_SOCKET = 'automator.sock'
+INTERRUPT_REPEAT = 0.5  # Seconds between interrupts while an interrupted request is still running
+
+def item_key(job):
+    return (job['prompt_type'], job['item_name'])
+
+class Control:
+    def __init__(self):
+        self.running = threading.Event()  # Cleared while paused
+        self.running.set()
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = {}  # id(job) -> (endpoint, job) of the requests sent, oldest first
+        self.last_job = {}  # endpoint -> job started there most recently
+        self.targets = set()  # id(job) of requests to interrupt until they return
+        self.interrupted = set()  # id(job) of requests in flight on a backend we interrupted
+        self.skipped_items = set()
+        self.interrupter = None
+        self.listeners = []  # Called on every pause, resume and cancel
+        self.reprioritize = None  # (item name, priority) -> False for unknown items, set while a scheduler or queue runs
+        self.server = None
+
+    # Request path
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _changed(self):
+        for listener in list(self.listeners):
+            listener()
+
+    def wait(self):
+        # Blocks while paused; False once cancelled
+        self.running.wait()
+        return not self.cancelled.is_set()
+
+    def should_run(self, job):
+        return not self.cancelled.is_set() and item_key(job) not in self.skipped_items
+
+    def job_started(self, endpoint, job):
+        with self.lock:
+            self.in_flight[id(job)] = (endpoint, job)
+            self.last_job[endpoint] = job
+
+    def is_interrupted(self, job):
+        with self.lock:
+            return id(job) in self.interrupted
+
+    def job_finished(self, job):
+        # Whether the request was interrupted by a command; may be called more than once
+        with self.lock:
+            self.in_flight.pop(id(job), None)
+            self.targets.discard(id(job))
+            if id(job) in self.interrupted:
+                self.interrupted.discard(id(job))
+                return True
+            return False
+
+    # Commands
+
+    def command(self, line):
+        # Runs one of COMMANDS, with its arguments; returns the resulting state
+        name, *arguments = line.split() or ['']
+        if name not in COMMANDS:
+            raise ValueError(f"unknown command {name!r}; choose from {', '.join(COMMANDS)}")
+        if name == 'priority':
+            self.set_priority(arguments)
+        elif name == 'pause' or (name == 'toggle' and self.running.is_set()):
+            self.pause()
+        elif name in ('resume', 'toggle'):
+            self.resume()
+        elif name == 'skip-item':
+            self.skip_item()
+        elif name == 'skip-image':
+            self.skip_image()
+        elif name == 'cancel':
+            self.cancel()
+        return self.status()
+
+    def set_priority(self, arguments):
+        try:
+            item, priority = '_'.join(arguments[:-1]), float(arguments[-1])
+        except (IndexError, ValueError):
+            raise ValueError("usage: priority ITEM N")
+        if not item:
+            raise ValueError("usage: priority ITEM N")
+        if self.reprioritize is None:
+            raise ValueError("this run has no job scheduler (streamed prompts are not reordered)")
+        if not self.reprioritize(item, priority):
+            raise ValueError(f"{item} has no jobs in this run")
+
+    def pause(self):
+        if self.running.is_set() and not self.cancelled.is_set():
+            self.running.clear()
+            self._changed()
+            print("\nPaused. Requests in flight are interrupted; their finished images are kept.")
+            self._interrupt(lambda job: True)
+
+    def resume(self):
+        if not self.running.is_set():
+            self.running.set()
+            self._changed()
+            print("\nResumed...")
+
+    def current_jobs(self):
+        # Per endpoint the oldest request in flight, which a web UI renders
+        # first, or else the last one sent there
+        current = dict(self.last_job)
+        for endpoint, job in reversed(list(self.in_flight.values())):
+            current[endpoint] = job
+        return list(current.values())
+
+    def skip_item(self):
+        with self.lock:
+            items = {item_key(job) for job in self.current_jobs()}
+            self.skipped_items |= items
+        for prompt_type, item_name in sorted(items):
+            print(f"\nSkipping the remaining images of {item_name}.")
+        self._interrupt(lambda job: item_key(job) in items)
+
+    def skip_image(self):
+        with self.lock:
+            endpoints = {endpoint for endpoint, _ in self.in_flight.values()}
+        for endpoint in sorted(endpoints):
+            self._post(endpoint, '/sdapi/v1/skip')
+
+    def cancel(self):
+        if not self.cancelled.is_set():
+            self.cancelled.set()
+            self.running.set()  # Wakes everything that waits for resume
+            self._changed()
+            print("\nCancelling. Requests in flight are interrupted; their finished images are kept.")
+            self._interrupt(lambda job: True)
+
+    def status(self):
+        with self.lock:
+            return {
+                'state': 'cancelled' if self.cancelled.is_set() else 'running' if self.running.is_set() else 'paused',
+                'in_flight': [{'endpoint': endpoint, 'item': job['item_name'], 'iteration': job['iteration'],
+                               'images': len(job['indices'])} for endpoint, job in self.in_flight.values()],
+                'skipped_items': sorted(item_name for _, item_name in self.skipped_items),
+            }
+
+    def _interrupt(self, match):
+        with self.lock:
+            for key, (endpoint, job) in self.in_flight.items():
+                if match(job):
+                    self.targets.add(key)
+            if self.interrupter is None and self.targets:
+                self.interrupter = threading.Thread(target=self._interrupt_loop, name='interrupter', daemon=True)
+                self.interrupter.start()
+
+    def _interrupt_loop(self):
+        while True:
+            with self.lock:
+                endpoints = {endpoint for key, (endpoint, _) in self.in_flight.items() if key in self.targets}
+                if not endpoints:
+                    self.interrupter = None
+                    return
+                self.interrupted |= {key for key, (endpoint, _) in self.in_flight.items() if endpoint in endpoints}
+            for endpoint in sorted(endpoints):
+                self._post(endpoint, '/sdapi/v1/interrupt')
+            time.sleep(INTERRUPT_REPEAT)
+
+    def _post(self, endpoint, path):
+        try:
+            get_client(endpoint).post(path, timeout=5, retries=0)
+        except requests.exceptions.RequestException as e:
+            print(f"{endpoint}{path} failed: {e}")
+
+    # Unix socket
+
+    def serve(self, path=DEFAULT_SOCKET):
+        # False when the socket cannot be served (no Unix sockets, or in use)
+        if not hasattr(socket, 'AF_UNIX'):
+            print("Control socket unavailable: this platform has no Unix sockets.")
+            return False
+        if os.path.exists(path):
+            try:
+                send_command(path, 'status')
+                print(f"Control socket {path} is used by another run; not serving it.")
+                return False
+            except OSError:
+                os.remove(path)  # Left behind by a run that crashed
+        control = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = control.command(line.decode('utf-8').strip())
+                    except ValueError as e:
+                        reply = {'error': str(e)}
+                    self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+        self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='control-socket', daemon=True).start()
+        print(f"Control socket: {path} (python main.py --control pause|resume|skip-item|skip-image|cancel|status)")
+        return True
+
+    def close(self):
+        if self.server is not None:
+            path = self.server.server_address
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def send_command(path, name, timeout=5.0):
+    # Sends one command to a running generation; returns its reply
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall((name + '\n').encode('utf-8'))
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    return json.loads(reply or b'{}')
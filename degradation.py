@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Graceful degradation after a failed txt2img request. A request that ran
+# out of memory is retried in smaller pieces, one rung at a time:
+#   batch_size  the batch is halved and n_iter grows to make the same images
+#   resolution  the output is rendered DOWNSCALE_FACTOR smaller (multiples
+#               of 8, at least MIN_SIDE), until it fits
+# Iterations run one after another, so splitting n_iter does not lower the
+# peak VRAM use; only a read timeout gets the n_iter rung (the iterations
+# are split into two requests), since a shorter request may finish in time.
+# With a fixed seed every image keeps its seed on every rung. The limit a
+# rung implies, with those of earlier rungs, travels with its retry jobs as
+# job['retry_limit']; it bounds how they are batched again and is
+# remembered per endpoint, model and resolution in the batch tuning cache
+# only once one of them succeeds, so later jobs start below the wall.
+
+from autotune import split_batches, tighten_limits
+from sd_client import ERROR_OOM, ERROR_TIMEOUT
+
+DOWNSCALE_FACTOR = 0.75
+MIN_SIDE = 256
+
+def rebatch(job, batch_size, max_n_iter=None):
+    # Splits a job into requests of at most batch_size x max_n_iter images;
+    # with a fixed seed image k of the job keeps the seed base + k - 1
+    payload = job['payload']
+    indices = job['indices']
+    offset = 0
+    for size, n_iter in split_batches(len(indices), batch_size):
+        while n_iter:
+            take = min(n_iter, max_n_iter or n_iter)
+            sub_payload = dict(payload, batch_size=size, n_iter=take)
+            if job['base_seed'] != -1:
+                sub_payload['seed'] = payload['seed'] + offset
+            yield dict(job, payload=sub_payload, indices=indices[offset:offset + size * take])
+            offset += size * take
+            n_iter -= take
+
+def output_size(payload):
+    if payload.get('enable_hr'):
+        return payload['hr_resize_x'], payload['hr_resize_y']
+    return payload['width'], payload['height']
+
+def smaller_size(width, height):
+    width, height = int(width * DOWNSCALE_FACTOR) // 8 * 8, int(height * DOWNSCALE_FACTOR) // 8 * 8
+    if min(width, height) < MIN_SIDE:
+        return None
+    return width, height
+
+def downscale(job, width, height):
+    # Renders the job's output at width x height. A hires-fix job keeps its
+    # first pass and upscales less, or drops hires-fix when nothing is left
+    # to upscale. `requested_size` keeps the first-pass size the limits are
+    # learned for.
+    payload = job['payload']
+    scaled = dict(payload)
+    if payload.get('enable_hr') and width > payload['width'] and height > payload['height']:
+        scaled.update(hr_resize_x=width, hr_resize_y=height)
+    else:
+        scaled.update(width=width, height=height, enable_hr=False)
+    return dict(job, payload=scaled, requested_size=job.get('requested_size') or (payload['width'], payload['height']))
+
+def degrade(job, kind, allow_downscale=True):
+    # The next rung for a job that failed with error `kind`:
+    # (rung, replacement jobs, limit to learn once one of them succeeds),
+    # or (None, [], None)
+    payload = job['payload']
+    if kind == ERROR_OOM and payload['batch_size'] > 1:
+        batch_size = payload['batch_size'] // 2
+        rung, jobs, limit = 'batch_size', list(rebatch(job, batch_size)), {'max_batch_size': batch_size}
+    elif kind == ERROR_OOM and allow_downscale and smaller_size(*output_size(payload)) is not None:
+        size = smaller_size(*output_size(payload))
+        rung, jobs, limit = 'resolution', [downscale(job, *size)], {'resolution': list(size)}
+    elif kind == ERROR_TIMEOUT and payload['n_iter'] > 1:
+        n_iter = (payload['n_iter'] + 1) // 2
+        rung, jobs, limit = 'n_iter', list(rebatch(job, 1, n_iter)), {'max_n_iter': n_iter}
+    else:
+        return None, [], None
+    # A retry of a retry also keeps to the limits of the rungs before
+    retry_limit = tighten_limits(dict(job.get('retry_limit') or {}), limit)
+    return rung, [dict(retry, retry_limit=retry_limit) for retry in jobs], limit
+
+def describe_rung(rung, jobs):
+    payload = jobs[0]['payload']
+    if rung == 'batch_size':
+        return f"batch_size {payload['batch_size']}"
+    if rung == 'n_iter':
+        return f"{len(jobs)} requests of up to {payload['n_iter']} images"
+    return "{}x{}".format(*output_size(payload))
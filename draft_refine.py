@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Two-phase draft-then-refine generation. The draft phase renders every
+# image at a fraction of the resolution and steps into Iteration_N/drafts/
+# and records the exact seed of each draft (from the response "info") in
+# drafts/drafts.jsonl. The refine phase re-renders only the selected drafts
+# at full settings: the first pass runs at the draft's resolution and seed,
+# so the composition is the one that was picked, and hires-fix takes it to
+# the full resolution. Drafts are selected from a file listing them, or by
+# an automatic score (best N per item and iteration).
+
+import os
+import json
+import threading
+
+DRAFT_DIR = 'drafts'
+MANIFEST_NAME = 'drafts.jsonl'
+SELECTION_NAME = 'selected.txt'
+DEFAULT_DRAFT_STEPS = 12
+DEFAULT_DRAFT_SCALE = 0.5
+DEFAULT_HR_UPSCALER = 'Latent'
+DEFAULT_HR_DENOISE = 0.55
+DEFAULT_KEEP = 1
+SCORERS = ('size', 'sharpness')
+
+def draft_size(value, scale):
+    return max(64, int(value * scale) // 8 * 8)
+
+def draft_payload(payload, scale=DEFAULT_DRAFT_SCALE, steps=DEFAULT_DRAFT_STEPS):
+    return dict(payload, width=draft_size(payload['width'], scale), height=draft_size(payload['height'], scale),
+                steps=min(steps, payload['steps']))
+
+def refine_payload(payload, draft, upscaler=DEFAULT_HR_UPSCALER, denoise=DEFAULT_HR_DENOISE):
+    # First pass at the draft's seed and resolution, hires-fix up to the full one
+    refined = dict(payload, seed=draft['seed'], n_iter=1, batch_size=1)
+    if (draft['width'], draft['height']) != (payload['width'], payload['height']):
+        refined.update(width=draft['width'], height=draft['height'], enable_hr=True,
+                       hr_resize_x=payload['width'], hr_resize_y=payload['height'],
+                       hr_upscaler=upscaler, denoising_strength=denoise, hr_second_pass_steps=0)
+    return refined
+
+class DraftManifest:
+    # Append-only record of every draft image and its seed; the last record
+    # of an image wins, like the journal
+    def __init__(self, story_dir):
+        self.story_dir = story_dir
+        self.path = os.path.join(story_dir, DRAFT_DIR, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line from a crash
+                    self.records[record['path']] = record
+        self.file = None
+
+    def record(self, job, index, seed, path):
+        record = {
+            'path': os.path.relpath(path, self.story_dir),
+            'prompt_type': job['prompt_type'],
+            'item_name': job['item_name'],
+            'iteration': job['iteration'],
+            'index': index,
+            'seed': seed,
+            'width': job['payload']['width'],
+            'height': job['payload']['height'],
+            'steps': job['payload']['steps'],
+        }
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.records[record['path']] = record
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def drafts(self):
+        # Records whose image is still on disk
+        return [record for record in self.records.values() if os.path.exists(os.path.join(self.story_dir, record['path']))]
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def score(path, scorer='size'):
+    # Higher is better. 'size': PNG bytes per pixel, a crude but free
+    # measure of detail; 'sharpness': variance of the edges (needs Pillow)
+    if scorer == 'sharpness':
+        from PIL import Image, ImageFilter, ImageStat
+        with Image.open(path) as image:
+            return ImageStat.Stat(image.convert('L').filter(ImageFilter.FIND_EDGES)).var[0]
+    from struct import unpack
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    width, height = unpack('>II', header[16:24]) if header[12:16] == b'IHDR' else (1, 1)
+    return os.path.getsize(path) / max(1, width * height)
+
+def select_best(story_dir, drafts, keep=DEFAULT_KEEP, scorer='size'):
+    # The `keep` best drafts of every item and iteration
+    groups = {}
+    for record in drafts:
+        groups.setdefault((record['prompt_type'], record['item_name'], record['iteration']), []).append(record)
+    selected = []
+    for _, records in sorted(groups.items()):
+        records.sort(key=lambda record: -score(os.path.join(story_dir, record['path']), scorer))
+        selected.extend(records[:keep])
+    return selected
+
+def read_selection(selection_path, story_dir, drafts):
+    # One draft per line, as a path relative to the story or a file name;
+    # returns (selected records, lines that matched no draft)
+    by_path = {os.path.normpath(record['path']): record for record in drafts}
+    by_name = {os.path.basename(record['path']): record for record in drafts}
+    selected = []
+    unknown = []
+    with open(selection_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            name = line.strip()
+            if not name or name.startswith('#'):
+                continue
+            if os.path.isabs(name):
+                name = os.path.relpath(name, story_dir)
+            record = by_path.get(os.path.normpath(name)) or by_name.get(os.path.basename(name))
+            if record is None:
+                unknown.append(line.strip())
+            elif record not in selected:
+                selected.append(record)
+    return selected, unknown
+
+def write_selection(story_dir, selected):
+    # Written next to the drafts so the choice can be edited and passed back with --select
+    path = os.path.join(story_dir, DRAFT_DIR, SELECTION_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("# Drafts to refine, one per line. Edit and pass back with --select.\n")
+        for record in selected:
+            f.write(record['path'] + '\n')
+    return path
+
+def print_gpu_work(drafts, refine_jobs):
+    # Work estimated as pixels x steps, compared to rendering every draft
+    # at full settings; hires-fix runs denoising_strength x steps at full size
+    if not drafts or not refine_jobs:
+        return
+    draft = sum(record['width'] * record['height'] * record['steps'] for record in drafts)
+    refine = 0
+    for job in refine_jobs:
+        payload = job['payload']
+        full_width = payload.get('hr_resize_x') or payload['width']
+        full_height = payload.get('hr_resize_y') or payload['height']
+        refine += payload['width'] * payload['height'] * payload['steps']
+        if payload.get('enable_hr'):
+            refine += full_width * full_height * payload['steps'] * payload['denoising_strength']
+    full = full_width * full_height * payload['steps'] * len(drafts)
+    print(f"\nEstimated GPU work: drafts {draft / full:.0%} + refine {refine / full:.0%} of rendering "
+          f"all {len(drafts)} images at full settings ({full / (draft + refine):.1f}x less).")
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Pipelined asyncio generation engine. Jobs flow through two stages that
+# are connected by bounded queues:
+#   submit - per endpoint, `in_flight` workers keep that many requests open,
+#            so the web UI always has the next job queued; each response is
+#            streamed through stream_decode as it arrives, every image
+#            straight into its AtomicFile
+#   finish - records the finished request and requeues or fails the images
+#            it did not return
+# Decoding and writing are not stages of their own: a queue in front of
+# either would have to hold whole bodies or whole images, while streaming
+# keeps one network chunk in memory per request, whatever batch_size and
+# n_iter are. Every image of a request ends up written, requeued through
+# remainder_jobs or reported to on_job_failed, so a job scheduler never
+# waits on an image that a short response left out.
+# The blocking HTTP and file calls, and every hook that may touch the disk,
+# run in worker threads so the event loop never waits on one. A request
+# whose hook or payload raises is reported to on_job_failed like any other
+# failure; the worker that sent it carries on.
+# With a control.Control, new requests wait on an asyncio.Event mirroring
+# its pause state, and an interrupted request's unwritten images can be
+# sent again through remainder_jobs.
+
+import time
+from collections import deque
+
+from lazy_imports import lazy_import
+from sd_client import get_client
+from journal import AtomicFile
+from stream_decode import StreamDecodeError, stream_txt2img_response
+
+asyncio = lazy_import('asyncio')
+requests = lazy_import('requests')
+
+DEFAULT_IN_FLIGHT = 2
+DEFAULT_QUEUE_SIZE = 4
+DEFAULT_STAGE_WORKERS = 2
+
+class ShortResponseError(ValueError):
+    # A request that was not interrupted returned fewer images than asked for
+    pass
+
+def image_index(job, idx):
+    # Extra images (e.g. a grid) are numbered after the requested ones
+    indices = job['indices']
+    return indices[idx] if idx < len(indices) else indices[-1] + idx - len(indices) + 1
+
+class EngineStats:
+    def __init__(self):
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.jobs_requeued = 0
+        self.images = 0
+        self.started = time.perf_counter()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'jobs_done': self.jobs_done,
+            'jobs_failed': self.jobs_failed,
+            'images': self.images,
+            'seconds': round(elapsed, 3),
+            'images_per_second': round(self.images / elapsed, 3) if elapsed else 0.0,
+        }
+
+async def run_engine(jobs, endpoints, path_for, in_flight=DEFAULT_IN_FLIGHT, queue_size=DEFAULT_QUEUE_SIZE,
+                     control=None, expand_job=None, before_request=None, open_image=None, on_image_written=None,
+                     on_job_done=None, on_job_failed=None, retry_job=None, remainder_jobs=None, controller=None):
+    # jobs: iterable of job dicts; endpoints: list of base URLs
+    # path_for(job, index) -> output path of image `index`
+    # open_image(job, index) -> file the image is decoded into, an AtomicFile
+    # of path_for by default; its `data`, if it keeps one, goes to on_image_written
+    # expand_job(endpoint, job) -> sub-jobs actually sent (e.g. batch splitting)
+    # before_request(endpoint, job) runs in a thread before each request
+    # on_image_written(endpoint, job, index, data) runs for every image on disk,
+    # in the thread receiving the response
+    # retry_job(endpoint, job, error, latency) -> smaller jobs to send instead
+    # of a failed request, or [] to give it up
+    # remainder_jobs(endpoint, job, written) -> jobs for the images an
+    # interrupted request did not return, or None when it was not interrupted
+    # (images it left out then go to on_job_failed)
+    # control: optional control.Control; requests wait while it is paused and
+    # are no longer sent once it is cancelled
+    # controller: optional concurrency.ConcurrencyController; every endpoint then
+    # gets controller.max_limit submitters, which only send while admitted
+    stats = EngineStats()
+    submit_q = asyncio.Queue(maxsize=queue_size)
+    finish_q = asyncio.Queue(maxsize=queue_size)
+    requeues = set()  # Tasks putting remainder jobs back on submit_q
+    running = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def sync_running():
+        # Called from any thread when the control changes state
+        loop.call_soon_threadsafe(running.set if control.running.is_set() else running.clear)
+
+    async def wait_running():
+        # False once cancelled
+        if control is None:
+            return True
+        await running.wait()
+        return not control.cancelled.is_set()
+
+    def requeue(job):
+        stats.jobs_requeued += 1
+        task = asyncio.create_task(submit_q.put(job))
+        requeues.add(task)
+        task.add_done_callback(requeues.discard)
+
+    async def failed(endpoint, job, error, latency):
+        stats.jobs_failed += 1
+        print(f"Error generating images for {job['item_name']} in iteration {job['iteration']}: {error}")
+        if on_job_failed is not None:
+            await asyncio.to_thread(on_job_failed, endpoint, job, error, latency)
+
+    def expand(endpoint, job):
+        # Runs in a thread: expanding may copy cached images
+        return list(expand_job(endpoint, job)) if expand_job is not None else [job]
+
+    def job_written(endpoint, job, written, fields, latency):
+        # Runs in a thread: the hooks write the journal and the telemetry.
+        # Returns (jobs to requeue, images to report as failed).
+        if on_job_done is not None:
+            on_job_done(endpoint, job, fields, latency)
+        rest = remainder_jobs(endpoint, job, written) if remainder_jobs is not None else None
+        if rest is not None:
+            return rest, []
+        return [], [index for index in job['indices'] if index not in written]
+
+    async def feeder():
+        # Pulled in a thread: a job scheduler may wait there for a dependency to finish
+        jobs_left = iter(jobs)
+        while await wait_running():
+            job = await asyncio.to_thread(next, jobs_left, None)
+            if job is None:
+                break
+            await submit_q.put(job)
+
+    def post(endpoint, job):
+        # Streams the images into their files; returns (image numbers written,
+        # the other response fields)
+        if before_request is not None:
+            before_request(endpoint, job)
+        response = get_client(endpoint).post('/sdapi/v1/txt2img', json=job['payload'], stream=True)
+        response.raise_for_status()  # Error bodies are small; retry_job reads them
+        files = {}
+        written = []
+
+        def open_file(idx):
+            index = image_index(job, idx)
+            files[idx] = open_image(job, index) if open_image is not None else AtomicFile(path_for(job, index))
+            return files[idx]
+
+        def image_done(count):
+            # The journal, output cache and post-processor hear of each image
+            # as soon as it is on disk (the latter may wait for its backlog)
+            image_file = files.pop(count - 1)
+            written.append(image_index(job, count - 1))
+            if on_image_written is not None:
+                on_image_written(endpoint, job, written[-1], getattr(image_file, 'data', None))
+
+        fields = stream_txt2img_response(response, open_file, on_image_done=image_done)
+        return written, fields
+
+    async def submitter(endpoint):
+        while True:
+            job = await submit_q.get()
+            try:
+                try:
+                    sub_jobs = deque(await asyncio.to_thread(expand, endpoint, job))
+                except Exception as e:
+                    # A failing hook must not take the worker down with it
+                    await failed(endpoint, job, e, 0.0)
+                    continue
+                while sub_jobs:
+                    sub_job = sub_jobs.popleft()
+                    if not await wait_running():
+                        continue  # Its images stay planned
+                    while controller is not None and not controller.admits(endpoint, active[endpoint]):
+                        await asyncio.sleep(0.1)
+                    active[endpoint] += 1
+                    start = time.perf_counter()
+                    try:
+                        written, fields = await asyncio.to_thread(post, endpoint, sub_job)
+                    except requests.exceptions.RequestException as e:
+                        # Caught first: RequestException is an OSError too
+                        latency = time.perf_counter() - start
+                        try:
+                            retry = await asyncio.to_thread(retry_job, endpoint, sub_job, e, latency) if retry_job is not None else []
+                        except Exception as retry_error:
+                            await failed(endpoint, sub_job, retry_error, latency)
+                            continue
+                        if retry:
+                            sub_jobs.extendleft(reversed(retry))
+                        else:
+                            await failed(endpoint, sub_job, e, latency)
+                        continue
+                    except (StreamDecodeError, OSError) as e:
+                        # A malformed body, or an image file that could not be written
+                        await failed(endpoint, sub_job, e, time.perf_counter() - start)
+                        continue
+                    except Exception as e:
+                        # E.g. a hook or the payload raising; the job's images are
+                        # reported as failed and the worker takes the next one
+                        await failed(endpoint, sub_job, e, time.perf_counter() - start)
+                        continue
+                    finally:
+                        active[endpoint] -= 1
+                    await finish_q.put((endpoint, sub_job, written, fields, time.perf_counter() - start))
+            finally:
+                submit_q.task_done()
+
+    async def finisher():
+        while True:
+            endpoint, job, written, fields, latency = await finish_q.get()
+            try:
+                stats.images += len(written)
+                stats.jobs_done += 1
+                rest, missing = await asyncio.to_thread(job_written, endpoint, job, written, fields, latency)
+                for rest_job in rest:
+                    requeue(rest_job)
+                if missing:
+                    error = ShortResponseError(f"{len(missing)} of {len(job['indices'])} images missing from the response")
+                    await failed(endpoint, dict(job, indices=missing), error, latency)
+                elif not rest:
+                    print(f"Iteration {job['iteration']}: Completed generating images for {job['item_name']} on {endpoint}")
+            except Exception as e:
+                await failed(endpoint, job, e, latency)
+            finally:
+                finish_q.task_done()
+
+    active = {endpoint: 0 for endpoint in endpoints}  # Requests open per endpoint
+    submitters = controller.max_limit if controller is not None else max(1, in_flight)
+    workers = [asyncio.create_task(submitter(endpoint)) for endpoint in endpoints for _ in range(submitters)]
+    for _ in range(DEFAULT_STAGE_WORKERS):
+        workers.append(asyncio.create_task(finisher()))
+    if control is not None:
+        control.add_listener(sync_running)
+        sync_running()
+    try:
+        await feeder()
+        while True:
+            requeued = stats.jobs_requeued
+            await submit_q.join()
+            await finish_q.join()
+            if stats.jobs_requeued == requeued:
+                break
+            await asyncio.gather(*requeues)
+    finally:
+        if control is not None:
+            control.remove_listener(sync_running)
+        for worker in workers + list(requeues):
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return stats.summary()
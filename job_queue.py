@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# Persistent job queue of a story in <story>/queue.sqlite3 (WAL mode), so
+# several worker processes, each pointed at its own web UIs, can share the
+# work. Jobs are claimed one at a time inside an IMMEDIATE transaction,
+# which makes a claim atomic across processes: the highest Priority first,
+# then plan order, skipping jobs whose DependsOn items still have jobs
+# pending or running on any worker (see scheduler.py). A claim is a
+# lease of LEASE_SECONDS that a heartbeat thread keeps renewing while the
+# worker is alive; a job whose lease ran out (its worker died) is claimed
+# again by the next worker, up to MAX_ATTEMPTS times. Adding the jobs of a
+# story again only adds new ones and re-queues failed ones, so finished
+# work is never repeated. Start another worker with --join to add a GPU to
+# a running story.
+
+import os
+import json
+import time
+import heapq
+import threading
+
+from lazy_imports import lazy_import
+from scheduler import DEFAULT_PRIORITY, item_label, job_item, matching_items, resolve_dependencies
+
+# Only loaded once a run uses the queue (--queue, --join, --queue-status)
+sqlite3 = lazy_import('sqlite3')
+socket = lazy_import('socket')
+
+QUEUE_NAME = 'queue.sqlite3'
+LEASE_SECONDS = 60.0
+HEARTBEAT_SECONDS = 15.0
+POLL_SECONDS = 2.0  # How often an idle worker looks for reclaimable jobs
+MAX_ATTEMPTS = 3
+BUSY_TIMEOUT = 30.0  # Seconds to wait for another process's write lock
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, RUNNING, DONE, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    job TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL,
+    prompt_type TEXT,
+    item TEXT,
+    priority REAL NOT NULL DEFAULT 0,
+    depends_on TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority DESC, id);
+CREATE INDEX IF NOT EXISTS jobs_item ON jobs (prompt_type, item, state);
+"""
+
+def queue_key(job):
+    indices = ','.join(str(index) for index in job['indices'])
+    return f"{job.get('phase') or 'final'}/{job['prompt_type']}/{job['item_name']}/{job['iteration']}/{indices}"
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class JobQueue:
+    def __init__(self, path, worker=None):
+        self.path = path
+        self.worker = worker or worker_name()
+        self.local = threading.local()  # One connection per thread
+        self.connections = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(SCHEMA)
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # Only used by the thread that opened it; close() may close it from another
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            with self.lock:
+                self.connections.append(db)
+        return db
+
+    def add(self, jobs):
+        # Returns (added, requeued, skipped). Jobs that are not finished yet
+        # take the priority and dependencies they are added with.
+        jobs = list(jobs)
+        added = requeued = skipped = 0
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            items = {job_item(job) for job in jobs}
+            items |= {tuple(row) for row in db.execute('SELECT DISTINCT prompt_type, item FROM jobs')}
+            for job in jobs:
+                key = queue_key(job)
+                priority = job.get('priority', DEFAULT_PRIORITY)
+                depends = json.dumps(resolve_dependencies(job, items)[0])
+                row = db.execute('SELECT state FROM jobs WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    db.execute('INSERT INTO jobs (key, job, state, updated, prompt_type, item, priority, depends_on) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key, json.dumps(job), PENDING, now) + job_item(job) + (priority, depends))
+                    added += 1
+                elif row[0] == FAILED:
+                    db.execute('UPDATE jobs SET job = ?, state = ?, attempts = 0, error = NULL, updated = ?, '
+                               'priority = ?, depends_on = ? WHERE key = ?',
+                               (json.dumps(job), PENDING, now, priority, depends, key))
+                    requeued += 1
+                else:
+                    if row[0] == PENDING:
+                        db.execute('UPDATE jobs SET priority = ?, depends_on = ? WHERE key = ?', (priority, depends, key))
+                    skipped += 1
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return added, requeued, skipped
+
+    def claim(self, lease=LEASE_SECONDS):
+        # The next pending job whose dependencies are done, or one whose
+        # worker stopped renewing its lease; None when there is nothing to
+        # claim right now. The candidates are read in claim order and only
+        # until the first one that may run.
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Jobs that keep losing their worker are given up
+            db.execute('UPDATE jobs SET state = ?, error = ?, worker = NULL, lease_until = NULL, updated = ? '
+                       'WHERE state = ? AND lease_until < ? AND attempts >= ?',
+                       (FAILED, f"lease expired {MAX_ATTEMPTS} times", now, RUNNING, now, MAX_ATTEMPTS))
+            row = first = None
+            candidates = self._candidates(db, now)
+            try:
+                for candidate in candidates:
+                    first = first or candidate
+                    if not self._waiting(db, candidate):
+                        row = candidate
+                        break
+            finally:
+                candidates.close()
+            if row is None and first is not None and not db.execute('SELECT 1 FROM jobs WHERE state = ? AND lease_until >= ? LIMIT 1',
+                                                                    (RUNNING, now)).fetchone():
+                # Nothing runs anywhere that could finish a dependency
+                unfinished = {tuple(item) for item in db.execute('SELECT DISTINCT prompt_type, item FROM jobs WHERE state IN (?, ?)',
+                                                                 (PENDING, RUNNING))}
+                blocked = sorted({item_label((candidate[3], candidate[4]), unfinished) for candidate in self._candidates(db, now)})
+                print(f"\nQueue: dependency cycle among {', '.join(blocked)}; their dependencies are ignored.")
+                row = first
+            job = None
+            if row is not None:
+                db.execute('UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE id = ?',
+                           (RUNNING, self.worker, now + lease, now, row[0]))
+                job = db.execute('SELECT job FROM jobs WHERE id = ?', (row[0],)).fetchone()[0]
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        if row[1] == RUNNING:
+            print(f"Queue: reclaimed a job of {row[2]}, whose lease ran out.")
+        return dict(json.loads(job), queue_id=row[0])
+
+    def _candidates(self, db, now):
+        # Pending jobs and jobs whose lease ran out, highest Priority first,
+        # then plan order: (id, state, worker, prompt_type, item, depends_on, priority)
+        columns = 'SELECT id, state, worker, prompt_type, item, depends_on, priority FROM jobs '
+        pending = db.execute(columns + 'WHERE state = ? ORDER BY priority DESC, id', (PENDING,))
+        expired = db.execute(columns + 'WHERE state = ? AND lease_until < ? ORDER BY priority DESC, id', (RUNNING, now))
+        try:
+            yield from heapq.merge(pending, expired, key=lambda row: (-row[6], row[0]))
+        finally:
+            pending.close()
+            expired.close()
+
+    def _waiting(self, db, row):
+        # Whether a DependsOn item of the row still has jobs pending or running
+        for prompt_type, item in json.loads(row[5]):
+            if db.execute('SELECT 1 FROM jobs WHERE prompt_type = ? AND item = ? AND state IN (?, ?) LIMIT 1',
+                          (prompt_type, item, PENDING, RUNNING)).fetchone():
+                return True
+        return False
+
+    def finish(self, job, ok, error=None):
+        # False when the lease was lost to another worker in the meantime
+        cursor = self._db().execute(
+            'UPDATE jobs SET state = ?, error = ?, lease_until = NULL, updated = ? WHERE id = ? AND worker = ? AND state = ?',
+            (DONE if ok else FAILED, error, time.time(), job['queue_id'], self.worker, RUNNING))
+        return cursor.rowcount == 1
+
+    def reprioritize(self, name, priority):
+        # For --control priority; applies to the unclaimed jobs of every
+        # worker. False when no item of that name is queued.
+        db = self._db()
+        items = matching_items(name, [tuple(row) for row in db.execute('SELECT DISTINCT prompt_type, item FROM jobs')])
+        if not items:
+            return False
+        updated = 0
+        for prompt_type, item in items:
+            updated += db.execute('UPDATE jobs SET priority = ? WHERE prompt_type = ? AND item = ? AND state = ?',
+                                  (priority, prompt_type, item, PENDING)).rowcount
+        print(f"\n{name} now has priority {priority:g} in the queue ({updated} jobs not claimed yet).")
+        return True
+
+    def renew(self, lease=LEASE_SECONDS):
+        now = time.time()
+        self._db().execute('UPDATE jobs SET lease_until = ?, updated = ? WHERE worker = ? AND state = ?',
+                           (now + lease, now, self.worker, RUNNING))
+
+    def counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        for state, count in self._db().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'):
+            counts[state] = count
+        return counts
+
+    def workers(self):
+        # {worker: jobs it holds a live lease on}
+        rows = self._db().execute('SELECT worker, COUNT(*) FROM jobs WHERE state = ? AND lease_until >= ? GROUP BY worker',
+                                  (RUNNING, time.time()))
+        return dict(rows.fetchall())
+
+    def release(self, job):
+        # Hands a claimed job back unfinished (e.g. cancelled), without using up an attempt
+        self._db().execute('UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, attempts = MAX(0, attempts - 1), '
+                           'updated = ? WHERE id = ? AND worker = ? AND state = ?',
+                           (PENDING, time.time(), job['queue_id'], self.worker, RUNNING))
+
+    def jobs(self, wait_running=lambda: True):
+        # Claimed jobs until none are pending and no other worker holds one
+        # it might still drop; wait_running blocks while paused and returns
+        # False to stop claiming
+        while True:
+            if not wait_running():
+                return
+            job = self.claim()
+            if job is not None:
+                yield job
+                continue
+            counts = self.counts()
+            if not counts[PENDING] and not counts[RUNNING]:
+                return
+            time.sleep(POLL_SECONDS)
+
+    def start_heartbeat(self):
+        self.stop_event.clear()
+        self.heartbeat = threading.Thread(target=self._beat, name='queue-heartbeat', daemon=True)
+        self.heartbeat.start()
+
+    def _beat(self):
+        while not self.stop_event.wait(HEARTBEAT_SECONDS):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                print(f"Queue heartbeat failed: {e}")
+
+    def close(self):
+        self.stop_event.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        with self.lock:
+            for db in self.connections:
+                db.close()
+            self.connections = []
+        self.local = threading.local()
+
+def format_counts(counts):
+    return ', '.join(f"{counts[state]} {state}" for state in STATES)
+
+def print_queue_status(story_dir):
+    path = os.path.join(story_dir, QUEUE_NAME)
+    if not os.path.exists(path):
+        print(f"{story_dir} has no job queue.")
+        return False
+    queue = JobQueue(path)
+    print(f"Queue of {story_dir}: {format_counts(queue.counts())}")
+    for worker, count in sorted(queue.workers().items()):
+        print(f"  {worker}: {count} running")
+    queue.close()
+    return True
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Per-story run journal. Every planned image and every outcome is appended
+# to <story>/journal.jsonl and fsynced, so after a crash the last known
+# status of each (type, item, iteration, image) survives. Images are written
+# through AtomicFile so a PNG on disk is always complete.
+
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+JOURNAL_NAME = 'journal.jsonl'
+
+PLANNED = 'planned'
+DONE = 'done'
+FAILED = 'failed'
+
+def job_key(prompt_type, item_name, iteration, index):
+    return f"{prompt_type}/{item_name}/{iteration}/{index}"
+
+class AtomicFile:
+    # Writes to a temporary file and renames it into place on close()
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.part"
+        self.file = open(self.tmp_path, 'wb')
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+class Journal:
+    def __init__(self, story_dir):
+        self.path = os.path.join(story_dir, JOURNAL_NAME)
+        self.lock = threading.Lock()
+        self.status = self._load()
+        os.makedirs(story_dir, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        status = {}
+        if not os.path.exists(self.path):
+            return status
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn final line from a crash
+                status[record['key']] = record
+        return status
+
+    def record_many(self, records):
+        with self.lock:
+            now = round(time.time(), 3)
+            for record in records:
+                record['ts'] = now
+                self.status[record['key']] = record
+                self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def record(self, prompt_type, item_name, iteration, indices, state, error=None):
+        records = []
+        for index in indices:
+            record = {'key': job_key(prompt_type, item_name, iteration, index), 'status': state}
+            if error:
+                record['error'] = error
+            records.append(record)
+        self.record_many(records)
+
+    def state_of(self, prompt_type, item_name, iteration, index):
+        record = self.status.get(job_key(prompt_type, item_name, iteration, index))
+        return record['status'] if record else None
+
+    def counts(self):
+        counts = {}
+        for record in self.status.values():
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def existing_files(paths, workers=16):
+    # Stat the output tree in parallel; network filesystems answer slowly per file
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return {path for path, exists in zip(paths, executor.map(os.path.exists, paths)) if exists}
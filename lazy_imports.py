@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Startup helpers. lazy_import() hands out a module whose real import runs
+# on first attribute access, so requests, asyncio and friends are only
+# loaded once a code path actually talks to a backend. ImportProfiler
+# times every import for the --import-profile report.
+
+import sys
+import time
+import builtins
+import importlib.util
+
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+class ImportProfiler:
+    # Wraps builtins.__import__ and records how long each new module took,
+    # including the modules it imported itself
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.entries = []  # (seconds since start, cumulative seconds, depth, name)
+        self.depth = 0
+        self.original = None
+
+    def install(self):
+        self.original = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self.original is not None:
+            builtins.__import__ = self.original
+            self.original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.original(name, globals, locals, fromlist, level)
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            self.entries.append((start - self.started, time.perf_counter() - start, self.depth, name))
+
+    def report(self, limit=15):
+        total = time.perf_counter() - self.started
+        top_level = [entry for entry in self.entries if entry[2] == 0]
+        print(f"\nImport profile ({len(self.entries)} modules, {sum(e[1] for e in top_level) * 1000:.1f} ms importing, "
+              f"{total * 1000:.1f} ms since start):")
+        for at, seconds, depth, name in sorted(top_level, key=lambda entry: -entry[1])[:limit]:
+            print(f"  {seconds * 1000:8.1f} ms  {name} (at +{at * 1000:.0f} ms)")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Spreads txt2img jobs over several Automatic1111 web UI instances.
+# Every backend owns a queue and a fixed number of worker threads (its
+# in-flight slots). A job is only handed to a backend when one of its
+# slots is free, and the backend with the lowest load relative to its
+# weight wins, so faster GPUs naturally pick up more work. With a
+# concurrency controller the usable slots follow its adaptive limits.
+
+import threading
+import queue
+
+DEFAULT_MAX_IN_FLIGHT = 2
+
+def parse_endpoints(sd_settings):
+    # Accept "api_endpoints": [{"url": ..., "weight": ...}, "http://..."]
+    # and fall back to the single "api_endpoint" of older settings files.
+    raw = sd_settings.get('api_endpoints') or [sd_settings.get('api_endpoint', 'http://localhost:7860')]
+    endpoints = []
+    for entry in raw:
+        if isinstance(entry, str):
+            entry = {'url': entry}
+        url = entry['url'].rstrip('/')
+        weight = float(entry.get('weight', 1))
+        if weight <= 0:
+            print(f"Skipping endpoint {url}: weight must be positive.")
+            continue
+        endpoints.append({
+            'url': url,
+            'weight': weight,
+            'max_in_flight': int(entry.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT)),
+        })
+    return endpoints
+
+class Backend:
+    def __init__(self, url, weight=1.0, max_in_flight=DEFAULT_MAX_IN_FLIGHT, controller=None):
+        self.url = url
+        self.controller = controller
+        self.weight = weight
+        self.max_in_flight = max(1, max_in_flight)
+        self.jobs = queue.Queue()
+        self.in_flight = 0  # Queued on this backend or currently running
+        self.completed = 0
+        self.failed = 0
+
+    def load(self):
+        return self.in_flight / self.weight
+
+    def has_capacity(self):
+        if self.controller is not None:
+            return self.controller.admits(self.url, self.in_flight)
+        return self.in_flight < self.max_in_flight
+
+class LoadBalancer:
+    def __init__(self, endpoints, handler, controller=None):
+        # handler(backend_url, job) runs one job against one backend
+        # controller: optional concurrency.ConcurrencyController; every backend
+        # then gets controller.max_limit slots, of which it admits the usable ones
+        self.handler = handler
+        self.backends = [Backend(e['url'], e.get('weight', 1.0),
+                                 controller.max_limit if controller is not None else e.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT),
+                                 controller)
+                         for e in endpoints]
+        if not self.backends:
+            raise ValueError("At least one API endpoint is required.")
+        self.lock = threading.Condition()
+        self.threads = []
+        for backend in self.backends:
+            for slot in range(backend.max_in_flight):
+                thread = threading.Thread(target=self._worker, args=(backend,), name=f"{backend.url}#{slot}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _pick_backend(self):
+        candidates = [b for b in self.backends if b.has_capacity()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: (b.load(), b.in_flight))
+
+    def submit(self, job):
+        # Blocks until some backend has a free slot
+        with self.lock:
+            backend = self._pick_backend()
+            while backend is None:
+                # Adaptive limits can rise without any job finishing
+                self.lock.wait(timeout=0.5)
+                backend = self._pick_backend()
+            backend.in_flight += 1
+        backend.jobs.put(job)
+        return backend.url
+
+    def _worker(self, backend):
+        while True:
+            job = backend.jobs.get()
+            if job is None:
+                backend.jobs.task_done()
+                return
+            ok = False
+            try:
+                ok = self.handler(backend.url, job) is not False
+            except Exception as e:
+                print(f"Unexpected error on {backend.url}: {e}")
+            finally:
+                with self.lock:
+                    backend.in_flight -= 1
+                    if ok:
+                        backend.completed += 1
+                    else:
+                        backend.failed += 1
+                    self.lock.notify_all()
+                backend.jobs.task_done()
+
+    def wait(self):
+        for backend in self.backends:
+            backend.jobs.join()
+
+    def close(self):
+        self.wait()
+        for backend in self.backends:
+            for _ in range(backend.max_in_flight):
+                backend.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def summary(self):
+        return [{'url': b.url, 'completed': b.completed, 'failed': b.failed} for b in self.backends]
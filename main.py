@@ -1,42 +1,91 @@
 #!/usr/bin/env python3
 
-import os
 import sys
+from lazy_imports import ImportProfiler, lazy_import
+
+# Installed before anything else is imported so --import-profile sees it all
+import_profiler = ImportProfiler() if '--import-profile' in sys.argv else None
+if import_profiler is not None:
+    import_profiler.install()
+
+import os
 import json
 import time
-import requests
-import base64
 import argparse
 import logging
-from tqdm import tqdm  # For progress bar
-
-# For keyboard listener
-try:
-    import pynput
-    from pynput import keyboard
-except ImportError:
-    print("The 'pynput' module is required for pause functionality. Installing it now...")
-    os.system(f"{sys.executable} -m pip install pynput")
-    import pynput
-    from pynput import keyboard
-
-paused = False  # Global variable to control pause state
+import itertools
+
+from load_balancer import LoadBalancer, parse_endpoints
+from sd_client import ERROR_MODEL_LOAD, classify_error, configure_clients, get_client, print_latency_report
+from stream_decode import StreamDecodeError, stream_txt2img_response
+from telemetry import DEFAULT_EVENT_LOG, EventLog, payload_hash, seed_from_info
+from journal import DONE, FAILED, PLANNED, AtomicFile, Journal, existing_files, job_key
+from autotune import BatchTuningCache, autotune, tighten_limits
+from degradation import degrade, describe_rung, downscale, output_size, rebatch
+from engine import DEFAULT_IN_FLIGHT, ShortResponseError, run_engine
+from concurrency import DEFAULT_MAX_LIMIT, ConcurrencyController, print_concurrency_report
+from progress import ProgressMonitor
+from planner import CheckpointTracker, job_checkpoint, job_group, plan_by_affinity, print_checkpoint_loads, print_plan_summary, summarize_plan
+from output_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_GB, OutputCache, image_payload, is_deterministic, print_cache_report
+from postprocess import DEFAULT_BACKLOG, CapturingFile, PostProcessor, parse_steps, pillow_available, print_postprocess_report
+from shared_output import SharedOutput, print_shared_output_report
+from job_queue import QUEUE_NAME, JobQueue, format_counts, print_queue_status
+from control import COMMANDS, DEFAULT_SOCKET, Control, send_command
+from scheduler import JobScheduler, item_dependencies, item_priority, print_schedule
+from draft_refine import (DEFAULT_DRAFT_SCALE, DEFAULT_DRAFT_STEPS, DEFAULT_HR_DENOISE, DEFAULT_HR_UPSCALER, DEFAULT_KEEP,
+                          DRAFT_DIR, SCORERS, DraftManifest, draft_payload, print_gpu_work, read_selection, refine_payload,
+                          select_best, write_selection)
+from model_catalog import ModelCatalog, describe, lora_mismatch
+from prompt_parser import iter_prompt_blocks
+from prompt_templates import PromptTemplateError, count_variations, expand_blocks
+from run_spec import (EXIT_BACKEND_DOWN, EXIT_IMAGES_FAILED, EXIT_INTERRUPTED, EXIT_INVALID_SPEC, EXIT_OK, SpecError,
+                      add_spec_arguments, build_stories, fetch_backend_options, is_headless, print_spec_errors,
+                      resolve_settings, validate_settings)
+
+# Heavy or optional modules are only loaded when their feature is used
+requests = lazy_import('requests')
+keyboard = None  # pynput.keyboard, imported by start_keyboard_listener()
+
+control = Control()  # Pause, resume, skip and cancel, from the keyboard or --control-socket
 keyboard_listener = None  # Global variable for keyboard listener
+event_log = None  # Structured per-request telemetry, set up in main()
+journal = None  # Crash-safe record of planned and finished images, set up in main()
+batch_cache = None  # Auto-tuned batch sizes per backend, model and resolution
+checkpoint_tracker = None  # Loaded checkpoint per backend, used to switch models explicitly
+progress_monitor = None  # Live step progress, ETA and throughput from /sdapi/v1/progress
+output_cache = None  # Finished images by payload hash, reused instead of regenerated
+model_catalog = None  # Indexed checkpoints and LoRAs, see get_model_catalog()
+model_dirs = None  # (checkpoint directory, LoRA directory) under sd_folder
+post_processor = None  # Optional WebP/AVIF copies, thumbnails and contact sheets, made in worker processes
+shared_output = None  # Picks images up from the web UI's output folder instead of base64, see --shared-output
+draft_manifest = None  # Seeds of the story's draft images, during --draft and --refine
+concurrency = None  # Adaptive in-flight limits per backend, see --adaptive
+oom_downscale = True  # Whether out-of-memory retries may lower the resolution, see --no-downscale
+job_queue = None  # The story's job queue shared with other worker processes, see --queue and --join
+scheduler = None  # Hands out the story's jobs by Priority and DependsOn, see scheduler.py
 
 def on_press(key):
-    global paused
-    try:
-        if key == keyboard.Key.space:
-            paused = not paused
-            state = "Paused" if paused else "Resumed"
-            print(f"\n{state}...")
-    except AttributeError:
-        pass
+    # Space pauses and resumes; while paused, 's' skips the current item and 'c' cancels
+    if key == keyboard.Key.space:
+        control.command('toggle')
+        if not control.running.is_set():
+            print("Press 'Space' to resume, 's' to skip the current item or 'c' to cancel.")
+    elif not control.running.is_set() and getattr(key, 'char', None) in ('s', 'c'):
+        control.command('skip-item' if key.char == 's' else 'cancel')
+        control.resume()
 
 def start_keyboard_listener():
-    global keyboard_listener
-    keyboard_listener = keyboard.Listener(on_press=on_press)
-    keyboard_listener.start()
+    # The pause key is optional: pynput may be missing or have no display
+    global keyboard_listener, keyboard
+    try:
+        from pynput import keyboard
+        keyboard_listener = keyboard.Listener(on_press=on_press)
+        keyboard_listener.start()
+    except Exception as e:
+        keyboard_listener = None
+        print(f"Pause key unavailable ({e or type(e).__name__}). Install pynput to pause with Space.")
+        return False
+    return True
 
 def stop_keyboard_listener():
     global keyboard_listener
@@ -53,51 +102,84 @@ def load_sd_settings():
     with open(sd_settings_path, 'r') as f:
         return json.load(f)
 
-def load_prompts(file_path):
-    with open(file_path, 'r') as f:
-        content = f.read()
-    return [block.strip() for block in content.split('---') if block.strip()]
-
-def parse_prompt_block(block):
-    lines = block.strip().split('\n')
-    data = {}
-    current_key = None
-    for line in lines:
-        if ':' in line:
-            key, value = line.split(':', 1)
-            current_key = key.strip()
-            data[current_key] = value.strip()
-        else:
-            if current_key:
-                data[current_key] += ' ' + line.strip()
-    return data
+def prompts_file_for(prompt_type, folder_path=''):
+    return os.path.join(folder_path, 'characters.txt' if prompt_type == 'character' else 'scenes.txt')
 
-def create_prompts(prompt_type):
-    if prompt_type == 'character':
-        prompts_file = 'characters.txt'
-    else:
-        prompts_file = 'scenes.txt'
+def create_prompts(prompt_type, folder_path=''):
+    # Lazily parsed and template-expanded: prompts come out one by one while the file is read
+    prompts_file = prompts_file_for(prompt_type, folder_path)
+    return expand_blocks(iter_prompt_blocks(prompts_file), prompts_file, folder_path)
 
-    prompt_blocks = load_prompts(prompts_file)
-    prompts = []
-    for block in prompt_blocks:
-        data = parse_prompt_block(block)
-        prompts.append(data)
-    return prompts
+def validate_prompts(folder_path=''):
+    # Parses characters.txt and scenes.txt and returns the problems found
+    problems = []
+    wildcards = {}
+    for prompt_type in ('character', 'scene'):
+        prompts_file = prompts_file_for(prompt_type, folder_path)
+        if not os.path.exists(prompts_file):
+            problems.append(f"{prompts_file} not found.")
+            continue
+        names = set()
+        count = 0
+        expanded = 0
+        for line_no, data in iter_prompt_blocks(prompts_file, on_problem=lambda e: problems.append(str(e))):
+            count += 1
+            item_name = data.get('Name', 'Unnamed').replace(' ', '_')
+            if item_name in names:
+                problems.append(f"{prompts_file}:{line_no}: {data.get('Name')} is listed more than once.")
+            names.add(item_name)
+            try:
+                expanded += count_variations(data, folder_path, wildcards)
+            except PromptTemplateError as e:
+                problems.append(f"{prompts_file}:{line_no}: {e}")
+        print(f"{prompts_file}: {count} {prompt_type} prompts, {expanded} after template expansion.")
+    return problems
+
+def get_model_catalog():
+    global model_catalog
+    if model_catalog is None:
+        model_catalog = ModelCatalog()
+    return model_catalog
+
+def model_paths(sd_settings):
+    sd_folder = sd_settings.get('sd_folder', '')
+    return os.path.join(sd_folder, 'models/Stable-diffusion'), os.path.join(sd_folder, 'models/Lora')
 
 def get_available_models(sd_models_path):
-    model_extensions = ('.ckpt', '.safetensors', '.pt')
-    models = [f for f in os.listdir(sd_models_path) if os.path.isfile(os.path.join(sd_models_path, f)) and f.lower().endswith(model_extensions)]
-    return models
+    # Listed from the catalog index, only rescanned when the directory changed
+    return get_model_catalog().names(sd_models_path)
 
 def get_available_loras(sd_loras_path):
-    lora_extensions = ('.ckpt', '.safetensors', '.pt')
-    loras = [f for f in os.listdir(sd_loras_path) if os.path.isfile(os.path.join(sd_loras_path, f)) and f.lower().endswith(lora_extensions)]
-    return loras
+    return get_model_catalog().names(sd_loras_path)
+
+def lora_problem(checkpoint, lora):
+    # Why `lora` cannot be used on `checkpoint`, or None when it can (or nobody knows)
+    if not checkpoint or not lora or model_dirs is None:
+        return None
+    catalog = get_model_catalog()
+    models_path, loras_path = model_dirs
+    return lora_mismatch(catalog.info(models_path, checkpoint), catalog.info(loras_path, lora), checkpoint, lora)
+
+def reject_mismatched_loras(jobs):
+    # Drops jobs whose LoRA was made for another architecture than their
+    # checkpoint before they reach a backend, and records them as failed
+    problems = {}
+    for job in jobs:
+        group = job_group(job)
+        if group not in problems:
+            problems[group] = lora_problem(*group)
+            if problems[group]:
+                print(f"Skipping jobs: {problems[group]}.")
+        if not problems[group]:
+            yield job
+            continue
+        logging.error(f"Skipped {job['item_name']} in iteration {job['iteration']}: {problems[group]}")
+        if journal is not None:
+            journal.record(job['prompt_type'], job['item_name'], job['iteration'], job['indices'], FAILED, error=problems[group])
 
 def get_available_samplers(api_endpoint):
     try:
-        response = requests.get(f'{api_endpoint}/sdapi/v1/samplers')
+        response = get_client(api_endpoint).get('/sdapi/v1/samplers')
         response.raise_for_status()
         samplers = response.json()
         return [sampler['name'] for sampler in samplers]
@@ -107,7 +189,7 @@ def get_available_samplers(api_endpoint):
 
 def get_available_schedulers(api_endpoint):
     try:
-        response = requests.get(f'{api_endpoint}/sdapi/v1/schedulers')
+        response = get_client(api_endpoint).get('/sdapi/v1/schedulers')
         response.raise_for_status()
         schedulers = response.json()
         return [scheduler['name'] for scheduler in schedulers]
@@ -120,7 +202,7 @@ def check_stable_diffusion_running(api_endpoint):
     test_url = f'{api_endpoint}/sdapi/v1/sd-models'
     print(f"Checking if Stable Diffusion web UI is running at {test_url}...")
     try:
-        response = requests.get(test_url)
+        response = get_client(api_endpoint).get('/sdapi/v1/sd-models', retries=0)
         if response.status_code == 200:
             print("Stable Diffusion web UI is running.")
             return True
@@ -133,255 +215,1083 @@ def check_stable_diffusion_running(api_endpoint):
         print(f"An error occurred: {e}")
     return False
 
-def generate_json_files(prompts, prompt_type, story_name, default_seed):
+def write_prompt_json(data, base_dir, default_seed, num_images=1, num_iterations=1):
+    item_name = data.get('Name', 'Unnamed').replace(' ', '_')
+    item_dir = os.path.join(base_dir, item_name)
+    os.makedirs(item_dir, exist_ok=True)
+    prompt_path = os.path.join(item_dir, 'prompt.json')
+    # Remove 'Name' from data to avoid redundancy in JSON
+    data_without_name = {k: v for k, v in data.items() if k != 'Name'}
+    # Add placeholders for 'Number of Images', 'Number of Iterations', and 'Seed'
+    data_without_name['Number of Images'] = num_images
+    data_without_name['Number of Iterations'] = num_iterations
+    data_without_name['Seed'] = default_seed
+    with open(prompt_path, 'w') as f:
+        json.dump(data_without_name, f, indent=4)
+    return prompt_path
+
+def generate_json_files(prompts, prompt_type, story_name, default_seed, num_images=1, num_iterations=1):
     base_dir = os.path.join(story_name, 'Characters' if prompt_type == 'character' else 'Scenes')
     os.makedirs(base_dir, exist_ok=True)
     json_files = []
     for data in prompts:
-        item_name = data.get('Name', 'Unnamed').replace(' ', '_')
-        item_dir = os.path.join(base_dir, item_name)
-        os.makedirs(item_dir, exist_ok=True)
-        prompt_path = os.path.join(item_dir, 'prompt.json')
-        # Remove 'Name' from data to avoid redundancy in JSON
-        data_without_name = {k: v for k, v in data.items() if k != 'Name'}
-        # Add placeholders for 'Number of Images', 'Number of Iterations', and 'Seed'
-        data_without_name['Number of Images'] = 1
-        data_without_name['Number of Iterations'] = 1
-        data_without_name['Seed'] = default_seed
-        with open(prompt_path, 'w') as f:
-            json.dump(data_without_name, f, indent=4)
-        json_files.append(prompt_path)
+        json_files.append(write_prompt_json(data, base_dir, default_seed, num_images, num_iterations))
     return json_files
 
-def generate_images(settings, prompt_type, story_name):
-    api_url = settings.get('api_endpoint', 'http://localhost:7860') + '/sdapi/v1/txt2img'
-    headers = {'Content-Type': 'application/json'}
+def build_payload(settings, data, seed, num_images):
+    positive_prompt = data.get('Positive prompt', '')
+    negative_prompt = data.get('Negative prompt', '')
+
+    # Include LoRA settings at the end of the positive prompt
+    if settings['lora']:
+        lora_name = os.path.splitext(settings['lora'])[0]  # Remove file extension
+        positive_prompt += f" <lora:{lora_name}:{settings['lora_weight']}>"
+
+    return {
+        "prompt": positive_prompt,
+        "negative_prompt": negative_prompt,
+        "steps": settings["sampling_steps"],
+        "cfg_scale": settings["cfg_scale"],
+        "width": settings["width"],
+        "height": settings["height"],
+        "sampler_name": settings["sampling_method"],
+        "seed": seed,
+        "batch_size": 1,
+        "n_iter": num_images,
+        "scheduler": settings["scheduler"],
+        "override_settings": {
+            "sd_model_checkpoint": settings["model"]
+        },
+        # Keep the checkpoint loaded after the request instead of swapping back
+        "override_settings_restore_afterwards": False
+    }
+
+def print_item_settings(settings, prompt_type, item_name, seed, num_images, num_iterations):
+    print(f"\nGenerating images for {prompt_type}: {item_name}")
+    print(f"Settings:")
+    print(f"  Model: {settings['model']}")
+    print(f"  LoRA: {settings['lora']}")
+    print(f"  LoRA Weight: {settings['lora_weight']}")
+    print(f"  Sampler: {settings['sampling_method']}")
+    print(f"  Scheduler: {settings['scheduler']}")
+    print(f"  Sampling Steps: {settings['sampling_steps']}")
+    print(f"  Width: {settings['width']}")
+    print(f"  Height: {settings['height']}")
+    print(f"  CFG Scale: {settings['cfg_scale']}")
+    print(f"  Seed: {seed}")
+    print(f"  Number of Images: {num_images}")
+    print(f"  Number of Iterations: {num_iterations}")
+
+def image_path(job, index):
+    return os.path.join(job['iteration_dir'], f"{job['item_name']}_{job['iteration']}_{index}.png")
 
+def split_job(job, indices):
+    # Narrow a job down to some of its image numbers. With a fixed seed the
+    # web UI gives image k of an n_iter run the seed base + k - 1, so every
+    # contiguous run of indices gets its own request starting at the right seed.
+    base_seed = job['base_seed']
+    if base_seed == -1:
+        runs = [indices]
+    else:
+        runs = []
+        for index in indices:
+            if runs and index == runs[-1][-1] + 1:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+    for run in runs:
+        payload = dict(job['payload'])
+        payload['n_iter'] = len(run)
+        if base_seed != -1:
+            payload['seed'] = base_seed + run[0] - 1
+        yield dict(job, payload=payload, indices=run)
+
+def item_overrides(settings, data):
+    # A prompt.json may pick its own checkpoint or LoRA for this item
+    item_settings = dict(settings)
+    if data.get('Model'):
+        item_settings['model'] = data['Model']
+    if 'LoRA' in data:
+        item_settings['lora'] = data['LoRA'] or ''
+    if 'LoRA Weight' in data:
+        item_settings['lora_weight'] = float(data['LoRA Weight'])
+    return item_settings
+
+def iter_jobs(settings, prompt_type, story_name):
+    # Yields one job per (item, iteration) found under the story directory
     base_dir = os.path.join(story_name, 'Characters' if prompt_type == 'character' else 'Scenes')
     items = os.listdir(base_dir)
     for item_name in items:
-        item_dir = os.path.join(base_dir, item_name)
-        prompt_path = os.path.join(item_dir, 'prompt.json')
-        with open(prompt_path, 'r') as f:
-            data = json.load(f)
-
-        num_images = int(data.get('Number of Images', 1))
-        num_iterations = int(data.get('Number of Iterations', 1))
-        seed = int(data.get('Seed', settings['seed']))
-
-        print(f"\nGenerating images for {prompt_type}: {item_name}")
-        print(f"Settings:")
-        print(f"  Model: {settings['model']}")
-        print(f"  LoRA: {settings['lora']}")
-        print(f"  LoRA Weight: {settings['lora_weight']}")
-        print(f"  Sampler: {settings['sampling_method']}")
-        print(f"  Scheduler: {settings['scheduler']}")
-        print(f"  Sampling Steps: {settings['sampling_steps']}")
-        print(f"  Width: {settings['width']}")
-        print(f"  Height: {settings['height']}")
-        print(f"  CFG Scale: {settings['cfg_scale']}")
-        print(f"  Seed: {seed}")
-        print(f"  Number of Images: {num_images}")
-        print(f"  Number of Iterations: {num_iterations}")
-
-        for iteration in range(1, num_iterations + 1):
-            iteration_dir = os.path.join(item_dir, f'Iteration_{iteration}')
-            os.makedirs(iteration_dir, exist_ok=True)
-
-            positive_prompt = data.get('Positive prompt', '')
-            negative_prompt = data.get('Negative prompt', '')
-
-            # Include LoRA settings at the end of the positive prompt
-            if settings['lora']:
-                lora_name = os.path.splitext(settings['lora'])[0]  # Remove file extension
-                positive_prompt += f" <lora:{lora_name}:{settings['lora_weight']}>"
-
-            # Check for pause
-            while paused:
-                time.sleep(0.5)
-
-            payload = {
-                "prompt": positive_prompt,
-                "negative_prompt": negative_prompt,
-                "steps": settings["sampling_steps"],
-                "cfg_scale": settings["cfg_scale"],
-                "width": settings["width"],
-                "height": settings["height"],
-                "sampler_name": settings["sampling_method"],
-                "seed": seed,
-                "batch_size": 1,
-                "n_iter": num_images,
-                "scheduler": settings["scheduler"],
-                "override_settings": {
-                    "sd_model_checkpoint": settings["model"]
-                }
-            }
-
-            # Log the payload
-            logging.info(f"Generating images for {item_name}, Iteration {iteration}")
-            logging.info(f"Payload: {json.dumps(payload, indent=4)}")
-
-            print(f"\nIteration {iteration}: Generating {num_images} images...")
-            try:
-                response = requests.post(api_url, headers=headers, json=payload)
-                response.raise_for_status()
-                r = response.json()
-
-                # Log the response
-                logging.info(f"Response: {response.text}")
-
-                for idx, img_data in enumerate(tqdm(r['images'], desc=f"Saving images for {item_name}")):
-                    img_bytes = base64.b64decode(img_data)
-                    img_path = os.path.join(iteration_dir, f'{item_name}_{iteration}_{idx + 1}.png')
-                    with open(img_path, 'wb') as img_file:
-                        img_file.write(img_bytes)
-                print(f"Iteration {iteration}: Completed generating images for {item_name}")
-            except requests.exceptions.RequestException as e:
-                print(f"Error generating images for {item_name} in iteration {iteration}: {e}")
-                logging.error(f"Error generating images for {item_name} in iteration {iteration}: {e}")
-                continue
-
-            # Check for pause
-            while paused:
-                time.sleep(0.5)
+        yield from item_jobs(settings, prompt_type, os.path.join(base_dir, item_name))
 
-def main():
-    # Configure logging
-    logging.basicConfig(filename='generation_log.txt', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+def stream_jobs(settings, prompt_type, story_name, folder_path='', num_images=1, num_iterations=1):
+    # One pass from prompt file to jobs: each block gets its prompt.json and
+    # its jobs before the next block is read, so generation starts right away
+    base_dir = os.path.join(story_name, 'Characters' if prompt_type == 'character' else 'Scenes')
+    os.makedirs(base_dir, exist_ok=True)
+    for data in create_prompts(prompt_type, folder_path):
+        prompt_path = write_prompt_json(data, base_dir, settings['seed'], num_images, num_iterations)
+        for job in item_jobs(settings, prompt_type, os.path.dirname(prompt_path)):
+            record_planned([job])
+            yield job
 
-    # Load Stable Diffusion settings
-    sd_settings = load_sd_settings()
+def item_jobs(settings, prompt_type, item_dir):
+    item_name = os.path.basename(item_dir)
+    prompt_path = os.path.join(item_dir, 'prompt.json')
+    with open(prompt_path, 'r') as f:
+        data = json.load(f)
 
-    # Command-line arguments for main.py
-    parser = argparse.ArgumentParser(description='Generate images for characters and scenes.')
-    args = parser.parse_args()
+    num_images = int(data.get('Number of Images', 1))
+    num_iterations = int(data.get('Number of Iterations', 1))
+    seed = int(data.get('Seed', settings['seed']))
+    item_settings = item_overrides(settings, data)
 
-    # Check if Stable Diffusion web UI is running
-    api_endpoint = sd_settings.get("api_endpoint", "http://localhost:7860")
-    if not check_stable_diffusion_running(api_endpoint):
-        print("Stable Diffusion web UI is not running.")
-        print("Please start the web UI manually before running this script.")
-        sys.exit(1)
+    print_item_settings(item_settings, prompt_type, item_name, seed, num_images, num_iterations)
 
-    # Prompt user for story name
-    story_name = input("Enter the name of your story: ").strip()
+    for iteration in range(1, num_iterations + 1):
+        iteration_dir = os.path.join(item_dir, f'Iteration_{iteration}')
+        os.makedirs(iteration_dir, exist_ok=True)
+        yield {
+            "prompt_type": prompt_type,
+            "item_name": item_name,
+            "iteration": iteration,
+            "iteration_dir": iteration_dir,
+            "base_seed": seed,
+            "indices": list(range(1, num_images + 1)),
+            "lora": item_settings['lora'],
+            "priority": item_priority(data),
+            "depends_on": item_dependencies(data),
+            "payload": build_payload(item_settings, data, seed, num_images),
+        }
 
-    # Get settings from user or settings file
-    settings_file = os.path.join(story_name, 'settings.json')
-    if os.path.exists(settings_file):
-        # Load settings from file
-        with open(settings_file, 'r') as f:
-            settings = json.load(f)
-        print("Loaded settings from previous session.")
+def draft_job(job, scale, steps):
+    # The same images at a fraction of the resolution and steps, in Iteration_N/drafts
+    iteration_dir = os.path.join(job['iteration_dir'], DRAFT_DIR)
+    os.makedirs(iteration_dir, exist_ok=True)
+    return dict(job, phase='draft', iteration_dir=iteration_dir, payload=draft_payload(job['payload'], scale, steps))
+
+def plan_jobs(settings, prompt_type, story_name, mode='all', draft=None):
+    # mode 'all' regenerates everything, 'resume' only images missing on disk,
+    # 'replay' only images the journal recorded as failed.
+    # draft: (scale, steps) to plan the draft images instead of the final ones
+    jobs = list(iter_jobs(settings, prompt_type, story_name))
+    if draft is not None:
+        jobs = [draft_job(job, *draft) for job in jobs]
+    if mode == 'all':
+        planned = jobs
+    else:
+        existing = existing_files(image_path(job, index) for job in jobs for index in job['indices'])
+        planned = []
+        for job in jobs:
+            pending = [i for i in job['indices'] if image_path(job, i) not in existing]
+            if mode == 'replay' and journal is not None:
+                pending = [i for i in pending if journal.state_of(prompt_type, job['item_name'], job['iteration'], i) == FAILED]
+            if pending == job['indices']:
+                planned.append(job)
+            elif pending:
+                planned.extend(split_job(job, pending))
+        skipped = sum(len(job['indices']) for job in jobs) - sum(len(job['indices']) for job in planned)
+        print(f"\n{mode.capitalize()}: {skipped} {prompt_type} images skipped, {sum(len(job['indices']) for job in planned)} to generate.")
+
+    record_planned(planned)
+    return planned
+
+def refine_jobs(args, settings, story_name, mode='all'):
+    # One job per selected draft: full settings, the draft's seed, hires-fix
+    drafts = draft_manifest.drafts()
+    if not drafts:
+        print(f"\nNo drafts found in {story_name}. Run with --draft first.")
+        return []
+    if args.select:
+        selected, unknown = read_selection(args.select, story_name, drafts)
+        for line in unknown:
+            print(f"Not a draft of {story_name}: {line}")
     else:
-        # Get available models and LoRAs
-        sd_folder = sd_settings['sd_folder']
-        models_path = os.path.join(sd_folder, 'models/Stable-diffusion')
-        loras_path = os.path.join(sd_folder, 'models/Lora')
-
-        models = get_available_models(models_path)
-        loras = get_available_loras(loras_path)
-
-        # Select model
-        print("\nAvailable Models:")
-        for idx, model in enumerate(models):
-            print(f"{idx + 1}: {model}")
-        model_choice = int(input("Select a model by number: ")) - 1
-        model = models[model_choice]
-
-        # Select LoRA
-        print("\nAvailable LoRAs:")
-        for idx, lora in enumerate(loras):
-            print(f"{idx + 1}: {lora}")
-        lora_choice_input = input("Select a LoRA by number (press Enter to skip): ")
-        if lora_choice_input.strip():
-            lora_choice = int(lora_choice_input) - 1
-            lora = loras[lora_choice]
-            lora_weight = input("Enter the LoRA weight (default 1.0): ").strip() or "1.0"
-            lora_weight = float(lora_weight)
+        selected = select_best(story_name, drafts, args.keep, args.score)
+        print(f"\nSelected the {args.keep} best drafts of every item by {args.score}; "
+              f"the list is in {write_selection(story_name, selected)}.")
+
+    full_jobs = {}
+    for prompt_type in ('character', 'scene'):
+        for job in iter_jobs(settings, prompt_type, story_name):
+            full_jobs[(prompt_type, job['item_name'], job['iteration'])] = job
+    jobs = []
+    for draft in selected:
+        job = full_jobs.get((draft['prompt_type'], draft['item_name'], draft['iteration']))
+        if job is None:
+            print(f"{draft['path']}: its item no longer exists, skipped.")
+            continue
+        index = draft['index']
+        # base_seed is chosen so that image `index` gets the draft's seed
+        refined = dict(job, phase='refine', indices=[index], base_seed=draft['seed'] - index + 1,
+                       payload=refine_payload(job['payload'], draft, args.hr_upscaler, args.hr_denoise))
+        if mode != 'all' and os.path.exists(image_path(refined, index)):
+            continue
+        jobs.append(refined)
+    print(f"\nRefine: {len(jobs)} of {len(drafts)} drafts to render at full settings.")
+    print_gpu_work(drafts, jobs)
+    record_planned(jobs)
+    return jobs
+
+def record_drafts(job, indices, seeds):
+    if draft_manifest is not None and job.get('phase') == 'draft':
+        for index, seed in zip(indices, seeds):
+            draft_manifest.record(job, index, seed, image_path(job, index))
+
+def record_planned(jobs):
+    if journal is None:
+        return
+    records = []
+    for job in jobs:
+        for index in job['indices']:
+            # Failures stay recorded as such until the image is actually written
+            if journal.state_of(job['prompt_type'], job['item_name'], job['iteration'], index) != FAILED:
+                records.append({'key': job_key(job['prompt_type'], job['item_name'], job['iteration'], index), 'status': PLANNED})
+    journal.record_many(records)
+
+def open_image_file(job, index):
+    # Files appear under their final name only once completely written
+    image_file = AtomicFile(image_path(job, index))
+    if post_processor is not None:
+        # Keep the decoded bytes so the post-processor need not read them back
+        image_file = CapturingFile(image_file)
+    return image_file
+
+def save_images(job, response, on_chunk=None, api_endpoint=None):
+    # Decode the streamed response image by image straight into the iteration directory
+    item_name = job['item_name']
+    indices = job['indices']
+    # The story-wide progress monitor replaces the per-request bar when active
+    from tqdm import tqdm  # For progress bar
+    progress = tqdm(total=len(indices), desc=f"Saving images for {item_name}", disable=progress_monitor is not None)
+
+    def index_for(idx):
+        # Extra images (e.g. a grid) are numbered after the requested ones
+        return indices[idx] if idx < len(indices) else indices[-1] + idx - len(indices) + 1
+
+    files = {}
+
+    def open_image(idx):
+        files[idx] = open_image_file(job, index_for(idx))
+        return files[idx]
+
+    def image_done(count):
+        progress.update(1)
+        image_file = files.pop(count - 1)
+        record_image_done(job, index_for(count - 1), api_endpoint, getattr(image_file, 'data', None))
+
+    try:
+        return stream_txt2img_response(response, open_image, on_image_done=image_done, on_chunk=on_chunk)
+    finally:
+        progress.close()
+
+def image_cache_key(api_endpoint, job, index):
+    model_hash = output_cache.model_hash(api_endpoint, job_checkpoint(job))
+    return output_cache.key(image_payload(job, index), model_hash)
+
+def cached_jobs(api_endpoint, job):
+    # Serves the images the output cache already holds and yields what is
+    # left to generate, split into contiguous runs of image numbers
+    if output_cache is None or not is_deterministic(job):
+        yield job
+        return
+    missing = []
+    hits = []
+    for index in job['indices']:
+        if output_cache.fetch(image_cache_key(api_endpoint, job, index), image_path(job, index)):
+            hits.append(index)
+            record_image_done(job, index)
+            record_drafts(job, [index], [job['base_seed'] + index - 1])
         else:
-            lora = ""
-            lora_weight = 1.0
-
-        # Get available schedulers
-        schedulers = get_available_schedulers(api_endpoint)
-
-        # Select scheduler
-        print("\nAvailable Schedulers:")
-        for idx, scheduler in enumerate(schedulers):
-            print(f"{idx + 1}: {scheduler}")
-        scheduler_choice = int(input("Select a scheduler by number: ")) - 1
-        scheduler = schedulers[scheduler_choice]
-
-        # Get available samplers
-        samplers = get_available_samplers(api_endpoint)
-
-        # Select sampler
-        print("\nAvailable Samplers:")
-        for idx, sampler in enumerate(samplers):
-            print(f"{idx + 1}: {sampler}")
-        sampler_choice = int(input("Select a sampler by number: ")) - 1
-        sampling_method = samplers[sampler_choice]
-
-        # Ask for other settings
-        sampling_steps = int(input("Enter the number of sampling steps (default 50): ").strip() or 50)
-        width = int(input("Enter the image width (default 512): ").strip() or 512)
-        height = int(input("Enter the image height (default 768): ").strip() or 768)
-        cfg_scale = float(input("Enter the CFG scale (default 7.5): ").strip() or 7.5)
-        seed_input = input("Enter the seed (enter '-1' for random, default -1): ").strip() or "-1"
-        seed = int(seed_input)
-
-        # Save settings
-        settings = {
-            "model": model,
-            "lora": lora,
-            "lora_weight": lora_weight,
-            "sampling_method": sampling_method,
-            "scheduler": scheduler,
-            "sampling_steps": sampling_steps,
-            "width": width,
-            "height": height,
-            "cfg_scale": cfg_scale,
-            "seed": seed,
-            "api_endpoint": api_endpoint
-        }
+            missing.append(index)
+    if hits:
+        print(f"Iteration {job['iteration']}: {len(hits)} images for {job['item_name']} taken from the output cache")
+        if progress_monitor is not None:
+            progress_monitor.job_finished(api_endpoint, dict(job, indices=hits), len(hits))
+    if missing == job['indices']:
+        yield job
+    elif missing:
+        # What is left of a partly cached batch goes one image per batch
+        yield from split_job(dict(job, payload=dict(job['payload'], batch_size=1)), missing)
 
-        os.makedirs(story_name, exist_ok=True)
-        settings_file = os.path.join(story_name, 'settings.json')
-        with open(settings_file, 'w') as f:
-            json.dump(settings, f, indent=4)
-        print("\nSettings saved for this story.")
+def batch_jobs(api_endpoint, job):
+    if not control.should_run(job):
+        # Skipped or cancelled; the images stay planned for --resume
+        if scheduler is not None:
+            scheduler.finished(job, job['indices'])
+        return
+    # The cache is looked up in the shape the job is sent in, which is part of its key
+    for limited in batch_job(api_endpoint, job):
+        yield from cached_jobs(api_endpoint, limited)
 
-    # Process prompts and generate JSON files
-    print("\nProcessing character prompts...")
-    character_prompts = create_prompts('character')
-    character_json_files = generate_json_files(character_prompts, 'character', story_name, settings['seed'])
+def batch_job(api_endpoint, job):
+    # Use the auto-tuned batch_size of this backend, if one is known, within
+    # the limits learned from earlier out-of-memory errors and those of the
+    # retry the job is (retries only teach the cache once they succeed)
+    payload = job['payload']
+    batch_size = None
+    limits = {}
+    if batch_cache is not None:
+        key = (payload['override_settings']['sd_model_checkpoint'], *(job.get('requested_size') or (payload['width'], payload['height'])))
+        batch_size = batch_cache.get(api_endpoint, *key)
+        limits = batch_cache.limits(api_endpoint, *key)
+    limits = tighten_limits(limits, job.get('retry_limit') or {})
+    width, height = limits.get('resolution') or (0, 0)
+    requested_width, requested_height = output_size(payload)
+    if oom_downscale and 0 < width * height < requested_width * requested_height:
+        print(f"Iteration {job['iteration']}: rendering {job['item_name']} at {width}x{height} instead of "
+              f"{requested_width}x{requested_height}, the largest size that fit on {api_endpoint}")
+        resized = downscale(job, width, height)
+        if progress_monitor is not None:
+            progress_monitor.job_resized(job, resized)
+        job = resized
+    batch_size = min(batch_size or 1, limits.get('max_batch_size') or batch_size or 1)
+    if len(job['indices']) <= 1 or (batch_size <= 1 and not limits.get('max_n_iter')):
+        yield job
+        return
+    yield from rebatch(job, batch_size, limits.get('max_n_iter'))
 
-    print("\nProcessing scene prompts...")
-    scene_prompts = create_prompts('scene')
-    scene_json_files = generate_json_files(scene_prompts, 'scene', story_name, settings['seed'])
+def run_job(api_endpoint, job):
+    ok = True
+    try:
+        for sub_job in batch_jobs(api_endpoint, job):
+            ok = run_request(api_endpoint, sub_job) and ok
+    finally:
+        if scheduler is not None:
+            scheduler.finished(job, job['indices'])
+    if job_queue is not None and 'queue_id' in job:
+        if control.cancelled.is_set():
+            job_queue.release(job)  # Another worker, or the next run, finishes it
+        elif not job_queue.finish(job, ok, None if ok else 'see the journal and generation_log.txt'):
+            print(f"Queue: the lease on {job['item_name']}, iteration {job['iteration']} was lost to another worker.")
+        print(f"Queue: {format_counts(job_queue.counts())}")
+    return ok
+
+def job_event(api_endpoint, job):
+    return {
+        'payload_hash': payload_hash(job['payload']),
+        'item': job['item_name'],
+        'iteration': job['iteration'],
+        'endpoint': api_endpoint,
+    }
+
+def record_success(api_endpoint, job, r, latency, raw_body=None):
+    if job.get('phase') == 'draft':
+        # The exact seeds, also when the web UI picked them (seed -1)
+        try:
+            seeds = json.loads(r.get('info') or '{}').get('all_seeds') or []
+        except ValueError:
+            seeds = []
+        if len(seeds) < min(r['images'], len(job['indices'])) and job['base_seed'] != -1:
+            seeds = [job['base_seed'] + index - 1 for index in job['indices']]
+        record_drafts(job, job['indices'][:r['images']], seeds)
+    if batch_cache is not None and job.get('retry_limit') and r['images']:
+        # The rung that got this retry through is the limit to start below next time
+        width, height = job.get('requested_size') or (job['payload']['width'], job['payload']['height'])
+        batch_cache.learn(api_endpoint, job_checkpoint(job), width, height, job['retry_limit'])
+    if progress_monitor is not None:
+        progress_monitor.job_finished(api_endpoint, job, r['images'])
+    if concurrency is not None and not control.is_interrupted(job):
+        # The latency of an interrupted request says nothing about the backend
+        concurrency.record(api_endpoint, job, latency)
+    if event_log is not None:
+        event = job_event(api_endpoint, job)
+        event.update(latency=round(latency, 3), bytes=r['bytes_received'],
+                     images=r['images'], seed=seed_from_info(r.get('info')))
+        if raw_body is not None:
+            event.update(payload=job['payload'], response=raw_body.decode('utf-8', 'replace'))
+        event_log.record('txt2img', **event)
 
-    print("\nJSON files for characters and scenes have been created.")
-    print("You can review and edit them before proceeding.")
-    print("Set 'Number of Images', 'Number of Iterations', and 'Seed' in each JSON file as desired.")
+def record_failure(api_endpoint, job, error, latency):
+    item_name = job['item_name']
+    iteration = job['iteration']
+    kind = classify_error(error)
+    logging.error(f"Error generating images for {item_name} in iteration {iteration} ({kind}): {error}")
+    if kind == ERROR_MODEL_LOAD and checkpoint_tracker is not None:
+        checkpoint_tracker.forget(api_endpoint)
+    if progress_monitor is not None:
+        # The images a short response left out were counted with the response
+        progress_monitor.job_finished(api_endpoint, job, 0, failed=True, steps=not isinstance(error, ShortResponseError))
+    if concurrency is not None:
+        concurrency.record(api_endpoint, job, latency, error)
+    control.job_finished(job)
+    if scheduler is not None:
+        scheduler.finished(job, job['indices'])
+    if journal is not None:
+        unfinished = [i for i in job['indices'] if journal.state_of(job['prompt_type'], item_name, iteration, i) != DONE]
+        journal.record(job['prompt_type'], item_name, iteration, unfinished, FAILED, error=str(error))
+    if event_log is not None:
+        event = job_event(api_endpoint, job)
+        event.update(latency=round(latency, 3), error=str(error), error_kind=kind)
+        if event_log.debug_responses:
+            event.update(payload=job['payload'])
+        event_log.record('txt2img_error', **event)
+
+def degraded_jobs(api_endpoint, job, error, latency):
+    # Smaller requests to retry a failed one with (see degradation.py), or
+    # [] when it stays failed. The limit the retry implies is remembered by
+    # record_success once a retry comes back.
+    if control.job_finished(job):
+        # Interrupted before it returned any image
+        if progress_monitor is not None:
+            progress_monitor.job_finished(api_endpoint, job, 0)
+        return remaining_jobs(api_endpoint, job, [])
+    kind = classify_error(error)
+    rung, jobs, limit = degrade(job, kind, oom_downscale)
+    if rung is None:
+        return []
+    print(f"Iteration {job['iteration']}: {job['item_name']} failed on {api_endpoint} ({kind}), "
+          f"retrying with {describe_rung(rung, jobs)}")
+    logging.warning(f"Retrying {job['item_name']} in iteration {job['iteration']} with smaller {rung} after {kind}: {error}")
+    if progress_monitor is not None:
+        progress_monitor.job_finished(api_endpoint, job, 0)
+        progress_monitor.jobs_requeued(jobs)
+    if concurrency is not None:
+        concurrency.record(api_endpoint, job, latency, error)
+    if event_log is not None:
+        event = job_event(api_endpoint, job)
+        event.update(latency=round(latency, 3), error=str(error), error_kind=kind, rung=rung, limit=limit, requests=len(jobs))
+        event_log.record('txt2img_retry', **event)
+    return jobs
 
-    input("\nPress Enter to start image generation...")
+def record_image_done(job, index, api_endpoint=None, data=None):
+    # data: the image bytes when they are still in memory
+    if journal is not None:
+        journal.record(job['prompt_type'], job['item_name'], job['iteration'], [index], DONE)
+    if scheduler is not None:
+        scheduler.finished(job, [index])
+    if output_cache is not None and api_endpoint is not None and is_deterministic(job) and index in job['indices']:
+        output_cache.store(image_cache_key(api_endpoint, job, index), image_path(job, index))
+    if post_processor is not None and index in job['indices']:
+        # Blocks only while the post-processing backlog is full
+        post_processor.submit(image_path(job, index), data)
+
+def before_request(api_endpoint, job):
+    if checkpoint_tracker is not None:
+        checkpoint_tracker.ensure_loaded(api_endpoint, job_checkpoint(job))
+    if progress_monitor is not None:
+        progress_monitor.job_started(api_endpoint, job)
+    control.job_started(api_endpoint, job)
+
+def remaining_jobs(api_endpoint, job, written):
+    # Requests for the images of a request that did not return all of them
+    # because it was interrupted. They are sent again, after resume when
+    # paused; after skip-item or cancel they stay planned for --resume.
+    missing = [index for index in job['indices'] if index not in written]
+    if not missing:
+        return []
+    if not control.should_run(job):
+        print(f"Iteration {job['iteration']}: {len(missing)} images of {job['item_name']} were not generated")
+        if scheduler is not None:
+            scheduler.finished(job, missing)
+        return []
+    print(f"Iteration {job['iteration']}: {len(missing)} images of {job['item_name']} were interrupted and are sent again")
+    jobs = list(split_job(dict(job, payload=dict(job['payload'], batch_size=1)), missing))
+    if progress_monitor is not None:
+        progress_monitor.jobs_requeued(jobs)
+    return jobs
+
+def run_request(api_endpoint, job):
+    item_name = job['item_name']
+    iteration = job['iteration']
+    payload = job['payload']
+    raw_body = bytearray() if event_log is not None and event_log.debug_responses else None
+    if not control.wait():
+        return True  # Cancelled; the images stay planned for --resume
+
+    logging.info(f"Generating images for {item_name}, Iteration {iteration} on {api_endpoint}")
+
+    print(f"\nIteration {iteration}: Generating {len(job['indices'])} images for {item_name} (batch size {payload['batch_size']})...")
+    before_request(api_endpoint, job)
+
+    shared_dir = shared_output.output_dir(api_endpoint) if shared_output is not None else None
+    if shared_dir is not None:
+        payload = shared_output.request_payload(payload)
+        shared_output.acquire(api_endpoint)  # Until its files are collected
+
+    start = time.perf_counter()
+    started_at = time.time()
+    try:
+        try:
+            response = get_client(api_endpoint).post('/sdapi/v1/txt2img', json=payload, stream=True)
+            response.raise_for_status()
+            r = save_images(job, response, on_chunk=raw_body.extend if raw_body is not None else None, api_endpoint=api_endpoint)
+            interrupted = control.is_interrupted(job)
+            written = job['indices'][:r['images']]
+            if shared_dir is not None:
+                missing = collect_shared_images(api_endpoint, job, r, shared_dir, started_at)
+                written = [index for index in job['indices'] if index not in missing]
+        finally:
+            if shared_dir is not None:
+                shared_output.release(api_endpoint)
+        if shared_dir is not None and missing and not interrupted:
+            # Not really shared after all: fetch the rest the usual way
+            shared_output.disable(api_endpoint, f"{len(missing)} images not found in {shared_dir}")
+            record_success(api_endpoint, dict(job, indices=written), r, time.perf_counter() - start, raw_body)
+            control.job_finished(job)
+            return all([run_request(api_endpoint, sub_job) for sub_job in split_job(job, missing)])
+        record_success(api_endpoint, job, r, time.perf_counter() - start, raw_body)
+        control.job_finished(job)
+        if interrupted:
+            # Waits for resume in run_request
+            rest = remaining_jobs(api_endpoint, job, written)
+            return all([run_request(api_endpoint, limited) for sub_job in rest for limited in batch_jobs(api_endpoint, sub_job)])
+        print(f"Iteration {iteration}: Completed generating images for {item_name}")
+        return True
+    except (requests.exceptions.RequestException, StreamDecodeError) as e:
+        retry_jobs = degraded_jobs(api_endpoint, job, e, time.perf_counter() - start)
+        if retry_jobs:
+            # Each piece also gets the limits its predecessors learned
+            return all([run_request(api_endpoint, limited) for sub_job in retry_jobs for limited in batch_job(api_endpoint, sub_job)])
+        print(f"Error generating images for {item_name} in iteration {iteration}: {e}")
+        record_failure(api_endpoint, job, e, time.perf_counter() - start)
+        return False
+
+def collect_shared_images(api_endpoint, job, r, shared_dir, since):
+    # Moves the images the web UI saved itself into the iteration directory;
+    # returns the image numbers that could not be found
+    try:
+        seeds = json.loads(r.get('info') or '{}').get('all_seeds') or []
+    except ValueError:
+        seeds = []
+    if len(seeds) < len(job['indices']):
+        if job['base_seed'] == -1:
+            return list(job['indices'])
+        seeds = [job['base_seed'] + index - 1 for index in job['indices']]
+    dests = [image_path(job, index) for index in job['indices']]
+    moved = shared_output.collect(shared_dir, seeds[:len(dests)], dests, since)
+    for n in moved:
+        record_image_done(job, job['indices'][n], api_endpoint)
+    r['images'] = len(moved)
+    return [index for n, index in enumerate(job['indices']) if n not in moved]
+
+def run_jobs(jobs, api_endpoint, balancer=None):
+    for job in jobs:
+        # Blocks while paused
+        if not control.wait():
+            break
+
+        if balancer is not None:
+            # Hand the job to the least-loaded backend; the balancer writes
+            # the images from its worker threads.
+            backend_url = balancer.submit(job)
+            logging.info(f"Dispatched {job['item_name']}, Iteration {job['iteration']} to {backend_url}")
+        else:
+            run_job(api_endpoint, job)
+
+    if balancer is not None:
+        balancer.wait()
+
+def run_jobs_async(jobs, endpoints, in_flight):
+    # Pipelined alternative to run_jobs: several requests in flight per backend
+    import asyncio
+    summary = asyncio.run(run_engine(
+        jobs, endpoints, image_path, in_flight=in_flight,
+        control=control,
+        controller=concurrency,
+        expand_job=batch_jobs,
+        before_request=before_request,
+        open_image=open_image_file,
+        on_image_written=lambda endpoint, job, index, data: record_image_done(job, index, endpoint, data),
+        on_job_done=lambda endpoint, job, r, latency: record_success(endpoint, job, r, latency),
+        on_job_failed=record_failure,
+        retry_job=degraded_jobs,
+        remainder_jobs=lambda endpoint, job, written: remaining_jobs(endpoint, job, written) if control.job_finished(job) else None,
+    ))
+    print(f"\nEngine: {summary['images']} images in {summary['seconds']:.1f}s "
+          f"({summary['images_per_second']:.2f} images/s), {summary['jobs_failed']} failed requests.")
+    return summary
+
+def prompt_story_settings(sd_settings, api_endpoint):
+    # Get available models and LoRAs
+    models_path, loras_path = model_paths(sd_settings)
+    catalog = get_model_catalog()
+
+    models = get_available_models(models_path)
+
+    # Select model
+    print("\nAvailable Models:")
+    for idx, model in enumerate(models):
+        print(f"{idx + 1}: {model}{describe(catalog.info(models_path, model))}")
+    model_choice = int(input("Select a model by number: ")) - 1
+    model = models[model_choice]
+
+    # Only offer LoRAs that can work with the chosen model
+    loras = [lora for lora in get_available_loras(loras_path)
+             if not lora_mismatch(catalog.info(models_path, model), catalog.info(loras_path, lora), model, lora)]
+    hidden = len(get_available_loras(loras_path)) - len(loras)
+
+    # Select LoRA
+    print("\nAvailable LoRAs:")
+    for idx, lora in enumerate(loras):
+        print(f"{idx + 1}: {lora}{describe(catalog.info(loras_path, lora))}")
+    if hidden:
+        print(f"({hidden} LoRAs for other architectures are hidden)")
+    lora_choice_input = input("Select a LoRA by number (press Enter to skip): ")
+    if lora_choice_input.strip():
+        lora_choice = int(lora_choice_input) - 1
+        lora = loras[lora_choice]
+        lora_weight = input("Enter the LoRA weight (default 1.0): ").strip() or "1.0"
+        lora_weight = float(lora_weight)
+    else:
+        lora = ""
+        lora_weight = 1.0
+
+    # Get available schedulers
+    schedulers = get_available_schedulers(api_endpoint)
+
+    # Select scheduler
+    print("\nAvailable Schedulers:")
+    for idx, scheduler in enumerate(schedulers):
+        print(f"{idx + 1}: {scheduler}")
+    scheduler_choice = int(input("Select a scheduler by number: ")) - 1
+    scheduler = schedulers[scheduler_choice]
+
+    # Get available samplers
+    samplers = get_available_samplers(api_endpoint)
+
+    # Select sampler
+    print("\nAvailable Samplers:")
+    for idx, sampler in enumerate(samplers):
+        print(f"{idx + 1}: {sampler}")
+    sampler_choice = int(input("Select a sampler by number: ")) - 1
+    sampling_method = samplers[sampler_choice]
+
+    # Ask for other settings
+    sampling_steps = int(input("Enter the number of sampling steps (default 50): ").strip() or 50)
+    width = int(input("Enter the image width (default 512): ").strip() or 512)
+    height = int(input("Enter the image height (default 768): ").strip() or 768)
+    cfg_scale = float(input("Enter the CFG scale (default 7.5): ").strip() or 7.5)
+    seed_input = input("Enter the seed (enter '-1' for random, default -1): ").strip() or "-1"
+    seed = int(seed_input)
+
+    return {
+        "model": model,
+        "lora": lora,
+        "lora_weight": lora_weight,
+        "sampling_method": sampling_method,
+        "scheduler": scheduler,
+        "sampling_steps": sampling_steps,
+        "width": width,
+        "height": height,
+        "cfg_scale": cfg_scale,
+        "seed": seed,
+        "api_endpoint": api_endpoint
+    }
+
+def load_story_settings(story_name):
+    settings_file = os.path.join(story_name, 'settings.json')
+    if not os.path.exists(settings_file):
+        return None
+    with open(settings_file, 'r') as f:
+        return json.load(f)
+
+def save_story_settings(story_name, settings):
+    os.makedirs(story_name, exist_ok=True)
+    settings_file = os.path.join(story_name, 'settings.json')
+    with open(settings_file, 'w') as f:
+        json.dump(settings, f, indent=4)
+
+def prepare_story(story_name, settings, mode, folder_path='', num_images=1, num_iterations=1):
+    if mode == 'all':
+        # Process prompts and generate JSON files
+        print("\nProcessing character prompts...")
+        character_prompts = create_prompts('character', folder_path)
+        character_json_files = generate_json_files(character_prompts, 'character', story_name, settings['seed'], num_images, num_iterations)
+
+        print("\nProcessing scene prompts...")
+        scene_prompts = create_prompts('scene', folder_path)
+        scene_json_files = generate_json_files(scene_prompts, 'scene', story_name, settings['seed'], num_images, num_iterations)
+
+        print("\nJSON files for characters and scenes have been created.")
+        print("You can review and edit them before proceeding.")
+        print("Set 'Number of Images', 'Number of Iterations', and 'Seed' in each JSON file as desired.")
+        print("Optionally add 'Priority' (higher goes first) and 'DependsOn' (items to finish first).")
+    else:
+        # Keep the existing prompt.json files (and any edits made to them)
+        print("\nUsing the existing JSON files of this story.")
+
+def run_story(args, endpoints, story_name, settings, mode, interactive=True, jobs=None, phase=None):
+    # Generates one prepared story; returns the number of failed images.
+    # `jobs` may be a stream of jobs that are run in the order they arrive.
+    # phase 'draft' renders the drafts, 'refine' the selected drafts.
+    # With --queue the jobs go through the story's job queue; with --join
+    # this process only works on the queue another one filled.
+    global journal, checkpoint_tracker, progress_monitor, draft_manifest, job_queue, scheduler
+    api_endpoint = endpoints[0]['url']
+
+    # Drafts have their own journal, so resuming one phase does not skip the other
+    journal = Journal(os.path.join(story_name, DRAFT_DIR) if phase == 'draft' else story_name)
+    draft_manifest = DraftManifest(story_name) if phase else None
+    if journal.counts():
+        print(f"Journal: {', '.join(f'{count} {state}' for state, count in sorted(journal.counts().items()))}")
+
+    if interactive:
+        input("\nPress Enter to start image generation...")
+
+    if args.auto_tune or args.retune:
+        autotune([e['url'] for e in endpoints], settings, batch_cache, force=args.retune)
 
     # Start keyboard listener
-    print("Press 'Space' at any time to pause/resume the script during image generation.")
-    start_keyboard_listener()
+    if interactive and not args.no_keyboard and start_keyboard_listener():
+        print("Press 'Space' at any time to pause/resume the script during image generation "
+              "(generation in progress is interrupted, finished images are kept).")
 
-    # Generate images
-    print("\nStarting image generation for characters...")
-    generate_images(settings, 'character', story_name)
+    # Spread the work over every running backend when more than one is configured;
+    # adaptive limits need the balancer's slots even for a single backend
+    balancer = None
+    if args.engine == 'serial' and (len(endpoints) > 1 or concurrency is not None):
+        balancer = LoadBalancer(endpoints, run_job, concurrency)
+        print(f"Distributing jobs over {len(endpoints)} backends.")
 
-    print("\nStarting image generation for scenes...")
-    generate_images(settings, 'scene', story_name)
+    checkpoint_tracker = CheckpointTracker([e['url'] for e in endpoints])
+    job_queue = JobQueue(os.path.join(story_name, QUEUE_NAME)) if args.queue or args.join else None
+    if args.join:
+        planned = None
+    elif jobs is None:
+        # Gather every pending job first so they can be grouped by checkpoint and LoRA
+        if phase == 'refine':
+            jobs = refine_jobs(args, settings, story_name, mode)
+        else:
+            draft = (args.draft_scale, args.draft_steps) if phase == 'draft' else None
+            jobs = plan_jobs(settings, 'character', story_name, mode, draft) + plan_jobs(settings, 'scene', story_name, mode, draft)
+        jobs = list(reject_mismatched_loras(jobs))
+        loaded = checkpoint_tracker.loaded[api_endpoint]
+        ordered = plan_by_affinity(jobs, loaded)
+        print_plan_summary(summarize_plan(jobs, ordered, loaded))
+        planned = [job for _, group in ordered for job in group]
+    else:
+        print("\nStreaming jobs straight from the prompt files (no checkpoint grouping).")
+        planned = reject_mismatched_loras(jobs)
+    if isinstance(planned, list):
+        scheduler = JobScheduler(planned)
+        print_schedule(scheduler)
+        if job_queue is not None:
+            # The queue's ids follow the schedule; claims apply priorities and
+            # dependencies across every worker of the story
+            planned = scheduler.drain()
+            scheduler = None
+    if job_queue is not None:
+        if planned is not None:
+            added, requeued, skipped = job_queue.add(planned)
+            print(f"\nQueue: {added} jobs added, {requeued} failed jobs queued again, {skipped} already queued or done.")
+        print(f"Queue: {format_counts(job_queue.counts())}. Worker {job_queue.worker} is claiming jobs; "
+              f"more can join with 'python main.py --join {story_name}'.")
+        planned = job_queue.jobs(control.wait)
+        control.reprioritize = job_queue.reprioritize
+        job_queue.start_heartbeat()
 
-    # Stop keyboard listener after image generation
-    stop_keyboard_listener()
+    # Generate images; groups are not drained one by one, so each backend
+    # moves on to the next checkpoint as soon as it runs out of current work
+    print("\nStarting image generation...")
+    progress_monitor = None
+    if not args.no_progress:
+        progress_monitor = ProgressMonitor([e['url'] for e in endpoints])
+        if isinstance(planned, list):
+            progress_monitor.set_plan(planned)
+        else:
+            planned = announce_jobs(planned, progress_monitor)
+        progress_monitor.start()
+    if scheduler is not None:
+        # Priorities can be changed until a job is handed out
+        planned = scheduler.jobs(control.wait)
+        control.reprioritize = scheduler.reprioritize
+        control.add_listener(scheduler.wake)
+    try:
+        if args.engine == 'async':
+            run_jobs_async(planned, [e['url'] for e in endpoints], args.in_flight)
+        else:
+            run_jobs(planned, api_endpoint, balancer)
+    finally:
+        if scheduler is not None:
+            control.remove_listener(scheduler.wake)
+            control.reprioritize = None
+            scheduler = None
 
+        if progress_monitor is not None:
+            progress_monitor.stop()
+
+        if balancer is not None:
+            balancer.close()
+            for backend in balancer.summary():
+                print(f"{backend['url']}: {backend['completed']} jobs completed, {backend['failed']} failed")
+
+        # Stop keyboard listener after image generation
+        stop_keyboard_listener()
+
+        print_checkpoint_loads(checkpoint_tracker)
+
+        if job_queue is not None:
+            control.reprioritize = None
+            print(f"Queue: {format_counts(job_queue.counts())}")
+            job_queue.close()
+            job_queue = None
+
+        counts = journal.counts()
+        journal.close()
+        if draft_manifest is not None:
+            draft_manifest.close()
+    if phase == 'draft':
+        print("\nDrafts are in the drafts folder of every iteration. Run with --refine to render the best ones "
+              "(or list them in a file for --select).")
+    return counts.get(FAILED, 0)
+
+def announce_jobs(jobs, monitor):
+    # Grows the progress total while a job stream is consumed
+    for job in jobs:
+        monitor.set_plan([job])
+        yield job
+
+def headless_stories(args, endpoints):
+    # Resolves and validates every story of the run spec before any work starts
+    stories = build_stories(args)
+    options = fetch_backend_options(endpoints[0]['url'])
+    errors = []
+    for story in stories:
+        story['dir'] = os.path.join(story['output_dir'], story['name'])
+        if args.replay_failed or args.resume:
+            story['mode'] = 'replay' if args.replay_failed else 'resume'
+        story['settings'] = resolve_settings(story, load_story_settings(story['dir']))
+        story['settings']['api_endpoint'] = endpoints[0]['url']
+        errors += validate_settings(story['settings'], options, f"Story {story['name']}")
+        problem = lora_problem(story['settings'].get('model'), story['settings'].get('lora'))
+        if problem:
+            errors.append(f"Story {story['name']}: {problem}.")
+        if story['mode'] == 'all':
+            for prompts_file in ('characters.txt', 'scenes.txt'):
+                if not os.path.exists(os.path.join(story['prompts_dir'], prompts_file)):
+                    errors.append(f"Story {story['name']}: {os.path.join(story['prompts_dir'], prompts_file)} not found.")
+        elif not os.path.isdir(story['dir']):
+            errors.append(f"Story {story['name']}: nothing to {story['mode']} in {story['dir']}.")
+    if errors:
+        raise SpecError(*errors)
+    return stories
+
+def main():
+    # Command-line arguments for main.py
+    parser = argparse.ArgumentParser(description='Generate images for characters and scenes.')
+    parser.add_argument('--event-log', default=DEFAULT_EVENT_LOG, help='JSONL file receiving one record per txt2img request')
+    parser.add_argument('--event-log-max-mb', type=float, default=20, help='Rotate the event log after this many MiB')
+    parser.add_argument('--debug-responses', action='store_true', help='Also record payloads and raw response bodies in the event log')
+    parser.add_argument('--resume', action='store_true', help='Only generate images that are missing from the story output')
+    parser.add_argument('--replay-failed', action='store_true', help='Only generate images the journal recorded as failed')
+    parser.add_argument('--auto-tune', action='store_true', help='Probe each backend for its fastest safe batch_size before generating')
+    parser.add_argument('--retune', action='store_true', help='Like --auto-tune, but ignore previously cached results')
+    parser.add_argument('--engine', choices=['serial', 'async'], default='serial', help='Request loop to use (async keeps several requests in flight)')
+    parser.add_argument('--in-flight', type=int, default=DEFAULT_IN_FLIGHT, help='Requests kept in flight per backend with --engine async')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adjust the requests in flight per backend to its queue, VRAM use, latency and errors, starting from --in-flight')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_LIMIT, help='Upper limit of the requests in flight per backend with --adaptive')
+    parser.add_argument('--no-downscale', action='store_true',
+                        help='After out-of-memory errors only retry with smaller batches, never at a lower resolution')
+    parser.add_argument('--no-progress', action='store_true', help='Do not poll /sdapi/v1/progress for live progress and ETA')
+    parser.add_argument('--no-keyboard', action='store_true', help='Do not listen for the pause key')
+    parser.add_argument('--control-socket', nargs='?', const=DEFAULT_SOCKET, metavar='PATH',
+                        help=f'Accept pause/resume/skip/cancel commands on a local Unix socket (default path {DEFAULT_SOCKET})')
+    parser.add_argument('--control', nargs='+', metavar='COMMAND',
+                        help=f"Send a command ({', '.join(COMMANDS)}) to the run serving --control-socket, then exit; "
+                             "'priority ITEM N' changes the priority of an item's jobs not started yet")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory of the content-addressed output cache')
+    parser.add_argument('--cache-max-gb', type=float, default=DEFAULT_MAX_GB, help='Evict the least recently used cached images beyond this size')
+    parser.add_argument('--no-cache', action='store_true', help='Always generate, never reuse cached images')
+    phase = parser.add_mutually_exclusive_group()
+    phase.add_argument('--draft', action='store_true', help='Render every image as a quick low-resolution draft into Iteration_N/drafts')
+    phase.add_argument('--refine', action='store_true', help='Render the selected drafts at full settings with hires-fix')
+    parser.add_argument('--draft-steps', type=int, default=DEFAULT_DRAFT_STEPS, help='Sampling steps of the drafts')
+    parser.add_argument('--draft-scale', type=float, default=DEFAULT_DRAFT_SCALE, help='Draft resolution relative to the final one')
+    parser.add_argument('--select', metavar='FILE', help='With --refine: file listing the drafts to refine, one per line')
+    parser.add_argument('--keep', type=int, default=DEFAULT_KEEP, help='With --refine and no --select: best drafts kept per item and iteration')
+    parser.add_argument('--score', choices=SCORERS, default='size', help="How drafts are ranked without --select ('sharpness' needs Pillow)")
+    parser.add_argument('--hr-upscaler', default=DEFAULT_HR_UPSCALER, help='Hires-fix upscaler used by --refine')
+    parser.add_argument('--hr-denoise', type=float, default=DEFAULT_HR_DENOISE, help='Hires-fix denoising strength used by --refine')
+    parser.add_argument('--shared-output', action='store_true',
+                        help="Let the web UI save the images and move them from its output folder instead of sending base64 (serial engine)")
+    parser.add_argument('--postprocess', type=parse_steps, metavar='STEPS',
+                        help="Comma-separated post-processing steps (optimize, webp, avif, thumbnail, contact-sheet) or 'all'; needs Pillow")
+    parser.add_argument('--postprocess-workers', type=int, help='Worker processes for post-processing (default: one per CPU)')
+    parser.add_argument('--postprocess-backlog', type=int, default=DEFAULT_BACKLOG, help='Images that may wait for post-processing before generation waits')
+    parser.add_argument('--queue', action='store_true',
+                        help='Put the jobs into the story\'s SQLite job queue and work on it, so --join workers can help (serial engine)')
+    parser.add_argument('--join', metavar='STORY_DIR', help='Work on the job queue of a story another process is running')
+    parser.add_argument('--queue-status', metavar='STORY_DIR', help='Print the job counts of a story\'s queue, then exit')
+    parser.add_argument('--endpoint', action='append', metavar='URL',
+                        help='Web UI to use instead of the ones in sd_settings.json (repeatable)')
+    parser.add_argument('--stream-prompts', action='store_true', help='Start generating while the prompt files are still being read (skips checkpoint grouping)')
+    parser.add_argument('--validate-prompts', action='store_true', help='Only parse the prompt files and report problems, then exit')
+    parser.add_argument('--import-profile', action='store_true', help='Print how long module imports took when the run ends')
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    mode = 'replay' if args.replay_failed else 'resume' if args.resume else 'all'
+    phase = 'draft' if args.draft else 'refine' if args.refine else None
+    headless = is_headless(args)
+
+    if args.queue_status:
+        return EXIT_OK if print_queue_status(args.queue_status) else EXIT_INVALID_SPEC
+
+    if args.control:
+        path = args.control_socket or DEFAULT_SOCKET
+        try:
+            reply = send_command(path, ' '.join(args.control))
+        except OSError as e:
+            print(f"No run is listening on {path}: {e}")
+            return EXIT_BACKEND_DOWN
+        print(json.dumps(reply, indent=2))
+        return EXIT_INVALID_SPEC if 'error' in reply else EXIT_OK
+
+    if args.validate_prompts:
+        # No backend, settings or log file needed
+        try:
+            folders = [story['prompts_dir'] for story in build_stories(args)] if headless else [args.prompts_dir or '']
+        except SpecError as e:
+            print_spec_errors(e.args)
+            return EXIT_INVALID_SPEC
+        problems = []
+        for folder_path in dict.fromkeys(folders):
+            problems += validate_prompts(folder_path)
+        if problems:
+            print_spec_errors(problems, "Problems in the prompt files:")
+            return EXIT_INVALID_SPEC
+        return EXIT_OK
+
+    # Configure logging
+    logging.basicConfig(filename='generation_log.txt', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
+    # Load Stable Diffusion settings
+    sd_settings = load_sd_settings()
+    configure_clients(sd_settings)
+
+    global event_log, batch_cache, output_cache, model_dirs, post_processor, shared_output, concurrency, oom_downscale
+    model_dirs = model_paths(sd_settings)
+
+    # Check which Stable Diffusion web UIs are running
+    if args.endpoint:
+        # A worker pointed at other GPUs than the settings file lists
+        sd_settings = dict(sd_settings, api_endpoints=args.endpoint)
+    endpoints = [e for e in parse_endpoints(sd_settings) if check_stable_diffusion_running(e['url'])]
+    if not endpoints:
+        print("Stable Diffusion web UI is not running.")
+        print("Please start the web UI manually before running this script.")
+        return EXIT_BACKEND_DOWN
+    api_endpoint = endpoints[0]['url']
+
+    if args.join:
+        # Everything the jobs need is in the queue; the settings only serve --auto-tune
+        settings = load_story_settings(args.join)
+        if settings is None or not os.path.exists(os.path.join(args.join, QUEUE_NAME)):
+            print(f"{args.join} is not a story with a job queue (start it with --queue first).")
+            return EXIT_INVALID_SPEC
+        stories = [{'name': os.path.basename(os.path.normpath(args.join)), 'dir': args.join, 'prompts_dir': '', 'mode': mode,
+                    'num_images': 1, 'num_iterations': 1, 'settings': settings}]
+        headless = True
+    elif headless:
+        try:
+            stories = headless_stories(args, endpoints)
+        except SpecError as e:
+            print_spec_errors(e.args)
+            if model_catalog is not None:
+                model_catalog.save()
+            return EXIT_INVALID_SPEC
+        print(f"\nHeadless run of {len(stories)} stories: {', '.join(story['name'] for story in stories)}")
+    else:
+        # Prompt user for story name
+        story_name = input("Enter the name of your story: ").strip()
+
+        # Get settings from user or settings file
+        settings = load_story_settings(story_name)
+        if settings is not None:
+            print("Loaded settings from previous session.")
+        else:
+            settings = prompt_story_settings(sd_settings, api_endpoint)
+            save_story_settings(story_name, settings)
+            print("\nSettings saved for this story.")
+        stories = [{'name': story_name, 'dir': story_name, 'prompts_dir': '', 'mode': mode,
+                    'num_images': 1, 'num_iterations': 1, 'settings': settings}]
+
+    event_log = EventLog(args.event_log, max_bytes=int(args.event_log_max_mb * 1024 * 1024), debug_responses=args.debug_responses)
+    # Batch sizes found by earlier auto-tune runs are always used
+    batch_cache = BatchTuningCache()
+    oom_downscale = not args.no_downscale
+    if not args.no_cache:
+        output_cache = OutputCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3))
+    if (args.queue or args.join) and args.engine == 'async':
+        print("The job queue is worked by the serial engine.")
+        args.engine = 'serial'
+    if args.shared_output:
+        if args.engine == 'async':
+            print("--shared-output is not supported by --engine async, images are sent as base64.")
+        else:
+            shared_output = SharedOutput(sd_settings.get('sd_folder', ''))
+    if args.postprocess:
+        if pillow_available():
+            post_processor = PostProcessor(args.postprocess, args.postprocess_workers, args.postprocess_backlog)
+        else:
+            print("Pillow is not installed, post-processing is disabled (pip install Pillow).")
+
+    if args.adaptive:
+        # Every limit change is logged with the signals behind it, for tuning
+        concurrency = ConcurrencyController([e['url'] for e in endpoints], initial=args.in_flight, max_limit=args.max_in_flight,
+                                            on_decision=lambda decision: event_log.record('concurrency', **decision))
+        concurrency.start()
+    if args.control_socket:
+        control.serve(args.control_socket)
+
+    failed = 0
+    try:
+        for story in stories:
+            if headless and not args.join:
+                print(f"\n=== Story {story['name']} ({story['mode']}) ===")
+                save_story_settings(story['dir'], story['settings'])
+            jobs = None
+            if args.join:
+                # The jobs come from the queue the story's first process filled
+                print(f"\n=== Joining story {story['name']} ===")
+            elif phase == 'refine':
+                # Refines what the draft run planned, from the existing prompt.json files
+                print("\nUsing the existing JSON files of this story.")
+            elif args.stream_prompts and story['mode'] == 'all' and phase is None:
+                # prompt.json files are written as the prompt files are read
+                jobs = itertools.chain(*(stream_jobs(story['settings'], prompt_type, story['dir'], story['prompts_dir'],
+                                                     story['num_images'], story['num_iterations'])
+                                         for prompt_type in ('character', 'scene')))
+            else:
+                prepare_story(story['dir'], story['settings'], story['mode'], story['prompts_dir'], story['num_images'], story['num_iterations'])
+            story_failed = run_story(args, endpoints, story['dir'], story['settings'], story['mode'], interactive=not headless, jobs=jobs, phase=phase)
+            if story_failed:
+                print(f"\n{story_failed} images of {story['name']} failed. Run 'python main.py --replay-failed' to retry them.")
+            failed += story_failed
+            if control.cancelled.is_set():
+                break
+    except KeyboardInterrupt:
+        print("\nInterrupted.")
+        return EXIT_INTERRUPTED
+    finally:
+        if concurrency is not None:
+            concurrency.stop()
+            print_concurrency_report(concurrency)
+        if output_cache is not None:
+            print_cache_report(output_cache)
+        if model_catalog is not None:
+            model_catalog.save()
+        if shared_output is not None:
+            print_shared_output_report(shared_output)
+        if post_processor is not None:
+            print("\nFinishing post-processing...")
+            post_processor.close()
+            print_postprocess_report(post_processor)
+        print("\nAPI latency:")
+        print_latency_report()
+        event_log.close()
+        control.close()
+
+    if control.cancelled.is_set():
+        print("\nCancelled. Run 'python main.py --resume' to generate the remaining images.")
+        return EXIT_INTERRUPTED
     print("\nImage generation completed.")
+    return EXIT_IMAGES_FAILED if failed else EXIT_OK
 
 if __name__ == '__main__':
-    main()
+    try:
+        sys.exit(main())
+    finally:
+        if import_profiler is not None:
+            import_profiler.report()
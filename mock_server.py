@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# Minimal stand-in for the Automatic1111 web UI API, for running the
+# automator without a GPU. Serves txt2img, options, progress, memory,
+# interrupt, skip and the model and sampler lists. Latency, image size,
+# errors, out-of-memory failures, parallel rendering and saving into an
+# output folder are configurable (see --help), and captured responses can
+# be replayed. Start one instance per port, e.g.:
+#   python mock_server.py --ports 7861 7862 7863 7864 --latency 0.5
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def make_png(width=8, height=8, shade=128, noise=False):
+    # Valid grayscale PNG of the requested size; noise makes it incompressible
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+    if noise:
+        rng = random.Random(shade)
+        raw = b''.join(b'\x00' + rng.randbytes(width) for _ in range(height))
+    else:
+        raw = b''.join(b'\x00' + bytes([shade % 256]) * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw))
+            + chunk(b'IEND', b''))
+
+MOCK_OPTIONS = {
+    'latency': 0.5,  # Seconds spent per generated image
+    'batch_cost': 0.5,  # Cost of each extra image in a batch, relative to the first
+    'max_batch': None,  # Larger batches fail like a CUDA OOM
+    'max_megapixels': None,  # Batches of more megapixels (at the hires-fix size) fail like a CUDA OOM
+    'switch_latency': 0.0,  # Seconds to load another checkpoint
+    'image_kb': 0,  # Approximate size of each returned PNG (0 = tiny)
+    'error_rate': 0.0,  # Fraction of txt2img requests answered with a generic 500
+    'oom_rate': 0.0,  # Fraction of txt2img requests answered with a CUDA OOM 500
+    'replay': None,  # Captured txt2img response bodies to return instead of synthetic ones
+    'seed': None,  # Seed for the error/OOM injection
+    'outdir': None,  # Folder save_images writes to, reported as outdir_txt2img_samples
+    'parallel': 1,  # Requests rendered at the same time (the real web UI renders one)
+    'vram_gb': 24.0,  # Total VRAM reported by /sdapi/v1/memory
+    'vram_base_gb': 6.0,  # VRAM used with nothing rendering (the loaded checkpoint)
+    'vram_per_request': 0.0,  # VRAM held by each rendering request
+}
+
+class MockState:
+    def __init__(self, port, **options):
+        self.port = port
+        for key, default in MOCK_OPTIONS.items():
+            setattr(self, key, options.get(key, default))
+        self.rng = random.Random(self.seed)
+        self.image_png = None  # Fixed PNG returned for every image when image_kb is set
+        if self.image_kb:
+            self.image_png = base64.b64encode(make_png(256, max(1, self.image_kb * 4), noise=True)).decode()
+        self.replay_index = 0
+        self.options = {'sd_model_checkpoint': 'mock.safetensors [0000000000]', 'samples_format': 'png',
+                        'samples_filename_pattern': '', 'save_to_dirs': True, 'outdir_samples': '',
+                        'outdir_txt2img_samples': self.outdir or os.path.join('outputs', 'txt2img-images')}
+        self.saved_images = 0
+        self.model_switches = 0
+        self.current = None  # (start, seconds per image, steps, images) of the job being rendered
+        self.jobs_started = 0
+        self.lock = threading.Lock()
+        self.render_slots = threading.Semaphore(max(1, self.parallel))
+        self.rendering = 0
+        self.oom_events = 0
+        self.interrupts = 0  # Bumped by /sdapi/v1/interrupt; renders started before stop
+        self.skips = 0
+        self.requests = 0
+        self.errors_injected = 0
+
+    def next_replay(self):
+        with self.lock:
+            body = self.replay[self.replay_index % len(self.replay)]
+            self.replay_index += 1
+            return body
+
+    def load_checkpoint(self, checkpoint):
+        # Called with the render lock held
+        if checkpoint and checkpoint != self.options['sd_model_checkpoint']:
+            time.sleep(self.switch_latency)
+            self.options['sd_model_checkpoint'] = checkpoint
+            self.model_switches += 1
+
+def progress_of(state):
+    current = state.current
+    idle = {'sampling_step': 0, 'sampling_steps': 0, 'job_count': 0, 'job_no': 0, 'job': ''}
+    if current is None:
+        return {'progress': 0.0, 'eta_relative': 0.0, 'state': idle}
+    start, per_image, steps, images = current
+    elapsed = time.time() - start
+    image_no = min(images - 1, int(elapsed / per_image)) if per_image else 0
+    within = (elapsed - image_no * per_image) / per_image if per_image else 1.0
+    total = per_image * images
+    return {
+        'progress': min(1.0, elapsed / total) if total else 1.0,
+        'eta_relative': max(0.0, total - elapsed),
+        'state': {
+            'sampling_step': min(steps, int(within * steps)),
+            'sampling_steps': steps,
+            'job_count': images,
+            'job_no': image_no,
+            'job': f'job-{state.jobs_started}',
+        },
+    }
+
+def memory_of(state):
+    gib = 1024 ** 3
+    used = min(state.vram_gb, state.vram_base_gb + state.vram_per_request * state.rendering)
+    return {
+        'ram': {'free': 16 * gib, 'used': 16 * gib, 'total': 32 * gib},
+        'cuda': {
+            'system': {'free': int((state.vram_gb - used) * gib), 'used': int(used * gib), 'total': int(state.vram_gb * gib)},
+            'events': {'retries': 0, 'oom': state.oom_events},
+        },
+    }
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, obj, status=200):
+            self.send_body(json.dumps(obj).encode(), status)
+
+        def send_body(self, body, status=200):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/sdapi/v1/sd-models':
+                self.send_json([{'title': 'mock.safetensors [0000000000]', 'model_name': 'mock'}])
+            elif self.path == '/sdapi/v1/samplers':
+                self.send_json([{'name': 'Euler a'}, {'name': 'DPM++ 2M'}])
+            elif self.path == '/sdapi/v1/options':
+                self.send_json(state.options)
+            elif self.path == '/sdapi/v1/memory':
+                self.send_json(memory_of(state))
+            elif self.path.split('?')[0] == '/sdapi/v1/progress':
+                self.send_json(progress_of(state))
+            elif self.path == '/sdapi/v1/schedulers':
+                self.send_json([{'name': 'automatic'}, {'name': 'karras'}])
+            else:
+                self.send_json({'detail': 'Not Found'}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            if self.path == '/sdapi/v1/options':
+                with state.lock:
+                    state.load_checkpoint(payload.pop('sd_model_checkpoint', None))
+                    state.options.update(payload)
+                self.send_json(None)
+                return
+            if self.path in ('/sdapi/v1/interrupt', '/sdapi/v1/skip'):
+                with state.lock:
+                    if self.path.endswith('interrupt'):
+                        state.interrupts += 1
+                    else:
+                        state.skips += 1
+                self.send_json(None)
+                return
+            if self.path != '/sdapi/v1/txt2img':
+                self.send_json({'detail': 'Not Found'}, 404)
+                return
+            batch_size = int(payload.get('batch_size', 1))
+            n_iter = int(payload.get('n_iter', 1))
+            count = batch_size * n_iter
+            width, height = int(payload.get('width', 512)), int(payload.get('height', 512))
+            if payload.get('enable_hr'):
+                width, height = int(payload.get('hr_resize_x') or width), int(payload.get('hr_resize_y') or height)
+            too_large = state.max_megapixels is not None and batch_size * width * height / 1e6 > state.max_megapixels
+            if (state.max_batch is not None and batch_size > state.max_batch) or too_large or state.rng.random() < state.oom_rate:
+                state.errors_injected += 1
+                self.send_json({'error': 'OutOfMemoryError', 'detail': '', 'body': '',
+                                'errors': 'CUDA out of memory. Tried to allocate 2.00 GiB'}, 500)
+                return
+            if state.rng.random() < state.error_rate:
+                state.errors_injected += 1
+                self.send_json({'error': 'RuntimeError', 'detail': '', 'body': '', 'errors': 'Injected failure'}, 500)
+                return
+            with state.render_slots:
+                with state.lock:
+                    fits = state.vram_base_gb + state.vram_per_request * (state.rendering + 1) <= state.vram_gb
+                    if fits:
+                        state.rendering += 1
+                        rendering = state.rendering
+                        state.requests += 1
+                        previous = state.options['sd_model_checkpoint']
+                        state.load_checkpoint(payload.get('override_settings', {}).get('sd_model_checkpoint'))
+                    else:
+                        state.oom_events += 1
+                if not fits:
+                    self.send_json({'error': 'OutOfMemoryError', 'detail': '', 'body': '',
+                                    'errors': 'CUDA out of memory. Tried to allocate 2.00 GiB'}, 500)
+                    return
+                # Requests rendered side by side slow each other down like a bigger batch
+                duration = state.latency * n_iter * (1 + (batch_size - 1 + rendering - 1) * state.batch_cost)
+                state.jobs_started += 1
+                state.current = (time.time(), duration / n_iter, int(payload.get('steps', 20)), n_iter)
+                interrupts = state.interrupts
+                finished = 0
+                while finished < n_iter and state.interrupts == interrupts:
+                    skips = state.skips
+                    end = time.time() + duration / n_iter
+                    while time.time() < end and state.interrupts == interrupts and state.skips == skips:
+                        time.sleep(min(0.02, max(0.0, end - time.time())))
+                    if state.interrupts == interrupts:
+                        finished += 1
+                with state.lock:
+                    state.rendering -= 1
+                    state.current = None
+                    if payload.get('override_settings_restore_afterwards', True):
+                        state.load_checkpoint(previous)
+            if state.replay:
+                self.send_body(state.next_replay())
+                return
+            seed = int(payload.get('seed', -1))
+            seed = seed if seed != -1 else 1234
+            done = batch_size * finished  # Like the web UI, all_seeds still lists every planned image
+            if payload.get('save_images') and state.outdir:
+                save_images(state, seed, done)
+            if payload.get('send_images', True) and state.image_png is not None:
+                images = [state.image_png] * done
+            elif payload.get('send_images', True):
+                images = [base64.b64encode(make_png(shade=seed + i)).decode() for i in range(done)]
+            else:
+                images = []
+            info = {'seed': seed, 'all_seeds': [seed + i for i in range(count)], 'port': state.port}
+            self.send_json({'images': images, 'parameters': payload, 'info': json.dumps(info)})
+
+    return Handler
+
+def save_images(state, seed, count):
+    folder = os.path.join(state.outdir, time.strftime('%Y-%m-%d'))
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        with state.lock:
+            number = state.saved_images
+            state.saved_images += 1
+        png = base64.b64decode(state.image_png) if state.image_png is not None else make_png(shade=seed + i)
+        with open(os.path.join(folder, f"{number:05}-{seed + i}.png"), 'wb') as f:
+            f.write(png)
+
+def load_replay(path):
+    # Accepts generation_log.txt ("Response: {...}" lines) or a JSONL event
+    # log written with --debug-responses ("response" fields)
+    bodies = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if 'Response: {' in line:
+                body = line.split('Response: ', 1)[1].strip()
+            elif line.startswith('{') and '"response"' in line:
+                body = json.loads(line).get('response')
+            else:
+                continue
+            if body and '"images"' in body:
+                bodies.append(body.encode('utf-8'))
+    return bodies
+
+def serve(ports, latency=MOCK_OPTIONS['latency'], **options):
+    servers = []
+    for port in ports:
+        state = MockState(port, latency=latency, **options)
+        server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+        server.state = state
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+def main():
+    parser = argparse.ArgumentParser(description='Run mock Automatic1111 API servers.')
+    parser.add_argument('--ports', type=int, nargs='+', default=[7860], help='Ports to listen on')
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds spent per generated image')
+    parser.add_argument('--batch-cost', type=float, default=0.5, help='Relative cost of each extra image in a batch')
+    parser.add_argument('--max-batch', type=int, default=None, help='Fail larger batches with a CUDA OOM error')
+    parser.add_argument('--max-megapixels', type=float, default=None, help='Fail batches of more megapixels with a CUDA OOM error')
+    parser.add_argument('--switch-latency', type=float, default=0.0, help='Seconds needed to load another checkpoint')
+    parser.add_argument('--image-kb', type=int, default=0, help='Approximate size of each returned PNG (0 = tiny)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of txt2img requests failing with HTTP 500')
+    parser.add_argument('--oom-rate', type=float, default=0.0, help='Fraction of txt2img requests failing with a CUDA OOM')
+    parser.add_argument('--replay', help='Return txt2img responses captured in generation_log.txt or a debug event log')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for error and OOM injection')
+    parser.add_argument('--outdir', help='Folder where txt2img requests with save_images write their PNGs')
+    parser.add_argument('--parallel', type=int, default=1, help='Requests rendered at the same time')
+    parser.add_argument('--vram-gb', type=float, default=24.0, help='Total VRAM reported by /sdapi/v1/memory')
+    parser.add_argument('--vram-per-request', type=float, default=0.0, help='GiB of VRAM each rendering request holds')
+    args = parser.parse_args()
+
+    replay = None
+    if args.replay:
+        replay = load_replay(args.replay)
+        if not replay:
+            print(f"No captured responses found in {args.replay}.")
+            sys.exit(1)
+        print(f"Replaying {len(replay)} captured responses.")
+
+    servers = serve(args.ports, args.latency, batch_cost=args.batch_cost, max_batch=args.max_batch, max_megapixels=args.max_megapixels,
+                    switch_latency=args.switch_latency, image_kb=args.image_kb, error_rate=args.error_rate,
+                    oom_rate=args.oom_rate, replay=replay, seed=args.seed, outdir=args.outdir,
+                    parallel=args.parallel, vram_gb=args.vram_gb, vram_per_request=args.vram_per_request)
+    print(f"Mock web UI listening on ports: {', '.join(str(p) for p in args.ports)}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+        sys.exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# Persistent catalog of checkpoints and LoRAs. A directory is only listed
+# again when its mtime changed, and a file is only inspected again when its
+# size or mtime changed, so repeated runs against a slow network share cost
+# one stat per directory. Lookups of a single file (info) read the snapshot
+# the last entries() call validated and stat nothing. safetensors files are
+# inspected by reading their JSON header through mmap (the weights are
+# never read) to find the architecture, base resolution and trigger words;
+# the file hash is the short hash the web UI shows for older checkpoints
+# (64 KiB at 1 MiB), or the full sha256 when asked for.
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+import threading
+
+from journal import AtomicFile
+
+DEFAULT_CATALOG_PATH = os.path.join('settings', 'model_catalog.json')
+MODEL_EXTENSIONS = ('.ckpt', '.safetensors', '.pt')
+MAX_HEADER_BYTES = 100 * 1024 * 1024
+BASE_RESOLUTIONS = {'SD1': 512, 'SD2': 768, 'SDXL': 1024, 'SD3': 1024, 'Flux': 1024}
+MAX_TRIGGER_WORDS = 10
+
+def read_safetensors_header(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < 8:
+                raise ValueError('file too short for a safetensors header')
+            length = struct.unpack('<Q', mm[:8])[0]
+            if length > MAX_HEADER_BYTES or 8 + length > len(mm):
+                raise ValueError('invalid safetensors header length')
+            return json.loads(mm[8:8 + length])
+
+def short_hash(path):
+    # The legacy web UI model hash: sha256 of 64 KiB at offset 1 MiB
+    with open(path, 'rb') as f:
+        f.seek(0x100000)
+        return hashlib.sha256(f.read(0x10000)).hexdigest()[:8]
+
+def full_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def architecture_from_metadata(metadata):
+    # modelspec: "stable-diffusion-xl-v1-base/lora"; kohya: "sdxl_base_v1-0", "sd_v1", "sd_v2"
+    text = ' '.join(str(metadata.get(key, '')) for key in ('modelspec.architecture', 'ss_base_model_version')).lower()
+    if 'flux' in text:
+        return 'Flux'
+    if 'sd3' in text or 'stable-diffusion-3' in text:
+        return 'SD3'
+    if 'sdxl' in text or 'stable-diffusion-xl' in text:
+        return 'SDXL'
+    if 'sd_v2' in text or 'stable-diffusion-v2' in text or str(metadata.get('ss_v2', '')).lower() == 'true':
+        return 'SD2'
+    if 'sd_v1' in text or 'stable-diffusion-v1' in text:
+        return 'SD1'
+    return None
+
+def architecture_from_keys(keys):
+    joined = '\n'.join(keys)
+    if 'double_blocks' in joined:
+        return 'Flux'
+    if 'joint_blocks' in joined:
+        return 'SD3'
+    if 'conditioner.embedders.1' in joined or 'lora_te2_' in joined or 'lora_unet_input_blocks_4_1_transformer_blocks_1_' in joined:
+        return 'SDXL'
+    if 'cond_stage_model.model.' in joined:
+        return 'SD2'
+    if 'cond_stage_model.transformer' in joined or 'lora_te_' in joined or 'lora_unet_down_blocks' in joined:
+        return 'SD1'
+    return None
+
+def parse_resolution(value):
+    # kohya stores "(1024, 1024)" or "[512, 512]"; modelspec "1024x1024"
+    digits = [int(part) for part in str(value).replace('x', ',').strip('()[] ').split(',') if part.strip().isdigit()]
+    return digits[0] if digits else None
+
+def trigger_words(metadata):
+    if metadata.get('modelspec.trigger_phrase'):
+        return [word.strip() for word in str(metadata['modelspec.trigger_phrase']).split(',') if word.strip()]
+    try:
+        frequencies = json.loads(metadata.get('ss_tag_frequency') or '{}')
+    except ValueError:
+        return []
+    totals = {}
+    for tags in frequencies.values():
+        for tag, count in tags.items():
+            totals[tag.strip()] = totals.get(tag.strip(), 0) + count
+    return [tag for tag, _ in sorted(totals.items(), key=lambda item: -item[1])[:MAX_TRIGGER_WORDS] if tag]
+
+def inspect_file(path, with_full_hash=False):
+    info = {'kind': None, 'architecture': None, 'resolution': None, 'trigger_words': [], 'hash': None}
+    try:
+        info['hash'] = full_hash(path) if with_full_hash else short_hash(path)
+    except OSError as e:
+        info['error'] = str(e)
+        return info
+    if not path.lower().endswith('.safetensors'):
+        return info  # Pickled formats cannot be inspected without loading them
+    try:
+        header = read_safetensors_header(path)
+    except (OSError, ValueError) as e:
+        info['error'] = f"unreadable header: {e}"
+        return info
+    metadata = header.pop('__metadata__', None) or {}
+    keys = list(header)
+    info['kind'] = 'lora' if any(key.startswith('lora_') or '.lora_' in key or 'lora_down' in key for key in keys[:200]) else 'checkpoint'
+    info['architecture'] = architecture_from_metadata(metadata) or architecture_from_keys(keys)
+    info['resolution'] = parse_resolution(metadata.get('ss_resolution') or metadata.get('modelspec.resolution') or '') \
+        or BASE_RESOLUTIONS.get(info['architecture'])
+    info['trigger_words'] = trigger_words(metadata)
+    if metadata.get('sshs_model_hash'):
+        info['sshs_model_hash'] = metadata['sshs_model_hash']
+    return info
+
+class ModelCatalog:
+    def __init__(self, path=DEFAULT_CATALOG_PATH, with_full_hash=False):
+        self.path = path
+        self.with_full_hash = with_full_hash
+        self.lock = threading.Lock()
+        self.directories = {}  # directory -> {'mtime': ..., 'files': {name: info}}
+        self.snapshots = {}  # directory -> files validated against its mtime during this run
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.directories = json.load(f).get('directories', {})
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable model catalog {path}: {e}")
+
+    def entries(self, directory):
+        # {file name: info} of the model files directly inside `directory`
+        key = os.path.abspath(directory)
+        with self.lock:
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                self.snapshots[key] = {}
+                return {}
+            cached = self.directories.get(key)
+            if cached is not None and cached['mtime'] == mtime:
+                self.snapshots[key] = cached['files']
+                return cached['files']
+            known = cached['files'] if cached is not None else {}
+            files = {}
+            for entry in os.scandir(directory):
+                if not entry.name.lower().endswith(MODEL_EXTENSIONS) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                info = known.get(entry.name)
+                if info is None or info.get('size') != stat.st_size or info.get('mtime') != stat.st_mtime:
+                    info = inspect_file(entry.path, self.with_full_hash)
+                    info.update(size=stat.st_size, mtime=stat.st_mtime)
+                files[entry.name] = info
+            self.directories[key] = {'mtime': mtime, 'files': files}
+            self.snapshots[key] = files
+            self.dirty = True
+            return files
+
+    def names(self, directory):
+        return sorted(self.entries(directory))
+
+    def info(self, directory, name):
+        if not name:
+            return None
+        files = self.snapshots.get(os.path.abspath(directory))
+        if files is None:
+            files = self.entries(directory)
+        name = name.split(' [')[0]  # "name.safetensors [hash]" titles
+        if name in files:
+            return files[name]
+        for file_name, info in files.items():
+            if os.path.splitext(file_name)[0] == name:
+                return info
+        return None
+
+    def find(self, directory, architecture=None, text=None, trigger=None):
+        # Filtered lookup; all filters are optional and case-insensitive
+        found = []
+        for name, info in sorted(self.entries(directory).items()):
+            if architecture and (info.get('architecture') or '').lower() != architecture.lower():
+                continue
+            if text and text.lower() not in name.lower():
+                continue
+            if trigger and not any(trigger.lower() in word.lower() for word in info.get('trigger_words', [])):
+                continue
+            found.append((name, info))
+        return found
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            catalog_file = AtomicFile(self.path)
+            catalog_file.write(json.dumps({'directories': self.directories}, indent=1).encode('utf-8'))
+            catalog_file.close()
+            self.dirty = False
+
+def lora_mismatch(checkpoint_info, lora_info, checkpoint, lora):
+    # Reason the LoRA cannot be used with the checkpoint, or None if it may
+    if not checkpoint_info or not lora_info:
+        return None
+    checkpoint_arch = checkpoint_info.get('architecture')
+    lora_arch = lora_info.get('architecture')
+    if checkpoint_arch and lora_arch and checkpoint_arch != lora_arch:
+        return f"LoRA {lora} is for {lora_arch} but checkpoint {checkpoint} is {checkpoint_arch}"
+    return None
+
+def describe(info):
+    if not info:
+        return ''
+    parts = [part for part in (info.get('architecture'), f"{info['resolution']}px" if info.get('resolution') else None) if part]
+    if info.get('trigger_words'):
+        parts.append('triggers: ' + ', '.join(info['trigger_words'][:3]))
+    return f" ({'; '.join(parts)})" if parts else ''
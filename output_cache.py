@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# Content-addressed cache of generated images. With a fixed seed the same
+# payload on the same checkpoint always renders the same image, so every
+# finished image is kept under the hash of its payload (seed base + k - 1,
+# model hash instead of the checkpoint name). batch_size and the image's
+# place in its batch stay in the key: with the seed they decide the noise a
+# sampler draws. n_iter does not: the web UI seeds iteration k with seed +
+# k x batch_size, so an image looks the same whichever iteration renders
+# it, and a job split into other iterations still hits the cache. Later
+# jobs that ask for that image get it hardlinked (or copied) into their
+# Iteration_N directory instead of going to the backend.
+# The cache is bounded in size and evicts the least recently used images.
+# Uses are appended to access.log rather than recorded in file mtimes,
+# which a hardlinked story image shares with its cache entry.
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+from lazy_imports import lazy_import
+from sd_client import get_client
+
+requests = lazy_import('requests')
+
+DEFAULT_CACHE_DIR = 'output_cache'
+DEFAULT_MAX_GB = 20
+ACCESS_LOG = 'access.log'  # Keys in the order they were stored or used
+# Payload fields that do not change how an individual image looks
+IGNORED_FIELDS = ('n_iter', 'send_images', 'save_images', 'override_settings_restore_afterwards')
+
+def link_or_copy(src, dest):
+    tmp = dest + '.part'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # Other file system, or no hardlink support
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+def image_payload(job, index):
+    # Payload that renders exactly image `index` of the job, in a request of
+    # the job's shape
+    payload = job['payload']
+    position = job['indices'].index(index) % payload.get('batch_size', 1)
+    return dict(payload, seed=job['base_seed'] + index - 1, batch_position=position)
+
+def is_deterministic(job):
+    return job.get('base_seed', -1) != -1
+
+class OutputCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_GB * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size, least recently used first
+        self.total = 0
+        self.model_hashes = {}  # endpoint -> {checkpoint name: hash}
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self._load()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.png')
+
+    def _used(self, key):
+        # Called with the lock held
+        try:
+            with open(os.path.join(self.directory, ACCESS_LOG), 'a') as log:
+                log.write(key + '\n')
+        except OSError:
+            pass  # Only the eviction order suffers
+
+    def _load(self):
+        found = []
+        if os.path.isdir(self.directory):
+            for bucket in os.scandir(self.directory):
+                if not bucket.is_dir():
+                    continue
+                for entry in os.scandir(bucket.path):
+                    if entry.name.endswith('.png'):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total += size
+        access_log = os.path.join(self.directory, ACCESS_LOG)
+        if not os.path.exists(access_log):
+            return
+        with open(access_log) as log:
+            for line in log:
+                if line.strip() in self.entries:
+                    self.entries.move_to_end(line.strip())
+        # Compacted to one line per entry, in use order
+        with open(access_log + '.tmp', 'w') as log:
+            log.writelines(key + '\n' for key in self.entries)
+        os.replace(access_log + '.tmp', access_log)
+
+    # Keys
+
+    def model_hash(self, endpoint, checkpoint):
+        # Hash the backend reports for a checkpoint; the name when unknown
+        if endpoint not in self.model_hashes:
+            hashes = {}
+            try:
+                response = get_client(endpoint).get('/sdapi/v1/sd-models')
+                response.raise_for_status()
+                for model in response.json():
+                    digest = model.get('sha256') or model.get('hash')
+                    if not digest and ' [' in model.get('title', ''):
+                        digest = model['title'].rsplit(' [', 1)[1].rstrip(']')
+                    if not digest:
+                        continue
+                    for name in (model.get('title'), model.get('model_name'), (model.get('title') or '').split(' [')[0]):
+                        if name:
+                            hashes[name] = digest
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Could not read checkpoint hashes from {endpoint}: {e}")
+            self.model_hashes[endpoint] = hashes
+        if not checkpoint:
+            return None
+        hashes = self.model_hashes[endpoint]
+        return hashes.get(checkpoint) or hashes.get(checkpoint.split(' [')[0]) or checkpoint
+
+    def key(self, payload, model_hash):
+        canonical = {k: v for k, v in payload.items() if k not in IGNORED_FIELDS}
+        override_settings = dict(canonical.get('override_settings') or {})
+        override_settings.pop('sd_model_checkpoint', None)
+        canonical['override_settings'] = override_settings
+        canonical['model_hash'] = model_hash
+        data = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    # Lookups and inserts
+
+    def fetch(self, key, dest):
+        with self.lock:
+            size = self.entries.get(key)
+            if size is None:
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self._used(key)
+        path = self._path(key)
+        try:
+            link_or_copy(path, dest)
+        except OSError:
+            with self.lock:
+                if self.entries.pop(key, None) is not None:
+                    self.total -= size
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+            self.bytes_served += size
+        return True
+
+    def store(self, key, src):
+        with self.lock:
+            if key in self.entries:
+                return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            link_or_copy(src, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"Could not add {src} to the output cache: {e}")
+            return
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = size
+                self.total += size
+                self.stores += 1
+                self._used(key)
+            self._evict()
+
+    def _evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def summary(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'bytes_served': self.bytes_served,
+                'entries': len(self.entries),
+                'bytes': self.total,
+            }
+
+def print_cache_report(cache):
+    summary = cache.summary()
+    print(f"\nOutput cache: {summary['hits']} hits, {summary['misses']} misses ({summary['hit_rate']:.0%} hit rate), "
+          f"{summary['bytes_served'] / 1024 / 1024:.1f} MiB served from cache.")
+    print(f"  {summary['stores']} images added, {summary['evictions']} evicted; "
+          f"{summary['entries']} images, {summary['bytes'] / 1024 / 1024:.1f} MiB of {cache.max_bytes / 1024 ** 3:.0f} GiB in {cache.directory}.")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Checkpoint-affinity planning. All pending jobs of a run are gathered
+# first, grouped by (checkpoint, LoRA) and sent group by group, starting
+# with whatever checkpoint the backend already has loaded. Each backend
+# switches checkpoints explicitly through /sdapi/v1/options as soon as it
+# picks up the first job of the next group, instead of the web UI swapping
+# models back and forth on every request.
+
+import time
+import threading
+
+from lazy_imports import lazy_import
+from sd_client import get_client
+from telemetry import payload_hash
+
+requests = lazy_import('requests')
+
+def job_checkpoint(job):
+    return job['payload'].get('override_settings', {}).get('sd_model_checkpoint')
+
+def job_group(job):
+    return (job_checkpoint(job), job.get('lora', ''))
+
+def checkpoint_matches(loaded, checkpoint):
+    # The options endpoint reports "name.safetensors [hash]" while settings
+    # usually store the bare file name
+    if not loaded or not checkpoint:
+        return False
+    return loaded == checkpoint or loaded.split(' [')[0] == checkpoint.split(' [')[0]
+
+def count_switches(jobs, loaded=None):
+    switches = 0
+    for job in jobs:
+        checkpoint = job_checkpoint(job)
+        if checkpoint and not checkpoint_matches(loaded, checkpoint):
+            if loaded is not None:
+                switches += 1
+            loaded = checkpoint
+    return switches
+
+def plan_by_affinity(jobs, loaded=None):
+    # Stable grouping: groups keep the order in which they first appear,
+    # except that the group(s) for the already loaded checkpoint go first.
+    # Groups of the same checkpoint with different LoRAs stay adjacent.
+    groups = {}
+    checkpoint_order = []
+    for job in jobs:
+        key = job_group(job)
+        if key not in groups:
+            groups[key] = []
+            if key[0] not in checkpoint_order:
+                checkpoint_order.append(key[0])
+        groups[key].append(job)
+    checkpoint_order.sort(key=lambda checkpoint: 0 if checkpoint_matches(loaded, checkpoint) else 1)
+    ordered = []
+    for checkpoint in checkpoint_order:
+        for key, group in groups.items():
+            if key[0] == checkpoint:
+                ordered.append((key, group))
+    return ordered
+
+def job_images(job):
+    payload = job['payload']
+    return payload.get('n_iter', 1) * payload.get('batch_size', 1)
+
+def coalesce_jobs(jobs):
+    # Identical fixed-seed payloads render identical images, so only the
+    # first one is sent; the others are attached to it as job['duplicates']
+    # and receive copies of its images. Random seeds are never coalesced.
+    unique = []
+    first_by_hash = {}
+    for job in jobs:
+        if job['payload'].get('seed', -1) == -1:
+            unique.append(job)
+            continue
+        digest = payload_hash(job['payload'])
+        first = first_by_hash.get(digest)
+        if first is None:
+            job['duplicates'] = []
+            first_by_hash[digest] = job
+            unique.append(job)
+        else:
+            first['duplicates'].append(job)
+    return unique
+
+def summarize_coalescing(jobs, unique):
+    duplicates = [duplicate for job in unique for duplicate in job.get('duplicates', [])]
+    return {
+        'jobs': len(jobs),
+        'requests': len(unique),
+        'coalesced': len(duplicates),
+        'images_saved': sum(job_images(job) for job in duplicates),
+    }
+
+def summarize_plan(jobs, ordered, loaded=None):
+    planned = [job for _, group in ordered for job in group]
+    naive = count_switches(jobs, loaded)
+    optimized = count_switches(planned, loaded)
+    return {
+        'jobs': len(jobs),
+        'groups': len(ordered),
+        'switches_naive': naive,
+        'switches_planned': optimized,
+        'switches_avoided': naive - optimized,
+    }
+
+class CheckpointTracker:
+    # Remembers which checkpoint each backend has loaded and switches it
+    # explicitly when a job needs another one
+    def __init__(self, endpoints):
+        self.loaded = {}
+        self.locks = {endpoint: threading.Lock() for endpoint in endpoints}
+        self.switches = 0
+        self.switch_seconds = 0.0
+        for endpoint in endpoints:
+            self.loaded[endpoint] = self.query_loaded(endpoint)
+
+    def query_loaded(self, endpoint):
+        try:
+            response = get_client(endpoint).get('/sdapi/v1/options')
+            response.raise_for_status()
+            return response.json().get('sd_model_checkpoint')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Could not read the loaded checkpoint from {endpoint}: {e}")
+            return None
+
+    def ensure_loaded(self, endpoint, checkpoint):
+        if not checkpoint:
+            return
+        with self.locks.setdefault(endpoint, threading.Lock()):
+            if checkpoint_matches(self.loaded.get(endpoint), checkpoint):
+                return
+            print(f"\nLoading checkpoint {checkpoint} on {endpoint}...")
+            start = time.perf_counter()
+            try:
+                response = get_client(endpoint).post('/sdapi/v1/options', json={'sd_model_checkpoint': checkpoint})
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                # The override in the txt2img payload will still load it
+                print(f"Pre-loading {checkpoint} on {endpoint} failed: {e}")
+                self.loaded[endpoint] = None
+                return
+            self.switch_seconds += time.perf_counter() - start
+            self.switches += 1
+            self.loaded[endpoint] = checkpoint
+
+    def forget(self, endpoint):
+        # After a failed model load the backend's checkpoint is unknown
+        with self.locks.setdefault(endpoint, threading.Lock()):
+            self.loaded[endpoint] = None
+
+def print_plan_summary(summary):
+    print(f"\nPlanned {summary['jobs']} jobs in {summary['groups']} checkpoint/LoRA groups.")
+    print(f"Model switches: {summary['switches_planned']} planned instead of {summary['switches_naive']} "
+          f"({summary['switches_avoided']} avoided).")
+
+def print_coalescing_summary(summary):
+    if summary['coalesced']:
+        print(f"\nCoalesced {summary['coalesced']} identical requests: {summary['requests']} requests for {summary['jobs']} jobs, "
+              f"{summary['images_saved']} images will be copied instead of generated.")
+
+def print_gpu_time_saved(summary, seconds, images):
+    # Estimated from the average time per generated image of this run
+    if summary['images_saved'] and images:
+        saved = summary['images_saved'] * seconds / images
+        print(f"GPU time saved by coalescing: ~{saved:.1f}s ({summary['images_saved']} images at {seconds / images:.2f}s per image).")
+
+def print_checkpoint_loads(tracker):
+    if tracker.switches:
+        print(f"\nCheckpoint loads performed: {tracker.switches} ({tracker.switch_seconds:.1f}s).")
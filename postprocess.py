@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Optional post-processing of finished images, off the generation path.
+# Decoded image bytes are handed from memory to a pool of worker processes
+# (images served from the output cache are read back from disk instead),
+# which write the derivatives next to the original:
+#   optimize       lossless PNG recompression, kept only when smaller
+#   webp / avif    <name>.webp / <name>.avif copies
+#   thumbnail      thumbnails/<name>.jpg
+#   contact-sheet  contact_sheet.jpg per Iteration_N, from its thumbnails
+# At most `max_backlog` images wait for a worker; submit() blocks when the
+# backlog is full, which is the only way the generation loop ever waits.
+# Needs Pillow, which is only imported in the workers.
+
+import os
+import time
+import argparse
+import importlib.util
+import threading
+
+from journal import AtomicFile
+
+STEPS = ('optimize', 'webp', 'avif', 'thumbnail', 'contact-sheet')
+DEFAULT_STEPS = ('optimize', 'webp', 'thumbnail', 'contact-sheet')
+DEFAULT_BACKLOG = 32
+THUMBNAIL_SIZE = 256
+THUMBNAIL_DIR = 'thumbnails'
+CONTACT_SHEET = 'contact_sheet.jpg'
+CONTACT_SHEET_COLUMNS = 6
+QUALITY = 90
+
+def pillow_available():
+    return importlib.util.find_spec('PIL') is not None
+
+def parse_steps(value):
+    # argparse type: "optimize,webp" -> ('optimize', 'webp'); "all" -> every step
+    if value.strip().lower() == 'all':
+        return STEPS
+    steps = tuple(step.strip().lower() for step in value.split(',') if step.strip())
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown post-processing step(s) {', '.join(unknown)}; choose from {', '.join(STEPS)}")
+    return steps
+
+class CapturingFile:
+    # Passes writes through to `file` and keeps a copy for the post-processor
+    def __init__(self, file):
+        self.file = file
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        getattr(self.file, 'discard', self.file.close)()
+
+def _save(image, path, image_format, **params):
+    output = AtomicFile(path)
+    try:
+        image.save(output.file, image_format, **params)
+    except BaseException:
+        output.discard()
+        raise
+    output.close()
+    return os.path.getsize(path)
+
+def process_image(path, data, steps):
+    # Runs in a worker process. Returns {'written': bytes written per step,
+    # 'saved': bytes saved by optimize, 'thumbnail': path or None}
+    import io
+    import importlib
+    from PIL import Image
+    if 'avif' in steps:
+        try:
+            importlib.import_module('pillow_avif')  # Registers AVIF support on Pillow < 11.2
+        except ImportError:
+            pass
+
+    image = Image.open(io.BytesIO(data) if data is not None else path)
+    image.load()
+    base = os.path.splitext(path)[0]
+    result = {'written': {}, 'saved': 0, 'thumbnail': None}
+
+    if 'optimize' in steps and image.format == 'PNG':
+        before = len(data) if data is not None else os.path.getsize(path)
+        smaller = io.BytesIO()
+        image.save(smaller, 'PNG', optimize=True, pnginfo=_png_info(image))
+        if smaller.tell() < before:
+            output = AtomicFile(path)
+            output.write(smaller.getvalue())
+            output.close()
+            result['saved'] = before - smaller.tell()
+    if 'webp' in steps:
+        result['written']['webp'] = _save(image, base + '.webp', 'WEBP', quality=QUALITY, method=4)
+    if 'avif' in steps:
+        result['written']['avif'] = _save(image, base + '.avif', 'AVIF', quality=QUALITY)
+    if 'thumbnail' in steps or 'contact-sheet' in steps:
+        thumbnail = image.convert('RGB')
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        thumbnail_dir = os.path.join(os.path.dirname(path), THUMBNAIL_DIR)
+        os.makedirs(thumbnail_dir, exist_ok=True)
+        result['thumbnail'] = os.path.join(thumbnail_dir, os.path.basename(base) + '.jpg')
+        result['written']['thumbnail'] = _save(thumbnail, result['thumbnail'], 'JPEG', quality=85)
+    return result
+
+def _png_info(image):
+    # Keeps the generation parameters the web UI stores in PNG text chunks
+    from PIL import PngImagePlugin
+    info = PngImagePlugin.PngInfo()
+    for key, value in image.info.items():
+        if isinstance(value, str):
+            info.add_text(key, value)
+    return info
+
+def contact_sheet(iteration_dir):
+    # Runs in a worker process; tiles every thumbnail of the iteration
+    from PIL import Image
+    thumbnail_dir = os.path.join(iteration_dir, THUMBNAIL_DIR)
+    if not os.path.isdir(thumbnail_dir):
+        return 0
+    names = sorted((name for name in os.listdir(thumbnail_dir) if name.endswith('.jpg')),
+                   key=lambda name: (len(name), name))  # image_2 before image_10
+    if not names:
+        return 0
+    columns = min(len(names), CONTACT_SHEET_COLUMNS)
+    rows = (len(names) + columns - 1) // columns
+    sheet = Image.new('RGB', (columns * THUMBNAIL_SIZE, rows * THUMBNAIL_SIZE), 'white')
+    for n, name in enumerate(names):
+        with Image.open(os.path.join(thumbnail_dir, name)) as thumbnail:
+            row, column = divmod(n, columns)
+            x = column * THUMBNAIL_SIZE + (THUMBNAIL_SIZE - thumbnail.width) // 2
+            y = row * THUMBNAIL_SIZE + (THUMBNAIL_SIZE - thumbnail.height) // 2
+            sheet.paste(thumbnail, (x, y))
+    return _save(sheet, os.path.join(iteration_dir, CONTACT_SHEET), 'JPEG', quality=85)
+
+class PostProcessor:
+    def __init__(self, steps=DEFAULT_STEPS, workers=None, max_backlog=DEFAULT_BACKLOG):
+        # Only runs that post-process pay for the process pool imports
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        self.steps = tuple(steps)
+        # spawn: the generation process runs threads, which fork does not mix with
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.backlog = threading.BoundedSemaphore(max_backlog)
+        self.max_backlog = max_backlog
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.iteration_dirs = set()  # Iterations that need a (new) contact sheet
+        self.images = 0
+        self.errors = []
+        self.saved = 0
+        self.written = {}
+        self.wait_seconds = 0.0  # Time submit() spent waiting for a free backlog slot
+
+    def submit(self, path, data=None):
+        # data: the image bytes when still in memory, None to read `path`
+        start = time.perf_counter()
+        self.backlog.acquire()
+        future = self.pool.submit(process_image, path, bytes(data) if data is not None else None, self.steps)
+        with self.lock:
+            self.wait_seconds += time.perf_counter() - start
+            self.futures.add(future)
+            if 'contact-sheet' in self.steps:
+                self.iteration_dirs.add(os.path.dirname(path))
+        future.add_done_callback(lambda done: self._done(path, done))
+
+    def _done(self, path, future):
+        self.backlog.release()
+        with self.lock:
+            self.futures.discard(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                self.errors.append(f"{path}: {e}")
+                return
+            self.images += 1
+            self.saved += result['saved']
+            for step, size in result['written'].items():
+                count, total = self.written.get(step, (0, 0))
+                self.written[step] = (count + 1, total + size)
+
+    def close(self):
+        # Waits for the backlog, then builds the contact sheets
+        with self.lock:
+            pending = list(self.futures)
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass  # Recorded by _done
+        sheets = [(iteration_dir, self.pool.submit(contact_sheet, iteration_dir)) for iteration_dir in sorted(self.iteration_dirs)]
+        for iteration_dir, future in sheets:
+            try:
+                size = future.result()
+            except Exception as e:
+                self.errors.append(f"{iteration_dir}: contact sheet failed: {e}")
+                continue
+            if size:
+                count, total = self.written.get('contact-sheet', (0, 0))
+                self.written['contact-sheet'] = (count + 1, total + size)
+        self.pool.shutdown()
+
+    def summary(self):
+        return {
+            'images': self.images,
+            'errors': len(self.errors),
+            'saved_bytes': self.saved,
+            'written': dict(self.written),
+            'wait_seconds': round(self.wait_seconds, 3),
+        }
+
+def print_postprocess_report(processor):
+    summary = processor.summary()
+    print(f"\nPost-processing: {summary['images']} images, {summary['errors']} failed, "
+          f"{summary['wait_seconds']:.1f}s spent waiting for the backlog of {processor.max_backlog}.")
+    if 'optimize' in processor.steps:
+        print(f"  optimize: {summary['saved_bytes'] / 1024 / 1024:.1f} MiB saved by lossless recompression")
+    for step, (count, total) in sorted(summary['written'].items()):
+        print(f"  {step}: {count} files, {total / 1024 / 1024:.1f} MiB")
+    for error in processor.errors[:10]:
+        print(f"  {error}")
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Live progress from /sdapi/v1/progress. A background thread polls every
+# backend, measures seconds per sampling step for each (width, height,
+# steps) combination and turns that into a story-wide ETA and a running
+# images-per-minute figure. snapshot() exposes the same numbers to code
+# that wants to make scheduling decisions.
+
+import time
+import threading
+from collections import deque
+
+from lazy_imports import lazy_import
+from sd_client import get_client
+
+requests = lazy_import('requests')
+
+DEFAULT_INTERVAL = 1.0
+SMOOTHING = 0.3  # Weight of the newest sample in the moving averages
+
+def step_key(payload):
+    return (payload['width'], payload['height'], payload['steps'])
+
+def job_step_count(job):
+    # Sampling steps the backend runs for this job (one pass per image)
+    payload = job['payload']
+    return payload['steps'] * len(job['indices'])
+
+class ProgressMonitor:
+    def __init__(self, endpoints, interval=DEFAULT_INTERVAL, display=True):
+        self.endpoints = list(endpoints)
+        self.interval = interval
+        self.display = display
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.bar = None
+        self.sec_per_step = {}  # (width, height, steps) -> seconds
+        self.running = {endpoint: deque() for endpoint in self.endpoints}  # Started, unfinished jobs
+        self.live = {endpoint: {} for endpoint in self.endpoints}
+        self.last_sample = {}
+        self.pending_steps = {}  # step key -> steps not yet finished
+        self.images_total = 0
+        self.images_done = 0
+        self.started = time.time()
+
+    # Planning and job lifecycle
+
+    def set_plan(self, jobs):
+        with self.lock:
+            for job in jobs:
+                key = step_key(job['payload'])
+                self.pending_steps[key] = self.pending_steps.get(key, 0) + job_step_count(job)
+                self.images_total += len(job['indices'])
+        if self.display and self.bar is not None:
+            self.bar.total = self.images_total
+            self.bar.refresh()
+
+    def jobs_requeued(self, jobs):
+        # Retries and resends of images already in the total: only their
+        # steps are pending again (under their own size, after a downscale)
+        with self.lock:
+            for job in jobs:
+                key = step_key(job['payload'])
+                self.pending_steps[key] = self.pending_steps.get(key, 0) + job_step_count(job)
+
+    def job_resized(self, job, resized):
+        # A planned job sent at another size (a learned resolution limit)
+        with self.lock:
+            key = step_key(job['payload'])
+            self.pending_steps[key] = max(0, self.pending_steps.get(key, 0) - job_step_count(job))
+            key = step_key(resized['payload'])
+            self.pending_steps[key] = self.pending_steps.get(key, 0) + job_step_count(resized)
+
+    def job_started(self, endpoint, job):
+        with self.lock:
+            self.running.setdefault(endpoint, deque()).append((job, time.time()))
+
+    def job_finished(self, endpoint, job, images, failed=False, steps=True):
+        # steps=False: the job's steps were already counted as finished
+        with self.lock:
+            queue = self.running.get(endpoint, deque())
+            started = None
+            for entry in list(queue):
+                if entry[0] is job:
+                    started = entry[1]
+                    queue.remove(entry)
+                    break
+            key = step_key(job['payload'])
+            if steps:
+                self.pending_steps[key] = max(0, self.pending_steps.get(key, 0) - job_step_count(job))
+            if failed:
+                self.images_total -= len(job['indices'])
+            else:
+                self.images_done += images
+                if started is not None and key not in self.sec_per_step and images:
+                    # First estimate until the poller has measured this size
+                    self.sec_per_step[key] = (time.time() - started) / job_step_count(job)
+        if self.display and self.bar is not None:
+            if failed:
+                self.bar.total = self.images_total
+            self.bar.update(0 if failed else images)
+
+    # Polling
+
+    def _poll(self, endpoint):
+        try:
+            response = get_client(endpoint).get('/sdapi/v1/progress?skip_current_image=true', retries=0)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return
+        state = data.get('state') or {}
+        now = time.time()
+        with self.lock:
+            step = state.get('sampling_step', 0)
+            steps = state.get('sampling_steps', 0)
+            job_no = (state.get('job'), state.get('job_no'))
+            self.live[endpoint] = {
+                'progress': data.get('progress', 0.0),
+                'eta_relative': data.get('eta_relative', 0.0),
+                'sampling_step': step,
+                'sampling_steps': steps,
+                'job_count': state.get('job_count', 0),
+            }
+            running = self.running.get(endpoint)
+            previous = self.last_sample.get(endpoint)
+            self.last_sample[endpoint] = (job_no, step, now)
+            if not running or previous is None or previous[0] != job_no or step <= previous[1]:
+                return
+            sample = (now - previous[2]) / (step - previous[1])
+            key = step_key(running[0][0]['payload'])
+            known = self.sec_per_step.get(key)
+            self.sec_per_step[key] = sample if known is None else known + SMOOTHING * (sample - known)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            for endpoint in self.endpoints:
+                self._poll(endpoint)
+            if self.display and self.bar is not None:
+                self.bar.set_postfix_str(self.status_line(), refresh=True)
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        if self.display:
+            from tqdm import tqdm
+            self.bar = tqdm(total=self.images_total, desc='Story', unit='img', position=0)
+        self.thread = threading.Thread(target=self._run, name='progress-monitor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.bar is not None:
+            self.bar.close()
+            self.bar = None
+
+    # Derived numbers
+
+    def _eta(self):
+        if not self.sec_per_step:
+            return None
+        fallback = sum(self.sec_per_step.values()) / len(self.sec_per_step)
+        seconds = 0.0
+        for key, steps in self.pending_steps.items():
+            seconds += steps * self.sec_per_step.get(key, fallback)
+        # Steps already done on running jobs are still counted as pending
+        for endpoint, live in self.live.items():
+            if self.running.get(endpoint):
+                key = step_key(self.running[endpoint][0][0]['payload'])
+                seconds -= live.get('sampling_step', 0) * self.sec_per_step.get(key, fallback)
+        return max(0.0, seconds) / max(1, len(self.endpoints))
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            return {
+                'images_done': self.images_done,
+                'images_total': self.images_total,
+                'images_per_minute': self.images_done * 60 / elapsed if elapsed > 0 else 0.0,
+                'eta_seconds': self._eta(),
+                'sec_per_step': {f"{w}x{h}@{s}": round(v, 4) for (w, h, s), v in self.sec_per_step.items()},
+                'endpoints': {endpoint: dict(live) for endpoint, live in self.live.items()},
+            }
+
+    def status_line(self):
+        snap = self.snapshot()
+        parts = []
+        for endpoint, live in snap['endpoints'].items():
+            if live.get('sampling_steps'):
+                parts.append(f"step {live['sampling_step']}/{live['sampling_steps']}")
+        eta = snap['eta_seconds']
+        parts.append(f"ETA {format_duration(eta)}" if eta is not None else "ETA --")
+        parts.append(f"{snap['images_per_minute']:.1f} img/min")
+        return ', '.join(parts)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
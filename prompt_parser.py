@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Single-pass parser for characters.txt / scenes.txt. The file is read line
+# by line and every block is handed out as soon as its closing separator is
+# seen, so memory use does not grow with the file and the first prompt is
+# available right away. Blocks are separated by lines that hold nothing but
+# '---', which lets prompts themselves contain three dashes. Inside a block
+# "Key: value" starts a field and a line without a colon continues the
+# previous one.
+
+SEPARATOR = '---'
+REQUIRED_KEYS = ('Name', 'Positive prompt')
+
+class PromptFormatError(ValueError):
+    def __init__(self, path, line_no, message):
+        super().__init__(f"{path}:{line_no}: {message}")
+        self.path = path
+        self.line_no = line_no
+
+def warn(problem):
+    print(f"Warning: {problem}")
+
+def _finish(path, start, data, on_problem):
+    for key in REQUIRED_KEYS:
+        if not data.get(key):
+            on_problem(PromptFormatError(path, start, f"block has no '{key}'"))
+    return start, data
+
+def iter_prompt_blocks(path, on_problem=warn):
+    # Yields (line number of the block's first line, {key: value})
+    data = {}
+    current_key = None
+    start = None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line_no, line in enumerate(f, start=1):
+            text = line.strip()
+            if text == SEPARATOR:
+                if data:
+                    yield _finish(path, start, data, on_problem)
+                elif start is not None:
+                    on_problem(PromptFormatError(path, start, "block has no 'Key: value' lines"))
+                data, current_key, start = {}, None, None
+                continue
+            if not text:
+                continue
+            if start is None:
+                start = line_no
+            if ':' in text:
+                key, value = text.split(':', 1)
+                current_key = key.strip()
+                if current_key in data:
+                    on_problem(PromptFormatError(path, line_no, f"'{current_key}' given twice, the last one wins"))
+                data[current_key] = value.strip()
+            elif current_key:
+                data[current_key] += ' ' + text
+            else:
+                on_problem(PromptFormatError(path, line_no, "line outside of any 'Key:' field is ignored"))
+    if data:
+        yield _finish(path, start, data, on_problem)
+
+def iter_prompts(path, on_problem=warn):
+    for _, data in iter_prompt_blocks(path, on_problem):
+        yield data
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# Prompt templates. The Positive/Negative prompt fields may contain
+#   {red|green|blue}       alternation, one option per variation
+#   {3::rain|1::clear}     weighted options (weights bias random sampling)
+#   __hair_colors__        wildcard, one option per line of wildcards/hair_colors.txt
+# and a block may set "Variations: all" (default) or "Variations: <N>" to
+# draw N distinct variations with "Variation seed: <seed>".
+#
+# Every choice point is a digit of a mixed-radix number, so variation k of a
+# block is rendered straight from k without building the other
+# combinations. Variations are named "<Name> v<k+1>", which keeps names
+# stable between runs, and identical renderings are dropped by hash.
+
+import os
+import re
+import random
+import hashlib
+
+from prompt_parser import PromptFormatError, warn
+
+TEMPLATE_FIELDS = ('Positive prompt', 'Negative prompt')
+WILDCARD_DIR = 'wildcards'
+MAX_SAMPLE_ATTEMPTS = 20  # Weighted draws per requested variation before giving up
+
+_SLOT = re.compile(r'\{([^{}]*\|[^{}]*)\}|__([\w\-/]+)__')
+_WEIGHT = re.compile(r'^\s*(\d+(?:\.\d+)?)::(.*)$', re.S)
+
+class PromptTemplateError(ValueError):
+    pass
+
+def parse_option(text):
+    match = _WEIGHT.match(text)
+    if match:
+        return match.group(2).strip(), float(match.group(1))
+    return text.strip(), 1.0
+
+def load_wildcard(name, wildcard_dir, cache):
+    if name not in cache:
+        path = os.path.join(wildcard_dir, name + '.txt')
+        if not os.path.exists(path):
+            raise PromptTemplateError(f"wildcard file {path} not found")
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            options = [parse_option(line) for line in f if line.strip() and not line.lstrip().startswith('#')]
+        if not options:
+            raise PromptTemplateError(f"wildcard file {path} is empty")
+        cache[name] = options
+    return cache[name]
+
+class PromptTemplate:
+    def __init__(self, fields, wildcard_dir=WILDCARD_DIR, cache=None):
+        # fields: {field name: template text}
+        cache = {} if cache is None else cache
+        self.parts = {}  # field -> (literals, first slot number)
+        self.slots = []  # [(options, weights)]
+        for field, text in fields.items():
+            literals = []
+            position = 0
+            first = len(self.slots)
+            for match in _SLOT.finditer(text):
+                literals.append(text[position:match.start()])
+                position = match.end()
+                if match.group(1) is not None:
+                    options = [parse_option(option) for option in match.group(1).split('|')]
+                else:
+                    options = load_wildcard(match.group(2), wildcard_dir, cache)
+                self.slots.append(([option for option, _ in options], [weight for _, weight in options]))
+            literals.append(text[position:])
+            self.parts[field] = (literals, first)
+        self.size = 1
+        for options, _ in self.slots:
+            self.size *= len(options)
+        self.weighted = any(len(set(weights)) > 1 for _, weights in self.slots)
+
+    def choices(self, index):
+        # Mixed-radix digits of `index`, the last slot varying fastest
+        digits = [0] * len(self.slots)
+        for n in range(len(self.slots) - 1, -1, -1):
+            index, digits[n] = divmod(index, len(self.slots[n][0]))
+        return digits
+
+    def render(self, index):
+        digits = self.choices(index)
+        rendered = {}
+        for field, (literals, first) in self.parts.items():
+            text = literals[0]
+            for n, literal in enumerate(literals[1:]):
+                text += self.slots[first + n][0][digits[first + n]] + literal
+            rendered[field] = ' '.join(text.split())
+        return rendered
+
+    def indices(self, variations=None, seed=0):
+        # All indices in order, or `variations` distinct ones drawn with `seed`
+        if variations is None or variations >= self.size:
+            return iter(range(self.size))
+        rng = random.Random(seed)
+        if not self.weighted:
+            return iter(rng.sample(range(self.size), variations))
+        return self._weighted_indices(variations, rng)
+
+    def _weighted_indices(self, variations, rng):
+        seen = set()
+        for _ in range(variations * MAX_SAMPLE_ATTEMPTS):
+            index = 0
+            for options, weights in self.slots:
+                index = index * len(options) + rng.choices(range(len(options)), weights)[0]
+            if index not in seen:
+                seen.add(index)
+                yield index
+                if len(seen) == variations:
+                    return
+
+def is_template(data):
+    return any(_SLOT.search(data.get(field, '')) for field in TEMPLATE_FIELDS)
+
+def parse_variations(data):
+    value = str(data.get('Variations', 'all')).strip().lower()
+    if value in ('', 'all'):
+        return None
+    try:
+        variations = int(value)
+    except ValueError:
+        raise PromptTemplateError(f"'Variations' must be a number or 'all', got {data['Variations']!r}")
+    if variations < 1:
+        raise PromptTemplateError("'Variations' must be at least 1")
+    return variations
+
+def parse_variation_seed(data):
+    value = str(data.get('Variation seed', 0)).strip()
+    if value == '':
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        raise PromptTemplateError(f"'Variation seed' must be a number, got {data['Variation seed']!r}")
+
+def block_template(data, wildcard_dir=WILDCARD_DIR, cache=None):
+    fields = {field: data[field] for field in TEMPLATE_FIELDS if field in data}
+    return PromptTemplate(fields, wildcard_dir, cache)
+
+def expand_block(data, wildcard_dir=WILDCARD_DIR, cache=None):
+    # Yields the data dict of every distinct variation of one block
+    if not is_template(data):
+        yield data
+        return
+    template = block_template(data, wildcard_dir, cache)
+    variations = parse_variations(data)
+    seed = parse_variation_seed(data)
+    base = {k: v for k, v in data.items() if k not in ('Variations', 'Variation seed')}
+    name = data.get('Name', 'Unnamed')
+    seen = set()
+    for index in template.indices(variations, seed):
+        rendered = template.render(index)
+        digest = hashlib.blake2b('\0'.join(rendered.get(field, '') for field in TEMPLATE_FIELDS).encode('utf-8'), digest_size=8).digest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        variation = dict(base)
+        variation.update(rendered)
+        variation['Name'] = f"{name} v{index + 1}"
+        yield variation
+
+def expand_blocks(blocks, path, folder_path='', on_problem=warn):
+    # blocks: (line number, data) pairs from prompt_parser.iter_prompt_blocks
+    wildcard_dir = os.path.join(folder_path, WILDCARD_DIR)
+    cache = {}
+    for line_no, data in blocks:
+        try:
+            yield from expand_block(data, wildcard_dir, cache)
+        except PromptTemplateError as e:
+            on_problem(PromptFormatError(path, line_no, f"{e}; block skipped"))
+
+def count_variations(data, folder_path='', cache=None):
+    # Number of prompts a block expands to (before removing duplicates)
+    if not is_template(data):
+        return 1
+    template = block_template(data, os.path.join(folder_path, WILDCARD_DIR), cache)
+    variations = parse_variations(data)
+    return template.size if variations is None else min(variations, template.size)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Headless runs. A run spec (JSON, or YAML when PyYAML is installed) lists
+# one or more stories plus the generation settings that are otherwise asked
+# for interactively; command-line flags override the spec. Every story is
+# checked against the models, samplers, schedulers and LoRAs the backend
+# reports before anything is generated, and the process exits with one of
+# the EXIT_* codes so cron or a job runner can act on the outcome.
+#
+#   {
+#       "defaults": {"model": "dreamshaper_8.safetensors", "sampling_method": "Euler a",
+#                    "scheduler": "Karras", "sampling_steps": 30, "seed": 42},
+#       "stories": [
+#           "Chapter_1",
+#           {"name": "Chapter_2", "prompts_dir": "chapter2", "width": 768, "mode": "resume"}
+#       ]
+#   }
+
+import os
+import json
+
+from lazy_imports import lazy_import
+from sd_client import get_client
+
+requests = lazy_import('requests')
+
+EXIT_OK = 0
+EXIT_IMAGES_FAILED = 1  # The run finished, but some images could not be generated
+EXIT_INVALID_SPEC = 2  # Bad spec/flags or values the backend does not offer
+EXIT_BACKEND_DOWN = 3  # No web UI reachable
+EXIT_INTERRUPTED = 130
+
+# Keys of a story's settings.json, with the defaults of the interactive prompts
+SETTING_DEFAULTS = {
+    'model': None,
+    'lora': '',
+    'lora_weight': 1.0,
+    'sampling_method': None,
+    'scheduler': None,
+    'sampling_steps': 50,
+    'width': 512,
+    'height': 768,
+    'cfg_scale': 7.5,
+    'seed': -1,
+}
+SETTING_TYPES = {'lora_weight': float, 'sampling_steps': int, 'width': int, 'height': int, 'cfg_scale': float, 'seed': int}
+STORY_KEYS = ('name', 'prompts_dir', 'output_dir', 'mode', 'num_images', 'num_iterations')
+MODES = ('all', 'resume', 'replay')
+
+class SpecError(ValueError):
+    pass
+
+def add_spec_arguments(parser):
+    group = parser.add_argument_group('headless runs', 'Giving --spec or --story runs without any prompts')
+    group.add_argument('--spec', help='JSON or YAML run spec with the stories and settings to generate')
+    group.add_argument('--story', action='append', default=[], help='Story to generate (repeatable); added to the spec stories')
+    group.add_argument('--prompts-dir', help='Directory holding characters.txt and scenes.txt')
+    group.add_argument('--output-dir', help='Directory the story folders are created in')
+    group.add_argument('--model', help='Checkpoint file or title')
+    group.add_argument('--lora', help='LoRA file name (empty for none)')
+    group.add_argument('--lora-weight', type=float)
+    group.add_argument('--sampler', dest='sampling_method')
+    group.add_argument('--scheduler')
+    group.add_argument('--steps', dest='sampling_steps', type=int)
+    group.add_argument('--width', type=int)
+    group.add_argument('--height', type=int)
+    group.add_argument('--cfg-scale', type=float)
+    group.add_argument('--seed', type=int)
+    group.add_argument('--num-images', type=int, help='Images per iteration (stories created from scratch)')
+    group.add_argument('--num-iterations', type=int, help='Iterations per item (stories created from scratch)')
+
+def is_headless(args):
+    return bool(args.spec or args.story)
+
+def load_spec_file(path):
+    if not os.path.exists(path):
+        raise SpecError(f"Run spec {path} not found.")
+    with open(path, 'r') as f:
+        text = f.read()
+    if path.lower().endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise SpecError("YAML run specs need PyYAML (pip install pyyaml); a JSON spec works without it.")
+        try:
+            spec = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise SpecError(f"Could not parse {path}: {e}")
+    else:
+        try:
+            spec = json.loads(text)
+        except ValueError as e:
+            raise SpecError(f"Could not parse {path}: {e}")
+    if not isinstance(spec, dict):
+        raise SpecError(f"{path} must contain a mapping with 'defaults' and 'stories'.")
+    return spec
+
+def coerce_settings(values, where):
+    settings = {}
+    for key, value in values.items():
+        if key in STORY_KEYS:
+            continue
+        if key not in SETTING_DEFAULTS:
+            raise SpecError(f"{where}: unknown setting '{key}'.")
+        if key in SETTING_TYPES and value is not None:
+            try:
+                value = SETTING_TYPES[key](value)
+            except (TypeError, ValueError):
+                raise SpecError(f"{where}: '{key}' must be a number, got {value!r}.")
+        settings[key] = '' if key == 'lora' and value is None else value
+    return settings
+
+def cli_overrides(args):
+    return {key: getattr(args, key) for key in SETTING_DEFAULTS if getattr(args, key, None) is not None}
+
+def build_stories(args):
+    # Returns the story dicts of the run in order: name, prompts_dir,
+    # output_dir, mode, num_images, num_iterations and (partial) settings
+    spec = load_spec_file(args.spec) if args.spec else {}
+    defaults = spec.get('defaults') or {}
+    if not isinstance(defaults, dict):
+        raise SpecError("'defaults' must be a mapping.")
+    defaults = coerce_settings(defaults, 'defaults')
+    entries = list(spec.get('stories') or []) + list(args.story)
+    if not entries:
+        raise SpecError("The run spec does not list any stories.")
+
+    overrides = cli_overrides(args)
+    stories = []
+    for n, entry in enumerate(entries, start=1):
+        if isinstance(entry, str):
+            entry = {'name': entry}
+        if not isinstance(entry, dict) or not str(entry.get('name') or '').strip():
+            raise SpecError(f"Story #{n} needs a name.")
+        name = str(entry['name']).strip()
+        mode = entry.get('mode', 'all')
+        if mode not in MODES:
+            raise SpecError(f"Story {name}: mode must be one of {', '.join(MODES)}.")
+        settings = dict(defaults)
+        settings.update(coerce_settings(entry, f"Story {name}"))
+        settings.update(overrides)
+        stories.append({
+            'name': name,
+            'prompts_dir': args.prompts_dir or entry.get('prompts_dir') or spec.get('prompts_dir') or '',
+            'output_dir': args.output_dir or entry.get('output_dir') or spec.get('output_dir') or '',
+            'mode': mode,
+            'num_images': int(args.num_images or entry.get('num_images') or spec.get('num_images') or 1),
+            'num_iterations': int(args.num_iterations or entry.get('num_iterations') or spec.get('num_iterations') or 1),
+            'settings': settings,
+        })
+    names = [os.path.join(story['output_dir'], story['name']) for story in stories]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise SpecError(f"Stories listed more than once: {', '.join(duplicates)}.")
+    return stories
+
+def resolve_settings(story, saved=None):
+    # Settings saved by an earlier session are the base, the spec wins
+    settings = dict(SETTING_DEFAULTS)
+    settings.update(saved or {})
+    settings.update(story['settings'])
+    return settings
+
+def fetch_backend_options(endpoint):
+    # Names the backend accepts; None where the endpoint is not available
+    client = get_client(endpoint)
+    options = {}
+    for key, path in (('models', '/sdapi/v1/sd-models'), ('samplers', '/sdapi/v1/samplers'),
+                      ('schedulers', '/sdapi/v1/schedulers'), ('loras', '/sdapi/v1/loras')):
+        try:
+            response = client.get(path, retries=0)
+            response.raise_for_status()
+            options[key] = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            options[key] = None
+    return options
+
+def model_names(entry):
+    names = {entry.get('title'), entry.get('model_name'), entry.get('name')}
+    if entry.get('title'):
+        names.add(entry['title'].split(' [')[0])  # "name.safetensors [hash]"
+    if entry.get('filename'):
+        names.add(os.path.basename(entry['filename'].replace('\\', '/')))
+    names.discard(None)
+    return names
+
+def lora_names(entry):
+    names = {entry.get('name'), entry.get('alias')}
+    if entry.get('path'):
+        base = os.path.basename(entry['path'].replace('\\', '/'))
+        names.update((base, os.path.splitext(base)[0]))
+    names.discard(None)
+    return names
+
+def validate_settings(settings, options, where):
+    errors = []
+    for key in ('model', 'sampling_method', 'scheduler'):
+        if not settings.get(key):
+            errors.append(f"{where}: '{key}' is required.")
+    for key in ('sampling_steps', 'width', 'height'):
+        if settings.get(key) is not None and settings[key] <= 0:
+            errors.append(f"{where}: '{key}' must be positive.")
+    for key in ('width', 'height'):
+        if settings.get(key) and settings[key] % 8:
+            errors.append(f"{where}: '{key}' must be a multiple of 8.")
+    if settings.get('cfg_scale') is not None and settings['cfg_scale'] < 1:
+        errors.append(f"{where}: 'cfg_scale' must be at least 1.")
+
+    if options.get('models') is not None and settings.get('model'):
+        known = set().union(*(model_names(entry) for entry in options['models'])) if options['models'] else set()
+        model = settings['model']
+        if model not in known and model.split(' [')[0] not in known:
+            errors.append(f"{where}: model '{model}' is not available on the backend.")
+    for key, option in (('sampling_method', 'samplers'), ('scheduler', 'schedulers')):
+        if options.get(option) is not None and settings.get(key):
+            known = set()
+            for entry in options[option]:
+                known.update([entry.get('name'), entry.get('label')] + list(entry.get('aliases') or []))
+            if settings[key] not in known:
+                errors.append(f"{where}: {option[:-1]} '{settings[key]}' is not available on the backend.")
+    if options.get('loras') is not None and settings.get('lora'):
+        known = set().union(*(lora_names(entry) for entry in options['loras'])) if options['loras'] else set()
+        if settings['lora'] not in known and os.path.splitext(settings['lora'])[0] not in known:
+            errors.append(f"{where}: LoRA '{settings['lora']}' is not available on the backend.")
+    return errors
+
+def print_spec_errors(errors, heading="The run spec is not valid:"):
+    print(f"\n{heading}")
+    for error in errors:
+        print(f"  {error}")
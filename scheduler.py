@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Priority and dependency ordering of a story's jobs. A prompt.json (or a
+# block of the prompt files) may set
+#   "Priority": 5           higher goes first, default 0
+#   "DependsOn": ["Hero"]   items whose images must all be finished (or
+#                           failed) before this item starts; a name means
+#                           the character and the scene of that name,
+#                           "Characters/Hero" or "Scenes/Hero" only one
+# Jobs that are ready wait in a heap ordered by priority and, within one
+# priority, by the checkpoint-affinity plan, so equal priorities cost no
+# extra model switches. A job whose dependencies are unfinished waits
+# outside the heap until their last image is accounted for. Jobs are handed
+# out one at a time, when a backend asks for work, so a priority changed
+# mid-run (python main.py --control priority ITEM N) applies to every job
+# not handed out yet. Dependencies that form a cycle are given up once
+# nothing else is left to run.
+
+import heapq
+import threading
+
+DEFAULT_PRIORITY = 0.0
+TYPE_FOLDERS = {'Characters': 'character', 'Scenes': 'scene'}
+
+def item_priority(data):
+    try:
+        return float(data.get('Priority') or DEFAULT_PRIORITY)
+    except (TypeError, ValueError):
+        print(f"Ignoring Priority {data.get('Priority')!r}: not a number.")
+        return DEFAULT_PRIORITY
+
+def item_dependencies(data):
+    # Item names as in the story folders; a prompt file gives them comma-separated
+    depends = data.get('DependsOn') or []
+    if isinstance(depends, str):
+        depends = depends.split(',')
+    return [str(name).strip().replace(' ', '_') for name in depends if str(name).strip()]
+
+def job_item(job):
+    # A character and a scene may share a name, so items are told apart by type too
+    return (job['prompt_type'], job['item_name'])
+
+def matching_items(name, items):
+    # The items of `items` a DependsOn or --control name refers to
+    folder, _, item_name = name.rpartition('/')
+    prompt_type = TYPE_FOLDERS.get(folder)
+    return [item for item in items if item[1] == item_name and (prompt_type is None or item[0] == prompt_type)]
+
+def item_label(item, items):
+    # The item name, with its folder when a character and a scene share it
+    if len(matching_items(item[1], items)) > 1:
+        folder = next(folder for folder, prompt_type in TYPE_FOLDERS.items() if prompt_type == item[0])
+        return f"{folder}/{item[1]}"
+    return item[1]
+
+def resolve_dependencies(job, items):
+    # (dependencies among `items`, names that match none of them)
+    own = job_item(job)
+    depends, unknown = [], []
+    for name in job.get('depends_on', []):
+        matches = [item for item in matching_items(name, items) if item != own]
+        if matches:
+            depends += [item for item in matches if item not in depends]
+        else:
+            unknown.append(name)
+    return depends, unknown
+
+def image_keys(job):
+    return {(job['iteration'], index) for index in job['indices']}
+
+class JobScheduler:
+    def __init__(self, jobs):
+        self.cond = threading.Condition()
+        self.priorities = {}  # (prompt_type, item name) -> priority
+        self.depends = {}  # (prompt_type, item name) -> items it waits for
+        self.outstanding = {}  # (prompt_type, item name) -> image keys not finished yet
+        self.active = set()  # (item, image key) handed out and not finished yet
+        self.ready = []  # Heap of (-priority, position in the plan, job)
+        self.blocked = []  # (position in the plan, job) waiting for dependencies
+        self.handed_out = 0
+        for job in jobs:
+            item = job_item(job)
+            self.priorities.setdefault(item, job.get('priority', DEFAULT_PRIORITY))
+            self.outstanding.setdefault(item, set()).update(image_keys(job))
+        for job in jobs:
+            item = job_item(job)
+            if item not in self.depends:
+                self.depends[item], unknown = resolve_dependencies(job, self.outstanding)
+                if unknown:
+                    print(f"{item_label(item, self.outstanding)} depends on {', '.join(unknown)}, which has nothing to generate in this run.")
+        for position, job in enumerate(jobs):
+            if self._is_ready(job):
+                self.ready.append((-self.priorities[job_item(job)], position, job))
+            else:
+                self.blocked.append((position, job))
+        heapq.heapify(self.ready)
+
+    def _is_ready(self, job):
+        return not any(self.outstanding[item] for item in self.depends[job_item(job)])
+
+    def _release(self, force=False):
+        # Moves the jobs whose dependencies are done (all of them when forced) into the heap
+        still_blocked = []
+        for position, job in self.blocked:
+            if force or self._is_ready(job):
+                heapq.heappush(self.ready, (-self.priorities[job_item(job)], position, job))
+            else:
+                still_blocked.append((position, job))
+        self.blocked = still_blocked
+
+    def jobs(self, wait_running=lambda: True):
+        # The jobs in schedule order; waits while everything left depends on
+        # work in progress. wait_running blocks while paused and returns
+        # False to stop.
+        while wait_running():
+            with self.cond:
+                if not self.ready:
+                    if not self.blocked:
+                        return
+                    if self.active:
+                        self.cond.wait()
+                        continue
+                    items = sorted({item_label(job_item(job), self.priorities) for _, job in self.blocked})
+                    print(f"\nDependency cycle among {', '.join(items)}; their dependencies are ignored.")
+                    self._release(force=True)
+                job = heapq.heappop(self.ready)[2]
+                self.active |= {(job_item(job), key) for key in image_keys(job)}
+                self.handed_out += 1
+            yield job
+
+    def finished(self, job, indices):
+        # Images of a job that were written, failed or dropped
+        item = job_item(job)
+        keys = {(job['iteration'], index) for index in indices}
+        with self.cond:
+            if item not in self.outstanding:
+                return
+            was_outstanding = bool(self.outstanding[item])
+            self.outstanding[item] -= keys
+            self.active -= {(item, key) for key in keys}
+            if was_outstanding and not self.outstanding[item] and self.blocked:
+                self._release()
+            self.cond.notify_all()
+
+    def reprioritize(self, name, priority):
+        # False when no item of that name has jobs in this run
+        with self.cond:
+            items = matching_items(name, self.priorities)
+            if not items:
+                return False
+            for item in items:
+                self.priorities[item] = priority
+            self.ready = [(-self.priorities[job_item(job)], position, job) for _, position, job in self.ready]
+            heapq.heapify(self.ready)
+            self.cond.notify_all()
+        print(f"\n{name} now has priority {priority:g}.")
+        return True
+
+    def wake(self):
+        # Lets a waiting jobs() see a pause or cancel
+        with self.cond:
+            self.cond.notify_all()
+
+    def drain(self):
+        # The whole schedule at once, as if every job finished as soon as it
+        # was handed out (for the job queue, which keeps the order it is given)
+        order = []
+        for job in self.jobs():
+            self.finished(job, job['indices'])
+            order.append(job)
+        return order
+
+def print_schedule(scheduler):
+    items = scheduler.priorities
+    prioritized = sorted(((priority, item_label(item, items)) for item, priority in items.items() if priority != DEFAULT_PRIORITY),
+                         reverse=True)
+    dependent = sorted((item_label(item, items), [item_label(depend, items) for depend in depends])
+                       for item, depends in scheduler.depends.items() if depends)
+    if prioritized:
+        print("Priorities: " + ', '.join(f"{item} ({priority:g})" for priority, item in prioritized))
+    if dependent:
+        print("Dependencies: " + ', '.join(f"{item} after {', '.join(depends)}" for item, depends in dependent))
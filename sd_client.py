@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Shared HTTP client for the Automatic1111 API. One SDClient per endpoint
+# keeps a keep-alive connection pool, applies connect/read timeouts, retries
+# connection resets and 5xx answers with jittered exponential backoff, and
+# records per-call latency. classify_error() sorts failed requests into
+# the kinds the retry logic in degradation.py acts on.
+
+import time
+import random
+import threading
+
+from lazy_imports import lazy_import
+
+requests = lazy_import('requests')
+
+DEFAULT_OPTIONS = {
+    'connect_timeout': 5.0,
+    'read_timeout': 600.0,  # A large n_iter batch can legitimately take minutes
+    'retries': 3,
+    'backoff': 1.0,
+    'pool_size': 8,
+}
+
+OOM_MARKERS = ('out of memory', 'outofmemoryerror', 'cuda error: out of memory')
+MODEL_LOAD_MARKERS = ('error(s) in loading state_dict', 'safetensorerror', 'failed to load checkpoint',
+                      'checkpoint not found', 'could not find checkpoint', 'error loading model')
+
+# Kinds of failed requests
+ERROR_OOM = 'oom'
+ERROR_MODEL_LOAD = 'model_load'
+ERROR_TIMEOUT = 'timeout'
+ERROR_BAD_REQUEST = 'bad_request'
+ERROR_BACKEND = 'backend'  # Anything else: connection errors, other 5xx, broken responses
+
+_clients = {}
+_clients_lock = threading.Lock()
+_options = dict(DEFAULT_OPTIONS)
+
+class SDClient:
+    def __init__(self, endpoint, connect_timeout=5.0, read_timeout=600.0, retries=3, backoff=1.0, pool_size=8):
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stats_lock = threading.Lock()
+        self.latency = {}  # path -> {'calls', 'errors', 'retries', 'total', 'max'}
+
+    def _record(self, path, elapsed, error, retried):
+        with self.stats_lock:
+            entry = self.latency.setdefault(path, {'calls': 0, 'errors': 0, 'retries': 0, 'total': 0.0, 'max': 0.0})
+            entry['calls'] += 1
+            entry['errors'] += 1 if error else 0
+            entry['retries'] += retried
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+
+    def _sleep_before_retry(self, attempt):
+        # Full jitter keeps several workers from hammering a recovering backend in lockstep
+        delay = self.backoff * (2 ** attempt)
+        time.sleep(random.uniform(0, delay))
+
+    def request(self, method, path, timeout=None, retries=None, **kwargs):
+        url = self.endpoint + path
+        retries = self.retries if retries is None else retries
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                # Read timeouts are not retried: the backend may still be rendering the job
+                if isinstance(e, requests.exceptions.ReadTimeout) or attempt >= retries:
+                    self._record(path, time.perf_counter() - start, True, attempt)
+                    raise
+            else:
+                # Retrying an out-of-memory failure with the same payload cannot succeed
+                if response.status_code < 500 or attempt >= retries or is_oom_error(response.text):
+                    self._record(path, time.perf_counter() - start, response.status_code >= 400, attempt)
+                    return response
+                response.close()
+            self._sleep_before_retry(attempt)
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def stats(self):
+        with self.stats_lock:
+            return {path: dict(entry) for path, entry in self.latency.items()}
+
+    def close(self):
+        self.session.close()
+
+def is_oom_error(text):
+    # The web UI reports CUDA OOM as a 500 whose body carries the torch error
+    text = (text or '').lower()
+    return any(marker in text for marker in OOM_MARKERS)
+
+def classify_error(error):
+    # Kind of a failed request from its exception and, for HTTP errors, the response body
+    if isinstance(error, requests.exceptions.Timeout):
+        return ERROR_TIMEOUT
+    response = getattr(error, 'response', None)
+    text = f"{error} {response.text if response is not None else ''}"
+    if is_oom_error(text):
+        return ERROR_OOM
+    if any(marker in text.lower() for marker in MODEL_LOAD_MARKERS):
+        return ERROR_MODEL_LOAD
+    if response is not None and 400 <= response.status_code < 500:
+        return ERROR_BAD_REQUEST
+    return ERROR_BACKEND
+
+def configure_clients(sd_settings):
+    # Timeouts and retry policy may be tuned in sd_settings.json
+    for key in DEFAULT_OPTIONS:
+        if key in sd_settings:
+            _options[key] = type(DEFAULT_OPTIONS[key])(sd_settings[key])
+
+def get_client(endpoint):
+    endpoint = endpoint.rstrip('/')
+    with _clients_lock:
+        client = _clients.get(endpoint)
+        if client is None:
+            client = SDClient(endpoint, **_options)
+            _clients[endpoint] = client
+        return client
+
+def all_clients():
+    with _clients_lock:
+        return list(_clients.values())
+
+def print_latency_report():
+    for client in all_clients():
+        for path, entry in sorted(client.stats().items()):
+            avg = entry['total'] / entry['calls'] if entry['calls'] else 0.0
+            print(f"{client.endpoint}{path}: {entry['calls']} calls, {entry['errors']} errors, "
+                  f"{entry['retries']} retries, avg {avg:.2f}s, max {entry['max']:.2f}s")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Shared-filesystem transfer mode. When the web UI's output folder is
+# reachable from here (same host, or sd_folder on shared storage), txt2img
+# is asked to save the images itself (save_images) and to send none back
+# (send_images false), which saves the base64 encoding, a third more bytes
+# on the wire and the decoding on both ends. The finished files are found
+# in the web UI's txt2img output folder by the seeds reported in "info" and
+# moved into the story's Iteration_N directory. The seed is read from the
+# [seed] field of the backend's samples_filename_pattern, so digits in a
+# prompt or model name are never taken for it; when free text comes before
+# [seed] in the pattern, the "parameters" text of the PNG decides. Two requests with a fixed
+# seed save files with the same seeds, so a backend gets one request at a
+# time until its files are collected. Backends whose output folder is not
+# visible, or whose file names do not contain the seed, keep using base64
+# transfer.
+
+import os
+import re
+import time
+import struct
+import threading
+
+from lazy_imports import lazy_import
+from sd_client import get_client
+from output_cache import link_or_copy
+
+requests = lazy_import('requests')
+
+DEFAULT_OUTDIR = os.path.join('outputs', 'txt2img-images')
+CLOCK_SKEW = 120  # Seconds a shared file server's clock may run behind ours
+FIND_TIMEOUT = 5.0  # Seconds to wait for files to show up on a network share
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_FIELD = re.compile(r'(\[[^\]]*\])')
+_INFO_SEED = re.compile(rb'\bSeed: (\d+)')
+
+def move_file(src, dest):
+    # A rename when both are on one file system, otherwise link or copy
+    try:
+        os.replace(src, dest)
+    except OSError:
+        link_or_copy(src, dest)
+        os.remove(src)
+
+def file_name_regex(pattern, save_to_dirs=True, add_number=True):
+    # Matches the start of the file names the web UI saves with `pattern`,
+    # "<number>-<pattern>" by default, up to the seed and what follows it;
+    # the second value tells whether free text comes before the seed
+    pattern = pattern or ('[seed]' if save_to_dirs else '[seed]-[prompt_spaces]')
+    parts = [part for part in _FIELD.split(os.path.basename(pattern)) if part]
+    seed_at = parts.index('[seed]')
+    regex = r'\d+-' if add_number else ''
+    for part in parts[:seed_at]:
+        regex += '.*?' if _FIELD.fullmatch(part) else re.escape(part)
+    regex += r'(?P<seed>\d+)'
+    following = parts[seed_at + 1] if seed_at + 1 < len(parts) else None
+    if following is None:
+        regex += r'\.'
+    elif _FIELD.fullmatch(following):
+        regex += r'(?!\d)'
+    else:
+        regex += re.escape(following)
+    return re.compile(regex), any(_FIELD.fullmatch(part) for part in parts[:seed_at])
+
+def png_info_seed(path):
+    # The seed in the generation parameters the web UI writes into a PNG
+    # text chunk, or None; stops at the image data
+    try:
+        with open(path, 'rb') as f:
+            if f.read(8) != PNG_SIGNATURE:
+                return None
+            while True:
+                head = f.read(8)
+                if len(head) < 8:
+                    return None
+                length, kind = struct.unpack('>I4s', head)
+                if kind == b'IDAT' or kind == b'IEND':
+                    return None
+                data = f.read(length + 4)[:length]
+                if kind in (b'tEXt', b'iTXt') and data.startswith(b'parameters\0'):
+                    match = _INFO_SEED.search(data)
+                    return int(match.group(1)) if match else None
+    except OSError:
+        return None
+
+class SharedOutput:
+    def __init__(self, sd_folder):
+        self.sd_folder = sd_folder
+        self.lock = threading.Lock()
+        self.dirs = {}  # endpoint -> local path of its txt2img output folder, None when not shared
+        self.names = {}  # output folder -> (file name regex, read seeds from PNG info), see file_name_regex()
+        self.busy = {}  # endpoint -> lock held from a request until its files are collected
+        self.images = 0
+        self.bytes = 0
+        self.fallbacks = 0
+
+    def output_dir(self, endpoint):
+        # Probed once per backend through /sdapi/v1/options
+        with self.lock:
+            if endpoint in self.dirs:
+                return self.dirs[endpoint]
+        output_dir, names, reason = self._probe(endpoint)
+        with self.lock:
+            if endpoint not in self.dirs:
+                users = [other for other, used in self.dirs.items() if used == output_dir]
+                if output_dir is not None and users:
+                    # Files are told apart by seed only, which two backends may share
+                    output_dir, reason = None, f"its output folder is also used by {users[0]}"
+                self.dirs[endpoint] = output_dir
+                if output_dir is not None:
+                    self.names[output_dir] = names
+                if output_dir is None:
+                    print(f"{endpoint}: using base64 transfer ({reason}).")
+                else:
+                    print(f"{endpoint}: images are picked up from {output_dir}.")
+            return self.dirs[endpoint]
+
+    def _probe(self, endpoint):
+        try:
+            response = get_client(endpoint).get('/sdapi/v1/options')
+            response.raise_for_status()
+            options = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return None, None, f"could not read its options: {e}"
+        if (options.get('samples_format') or 'png').lower() != 'png':
+            return None, None, f"it saves {options['samples_format']} files"
+        pattern = options.get('samples_filename_pattern') or ''
+        if pattern and '[seed]' not in os.path.basename(pattern):
+            return None, None, "its file name pattern does not contain [seed]"
+        name_regex, ambiguous = file_name_regex(pattern, options.get('save_to_dirs', True),
+                                                options.get('save_images_add_number', True))
+        names = (name_regex, ambiguous and options.get('enable_pnginfo', True))
+        output_dir = options.get('outdir_samples') or options.get('outdir_txt2img_samples') or DEFAULT_OUTDIR
+        if not os.path.isabs(output_dir):
+            output_dir = os.path.join(self.sd_folder, output_dir)
+        if not os.path.isdir(output_dir):
+            return None, None, f"its output folder {output_dir} is not visible here"
+        return output_dir, names, None
+
+    def disable(self, endpoint, reason):
+        with self.lock:
+            self.dirs[endpoint] = None
+            self.fallbacks += 1
+        print(f"{endpoint}: falling back to base64 transfer ({reason}).")
+
+    def acquire(self, endpoint):
+        with self.lock:
+            busy = self.busy.setdefault(endpoint, threading.Lock())
+        busy.acquire()
+
+    def release(self, endpoint):
+        self.busy[endpoint].release()
+
+    def request_payload(self, payload):
+        return dict(payload, save_images=True, send_images=False)
+
+    def _candidates(self, output_dir, since):
+        # Recent PNGs in the output folder and its (date) subfolders, newest
+        # first, as {seed: [path, ...]}
+        name_regex, from_info = self.names[output_dir]
+        found = []
+        folders = [output_dir]
+        for entry in os.scandir(output_dir):
+            if entry.is_dir() and entry.stat().st_mtime >= since - CLOCK_SKEW:
+                folders.append(entry.path)
+        for folder in folders:
+            for entry in os.scandir(folder):
+                if entry.name.endswith('.png') and entry.is_file():
+                    mtime = entry.stat().st_mtime
+                    if mtime >= since - CLOCK_SKEW:
+                        found.append((mtime, entry.path))
+        candidates = {}
+        for _, path in sorted(found, reverse=True):
+            match = name_regex.match(os.path.basename(path))
+            if match is None:
+                continue
+            seed = png_info_seed(path) if from_info else None
+            candidates.setdefault(seed if seed is not None else int(match.group('seed')), []).append(path)
+        return candidates
+
+    def collect(self, output_dir, seeds, dests, since):
+        # Moves the newest file of every seed to its destination; returns
+        # the positions of `dests` that were filled
+        moved = []
+        deadline = time.monotonic() + FIND_TIMEOUT
+        while True:
+            candidates = self._candidates(output_dir, since)
+            for n, (seed, dest) in enumerate(zip(seeds, dests)):
+                if n in moved or not candidates.get(seed):
+                    continue
+                path = candidates[seed].pop(0)
+                size = os.path.getsize(path)
+                move_file(path, dest)
+                moved.append(n)
+                with self.lock:
+                    self.images += 1
+                    self.bytes += size
+            if len(moved) == len(dests) or time.monotonic() > deadline:
+                return sorted(moved)
+            time.sleep(0.2)
+
+def print_shared_output_report(shared):
+    print(f"\nShared output: {shared.images} images moved from the web UI's output folders "
+          f"({shared.bytes / 1024 / 1024:.1f} MiB not sent as base64), {shared.fallbacks} fallbacks to base64.")
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Incremental decoder for txt2img responses. The body is scanned as it
+# arrives; every element of the top-level "images" array is base64-decoded
+# in slices straight into its own output file, so only one network chunk
+# is held in memory at a time no matter how many images are in the batch.
+# All other top-level values (parameters, info) are small and are parsed
+# normally once complete.
+
+import json
+import base64
+import binascii
+
+CHUNK_SIZE = 256 * 1024
+
+class StreamDecodeError(ValueError):
+    pass
+
+class Txt2ImgStreamParser:
+    def __init__(self, open_image, on_image_done=None):
+        # open_image(index) returns a writable binary file for image `index`
+        self.open_image = open_image
+        self.on_image_done = on_image_done
+        self.state = 'start'
+        self.buffer = b''
+        self.key = None
+        self.value = bytearray()
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.fields = {}
+        self.image_count = 0
+        self.image_file = None
+        self.image_head = False  # Nothing of the current image seen yet
+        self.b64_tail = b''
+        self.bytes_received = 0
+
+    def feed(self, chunk):
+        self.bytes_received += len(chunk)
+        data = self.buffer + chunk if self.buffer else chunk
+        self.buffer = b''
+        pos = 0
+        end = len(data)
+        while pos < end:
+            state = self.state
+            if state == 'image':
+                pos = self._feed_image(data, pos)
+                continue
+            c = data[pos:pos + 1]
+            if state == 'value':
+                pos = self._feed_value(data, pos)
+                continue
+            if c in b' \t\r\n':
+                pos += 1
+                continue
+            if state == 'start':
+                self._expect(c, b'{')
+                self.state = 'key_or_end'
+            elif state in ('key_or_end', 'key'):
+                if c == b'}' and state == 'key_or_end':
+                    self.state = 'done'
+                elif c == b'"':
+                    close = data.find(b'"', pos + 1)
+                    if close == -1:
+                        # Wait for the rest of the key
+                        self.buffer = data[pos:]
+                        return
+                    self.key = json.loads(data[pos:close + 1])
+                    pos = close
+                    self.state = 'colon'
+                else:
+                    raise StreamDecodeError(f"Unexpected {c!r} while reading a key")
+            elif state == 'colon':
+                self._expect(c, b':')
+                self.state = 'images_start' if self.key == 'images' else 'value'
+                if self.state == 'value':
+                    self.value = bytearray()
+                    self.depth = 0
+            elif state == 'images_start':
+                if c == b'n':
+                    # "images": null
+                    self.state = 'value'
+                    self.value = bytearray()
+                    self.depth = 0
+                    continue
+                self._expect(c, b'[')
+                self.state = 'image_or_end'
+            elif state in ('image_or_end', 'image_next'):
+                if c == b']' and state == 'image_or_end':
+                    self.state = 'after_value'
+                elif c == b'"':
+                    self.image_file = self.open_image(self.image_count)
+                    self.image_head = True
+                    self.b64_tail = b''
+                    self.state = 'image'
+                else:
+                    raise StreamDecodeError(f"Unexpected {c!r} inside the images array")
+            elif state == 'image_sep':
+                if c == b',':
+                    self.state = 'image_next'
+                else:
+                    self._expect(c, b']')
+                    self.state = 'after_value'
+            elif state == 'after_value':
+                if c == b',':
+                    self.state = 'key'
+                else:
+                    self._expect(c, b'}')
+                    self.state = 'done'
+            elif state == 'done':
+                raise StreamDecodeError("Trailing data after the response object")
+            pos += 1
+
+    def _expect(self, c, expected):
+        if c != expected:
+            raise StreamDecodeError(f"Expected {expected!r}, got {c!r}")
+
+    def _feed_image(self, data, pos):
+        close = data.find(b'"', pos)
+        if self.image_head:
+            # A1111 may prefix the data with a data URI header, which can be
+            # split over chunks like anything else
+            head = data[pos:pos + 64] if close == -1 else data[pos:min(close, pos + 64)]
+            if close == -1 and b',' not in head and len(head) < 64 and (head.startswith(b'data:') or b'data:'.startswith(head)):
+                self.buffer = data[pos:]
+                return len(data)
+            self.image_head = False
+            if head.startswith(b'data:') and b',' in head:
+                pos = data.index(b',', pos) + 1
+        segment = data[pos:] if close == -1 else data[pos:close]
+        if b'\\' in segment:
+            if close == -1 and segment.endswith(b'\\'):
+                # Keep a dangling escape for the next chunk
+                self.buffer = b'\\'
+                segment = segment[:-1]
+            segment = segment.replace(b'\\/', b'/')
+        segment = self.b64_tail + segment
+        usable = len(segment) - len(segment) % 4 if close == -1 else len(segment)
+        self.b64_tail = segment[usable:]
+        if usable:
+            try:
+                self.image_file.write(base64.b64decode(segment[:usable]))
+            except binascii.Error as e:
+                raise StreamDecodeError(f"Invalid base64 in image {self.image_count + 1}: {e}")
+        if close == -1:
+            return len(data)
+        self.image_file.close()
+        self.image_file = None
+        self.image_count += 1
+        if self.on_image_done is not None:
+            self.on_image_done(self.image_count)
+        self.state = 'image_sep'
+        return close + 1
+
+    def _feed_value(self, data, pos):
+        # Collect one JSON value (any type) until it is closed at depth 0
+        start = pos
+        end = len(data)
+        while pos < end:
+            c = data[pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == 0x5c:  # backslash
+                    self.escaped = True
+                elif c == 0x22:  # quote
+                    self.in_string = False
+                    if self.depth == 0:
+                        pos += 1
+                        return self._finish_value(data, start, pos)
+            elif c == 0x22:
+                self.in_string = True
+            elif c in (0x7b, 0x5b):  # { [
+                self.depth += 1
+            elif c in (0x7d, 0x5d):  # } ]
+                if self.depth == 0:
+                    return self._finish_value(data, start, pos)
+                self.depth -= 1
+                if self.depth == 0:
+                    pos += 1
+                    return self._finish_value(data, start, pos)
+            elif c == 0x2c and self.depth == 0:  # , ends a scalar
+                return self._finish_value(data, start, pos)
+            pos += 1
+        self.value += data[start:end]
+        return end
+
+    def _finish_value(self, data, start, pos):
+        self.value += data[start:pos]
+        self.fields[self.key] = json.loads(bytes(self.value))
+        self.value = bytearray()
+        self.state = 'after_value'
+        return pos
+
+    def close(self):
+        if self.state != 'done':
+            raise StreamDecodeError("Response ended before the JSON object was complete")
+        self.fields['images'] = self.image_count
+        return self.fields
+
+def stream_txt2img_response(response, open_image, on_image_done=None, on_chunk=None, chunk_size=CHUNK_SIZE):
+    # Consumes a requests response opened with stream=True. Returns the
+    # non-image fields of the body with "images" replaced by the image count.
+    # on_chunk, if given, sees every raw chunk (used to capture debug bodies).
+    parser = Txt2ImgStreamParser(open_image, on_image_done)
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                if on_chunk is not None:
+                    on_chunk(chunk)
+                parser.feed(chunk)
+        fields = parser.close()
+    finally:
+        if parser.image_file is not None:
+            # Drop a half-written image instead of leaving a truncated file
+            getattr(parser.image_file, 'discard', parser.image_file.close)()
+        response.close()
+    fields['bytes_received'] = parser.bytes_received
+    return fields
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Structured generation telemetry: one compact JSON object per line, rotated
+# by size with the rotated files gzip-compressed. Raw response bodies are
+# only recorded when explicitly requested.
+
+import os
+import json
+import time
+import hashlib
+
+DEFAULT_EVENT_LOG = 'generation_events.jsonl'
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 10
+
+def payload_hash(payload):
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def seed_from_info(info):
+    # The txt2img "info" field is itself a JSON-encoded string
+    if isinstance(info, str):
+        try:
+            info = json.loads(info)
+        except ValueError:
+            return None
+    if isinstance(info, dict):
+        return info.get('seed')
+    return None
+
+def _gzip_namer(name):
+    return name + '.gz'
+
+def _gzip_rotator(source, dest):
+    import gzip
+    import shutil
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+class EventLog:
+    def __init__(self, path=DEFAULT_EVENT_LOG, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT, debug_responses=False):
+        import logging.handlers  # Pulls in socket and pickle; only needed once a run starts
+        self.path = path
+        self.debug_responses = debug_responses
+        self.logger = logging.getLogger(f'telemetry.{os.path.abspath(path)}')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False  # Keep events out of generation_log.txt
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.handler.namer = _gzip_namer
+        self.handler.rotator = _gzip_rotator
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(self.handler)
+
+    def record(self, event, **fields):
+        record = {'ts': round(time.time(), 3), 'event': event}
+        record.update(fields)
+        self.logger.info(json.dumps(record, separators=(',', ':'), default=str))
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
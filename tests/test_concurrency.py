@@ -0,0 +1,84 @@
+import pytest
+
+import concurrency
+from concurrency import ConcurrencyController
+
+URL = 'http://backend'
+
+@pytest.fixture
+def controller():
+    decisions = []
+    controller = ConcurrencyController([URL], initial=4, min_limit=1, max_limit=8, on_decision=decisions.append)
+    controller.decisions = decisions
+    return controller
+
+def tick(controller, queue=(), limited=False, idle=0):
+    # One decision interval with the given /progress queue samples
+    health = controller.backends[URL]
+    for depth in queue:
+        health.queue = depth
+        health.queue_total += depth
+        health.queue_samples += 1
+    health.limited = limited
+    health.idle_samples = idle
+    controller._decide(URL)
+    return controller.decisions[-1] if controller.decisions else None
+
+def actions(controller):
+    return [(d['action'], d['reason'], d['limit']) for d in controller.decisions]
+
+def test_admission_follows_the_limit(controller):
+    assert controller.admits(URL, 3)
+    assert not controller.admits(URL, 4)
+    assert controller.backends[URL].limited
+
+def test_idle_gpu_raises_the_limit_only_when_it_held_work_back(controller):
+    tick(controller, idle=2)
+    assert controller.decisions == []
+    tick(controller, limited=True, idle=2)
+    assert actions(controller) == [('increase', 'gpu idle', 5)]
+
+def test_growing_queue_halves_the_limit(controller):
+    tick(controller, queue=[1, 1])
+    decision = tick(controller, queue=[4, 4], limited=True, idle=1)
+    assert (decision['action'], decision['reason'], decision['limit']) == ('decrease', 'queue', 2)
+    assert (decision['queue_depth'], decision['last_queue_depth']) == (4.0, 1.0)
+
+def test_small_or_shrinking_queue_is_no_backpressure(controller):
+    tick(controller, queue=[2, 2])
+    tick(controller, queue=[2 + concurrency.QUEUE_GROWTH - 1] * 2)
+    tick(controller, queue=[0, 0], limited=True, idle=1)
+    assert actions(controller) == [('increase', 'gpu idle', 5)]
+
+def test_queue_growth_after_an_increase_is_ours(controller):
+    tick(controller, queue=[0, 0], limited=True, idle=1)
+    tick(controller, queue=[3, 3])
+    assert actions(controller) == [('increase', 'gpu idle', 5)]
+
+def test_growing_queue_at_the_minimum_blocks_increases():
+    decisions = []
+    controller = ConcurrencyController([URL], initial=1, min_limit=1, on_decision=decisions.append)
+    controller.decisions = decisions
+    tick(controller, queue=[0, 0])
+    tick(controller, queue=[3, 3], limited=True, idle=1)
+    assert decisions == []
+    tick(controller, queue=[3, 3], limited=True, idle=1)
+    assert actions(controller) == [('increase', 'gpu idle', 2)]
+
+def test_slow_requests_halve_the_limit(controller):
+    job = {'payload': {'width': 512, 'height': 512, 'steps': 20}, 'indices': [1]}
+    controller.record(URL, job, 1.0)
+    controller.record(URL, job, 50.0)
+    assert tick(controller)['reason'] == 'latency'
+    assert controller.limit(URL) == 2
+
+def test_oom_sets_a_ceiling_and_holds_at_the_minimum(controller):
+    controller.record(URL, {}, 0.0, error=RuntimeError('CUDA out of memory'))
+    assert actions(controller) == [('decrease', 'oom', 2)]
+    assert controller.backends[URL].ceiling == 4
+    controller.backends[URL].last_cut = 0
+    controller.record(URL, {}, 0.0, error=RuntimeError('CUDA out of memory'))
+    controller.backends[URL].last_cut = 0
+    controller.record(URL, {}, 0.0, error=RuntimeError('CUDA out of memory'))
+    assert controller.decisions[-1]['action'] == 'hold'
+    assert not controller.admits(URL, 0)
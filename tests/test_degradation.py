@@ -0,0 +1,68 @@
+from degradation import degrade, describe_rung, downscale, rebatch, smaller_size
+from sd_client import ERROR_OOM, ERROR_TIMEOUT
+
+def job(batch_size=4, n_iter=1, seed=100, width=1024, height=1024, **payload):
+    payload = dict(batch_size=batch_size, n_iter=n_iter, seed=seed, width=width, height=height, **payload)
+    return {'payload': payload, 'indices': list(range(1, batch_size * n_iter + 1)), 'base_seed': seed}
+
+def seeds(jobs):
+    # The seed every image of `jobs` is rendered with
+    return {index: j['payload']['seed'] + n for j in jobs for n, index in enumerate(j['indices'])}
+
+def test_rebatch_keeps_every_image_and_its_seed():
+    original = job(batch_size=3, n_iter=3)
+    jobs = list(rebatch(original, 2))
+    assert [(j['payload']['batch_size'], j['payload']['n_iter']) for j in jobs] == [(2, 4), (1, 1)]
+    assert [index for j in jobs for index in j['indices']] == original['indices']
+    assert seeds(jobs) == seeds([original])
+
+def test_rebatch_limits_n_iter():
+    jobs = list(rebatch(job(batch_size=1, n_iter=5), 1, 2))
+    assert [j['payload']['n_iter'] for j in jobs] == [2, 2, 1]
+    assert [j['payload']['seed'] for j in jobs] == [100, 102, 104]
+
+def test_random_seed_is_left_alone():
+    jobs = list(rebatch(job(batch_size=3, seed=-1), 2))
+    assert [(j['payload']['batch_size'], j['payload']['seed']) for j in jobs] == [(2, -1), (1, -1)]
+
+def test_oom_halves_the_batch_first():
+    rung, jobs, limit = degrade(job(batch_size=4), ERROR_OOM)
+    assert rung == 'batch_size' and limit == {'max_batch_size': 2}
+    assert [j['payload']['batch_size'] for j in jobs] == [2]
+    assert all(j['retry_limit'] == limit for j in jobs)
+    assert describe_rung(rung, jobs) == 'batch_size 2'
+
+def test_retry_keeps_the_limits_of_earlier_rungs():
+    retry = dict(job(batch_size=1), retry_limit={'max_batch_size': 1})
+    rung, jobs, limit = degrade(retry, ERROR_OOM)
+    assert rung == 'resolution' and limit == {'resolution': [768, 768]}
+    assert jobs[0]['retry_limit'] == {'max_batch_size': 1, 'resolution': [768, 768]}
+
+def test_oom_at_batch_size_one_downscales():
+    rung, jobs, limit = degrade(job(batch_size=1), ERROR_OOM)
+    assert rung == 'resolution' and limit == {'resolution': [768, 768]}
+    assert (jobs[0]['payload']['width'], jobs[0]['payload']['height']) == (768, 768)
+    assert jobs[0]['requested_size'] == (1024, 1024)
+    assert describe_rung(rung, jobs) == '768x768'
+    assert degrade(job(batch_size=1), ERROR_OOM, allow_downscale=False) == (None, [], None)
+
+def test_downscale_stops_at_the_minimum_side():
+    assert smaller_size(1000, 600) == (744, 448)
+    assert smaller_size(320, 320) is None
+    assert degrade(job(batch_size=1, width=320, height=320), ERROR_OOM) == (None, [], None)
+
+def test_hires_fix_upscales_less_before_it_is_dropped():
+    hires = job(batch_size=1, width=512, height=512, enable_hr=True, hr_resize_x=1024, hr_resize_y=1024)
+    _, jobs, limit = degrade(hires, ERROR_OOM)
+    payload = jobs[0]['payload']
+    assert (payload['width'], payload['hr_resize_x'], payload['enable_hr']) == (512, 768, True)
+    assert limit == {'resolution': [768, 768]}
+    payload = downscale(hires, 384, 384)['payload']
+    assert (payload['width'], payload['enable_hr']) == (384, False)
+
+def test_timeout_splits_the_iterations():
+    rung, jobs, limit = degrade(job(batch_size=1, n_iter=5), ERROR_TIMEOUT)
+    assert rung == 'n_iter' and limit == {'max_n_iter': 3}
+    assert [j['payload']['n_iter'] for j in jobs] == [3, 2]
+    assert describe_rung(rung, jobs) == '2 requests of up to 3 images'
+    assert degrade(job(batch_size=4, n_iter=1), ERROR_TIMEOUT) == (None, [], None)
@@ -0,0 +1,44 @@
+import os
+import asyncio
+
+import pytest
+
+from engine import run_engine
+from mock_server import serve
+
+@pytest.fixture
+def endpoint():
+    server = serve([0], latency=0.0, max_batch=1)[0]
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+def make_job(name, seed):
+    return {'item_name': name, 'iteration': 1, 'indices': [1],
+            'payload': {'prompt': name, 'seed': seed, 'batch_size': 1, 'n_iter': 1}}
+
+def test_a_raising_hook_fails_its_job_and_the_worker_goes_on(endpoint, tmp_path):
+    jobs = [make_job('expand', 1), make_job('before', 2), make_job('retry', 3), make_job('fine', 4)]
+    failures = []
+
+    def expand_job(_, job):
+        if job['item_name'] == 'expand':
+            raise ValueError('bad payload')
+        if job['item_name'] == 'retry':
+            job = dict(job, payload=dict(job['payload'], batch_size=2))  # Out of memory on the mock
+        return [job]
+
+    def before_request(_, job):
+        if job['item_name'] == 'before':
+            raise KeyError('sd_model_checkpoint')
+
+    def retry_job(*_):
+        raise RuntimeError('retry hook')
+
+    summary = asyncio.run(run_engine(
+        jobs, [endpoint], lambda job, index: str(tmp_path / f"{job['item_name']}_{index}.png"), in_flight=1,
+        expand_job=expand_job, before_request=before_request, retry_job=retry_job,
+        on_job_failed=lambda _, job, error, latency: failures.append((job['item_name'], type(error)))))
+    assert sorted(failures) == [('before', KeyError), ('expand', ValueError), ('retry', RuntimeError)]
+    assert summary['jobs_done'] == 1 and summary['jobs_failed'] == 3
+    assert os.listdir(tmp_path) == ['fine_1.png']
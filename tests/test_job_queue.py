@@ -0,0 +1,113 @@
+import pytest
+
+import job_queue
+from job_queue import DONE, FAILED, PENDING, RUNNING, JobQueue, queue_key
+
+def job(name, prompt_type='scene', priority=0.0, depends_on=(), iteration=1, indices=(1,)):
+    return {'item_name': name, 'prompt_type': prompt_type, 'priority': priority, 'depends_on': list(depends_on),
+            'iteration': iteration, 'indices': list(indices)}
+
+@pytest.fixture
+def queues(tmp_path):
+    opened = []
+    def open_queue(worker):
+        queue = JobQueue(str(tmp_path / 'story' / job_queue.QUEUE_NAME), worker=worker)
+        opened.append(queue)
+        return queue
+    yield open_queue
+    for queue in opened:
+        queue.close()
+
+def test_queue_key():
+    assert queue_key(job('Hero', indices=[1, 2])) == 'final/scene/Hero/1/1,2'
+    assert queue_key(dict(job('Hero'), phase='draft')) == 'draft/scene/Hero/1/1'
+
+def test_adding_again_skips_known_and_requeues_failed(queues):
+    queue = queues('a')
+    assert queue.add([job('A'), job('B')]) == (2, 0, 0)
+    claimed = queue.claim()
+    assert queue.finish(claimed, ok=False, error='boom')
+    assert queue.add([job('A'), job('B'), job('C')]) == (1, 1, 1)
+    assert queue.counts() == {PENDING: 3, RUNNING: 0, DONE: 0, FAILED: 0}
+
+def test_claims_by_priority_then_plan_order(queues):
+    queue = queues('a')
+    queue.add([job('A'), job('B', priority=5), job('C')])
+    order = []
+    for _ in range(3):
+        claimed = queue.claim()
+        assert claimed['queue_id']
+        order.append(claimed['item_name'])
+    assert queue.claim() is None
+    assert order == ['B', 'A', 'C']
+
+def test_dependencies_hold_a_job_until_done(queues):
+    queue = queues('a')
+    queue.add([job('Scene', priority=10, depends_on=['Hero']), job('Hero', 'character')])
+    hero = queue.claim()
+    assert hero['item_name'] == 'Hero'
+    assert queue.claim() is None  # Hero still runs
+    queue.finish(hero, ok=True)
+    assert queue.claim()['item_name'] == 'Scene'
+
+def test_a_claim_is_exclusive_between_workers(queues):
+    first, second = queues('a'), queues('b')
+    first.add([job('A')])
+    assert first.claim() is not None
+    assert second.claim() is None
+    assert first.workers() == {'a': 1}
+
+def test_expired_lease_is_reclaimed_and_the_old_worker_loses_it(queues, capsys):
+    first, second = queues('a'), queues('b')
+    first.add([job('A')])
+    lost = first.claim(lease=-1)
+    reclaimed = second.claim()
+    assert reclaimed['queue_id'] == lost['queue_id']
+    assert 'reclaimed a job of a' in capsys.readouterr().out
+    assert not first.finish(lost, ok=True)
+    assert second.finish(reclaimed, ok=True)
+    assert second.counts()[DONE] == 1
+
+def test_job_is_failed_after_max_attempts(queues):
+    queue = queues('a')
+    queue.add([job('A')])
+    for _ in range(job_queue.MAX_ATTEMPTS):
+        assert queue.claim(lease=-1) is not None
+    assert queue.claim() is None
+    assert queue.counts()[FAILED] == 1
+
+def test_renew_keeps_the_lease(queues):
+    first, second = queues('a'), queues('b')
+    first.add([job('A')])
+    first.claim(lease=-1)
+    first.renew()
+    assert second.claim() is None
+
+def test_release_gives_the_attempt_back(queues):
+    queue = queues('a')
+    queue.add([job('A')])
+    queue.release(queue.claim())
+    assert queue.counts()[PENDING] == 1
+    assert queue._db().execute('SELECT attempts FROM jobs').fetchone() == (0,)
+
+def test_reprioritize_pending_jobs(queues):
+    queue = queues('a')
+    queue.add([job('A', priority=1), job('B')])
+    assert queue.reprioritize('B', 5)
+    assert not queue.reprioritize('Nobody', 5)
+    assert queue.claim()['item_name'] == 'B'
+
+def test_dependency_cycle_is_given_up(queues, capsys):
+    queue = queues('a')
+    queue.add([job('A', depends_on=['B']), job('B', depends_on=['A'])])
+    assert queue.claim()['item_name'] == 'A'
+    assert 'dependency cycle among A, B' in capsys.readouterr().out
+
+def test_jobs_stops_when_nothing_is_left(queues):
+    queue = queues('a')
+    queue.add([job('A'), job('B')])
+    seen = []
+    for claimed in queue.jobs():
+        seen.append(claimed['item_name'])
+        queue.finish(claimed, ok=True)
+    assert seen == ['A', 'B']
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+import main
+from autotune import BatchTuningCache
+from mock_server import serve
+
+MODEL = 'mock.safetensors [0000000000]'
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    # A mock web UI that runs out of memory above batch_size 2, and a tuning
+    # cache that believes batch_size 4 fits on it
+    server = serve([0], latency=0.0, max_batch=2)[0]
+    endpoint = f'http://127.0.0.1:{server.server_address[1]}'
+    cache = BatchTuningCache(str(tmp_path / 'batch_tuning.json'))
+    cache.put(endpoint, MODEL, 512, 512, {'batch_size': 4})
+    monkeypatch.setattr(main, 'batch_cache', cache)
+    yield server, endpoint
+    server.shutdown()
+    server.server_close()
+
+def make_job(out_dir, images=4, batch_size=1):
+    os.makedirs(out_dir, exist_ok=True)
+    return {
+        'prompt_type': 'scene', 'item_name': 'Hero', 'iteration': 1, 'iteration_dir': str(out_dir),
+        'base_seed': 100, 'indices': list(range(1, images + 1)), 'lora': '',
+        'payload': {
+            'prompt': 'hero', 'negative_prompt': '', 'steps': 20, 'cfg_scale': 7, 'width': 512, 'height': 512,
+            'sampler_name': 'Euler a', 'scheduler': 'automatic', 'seed': 100, 'batch_size': batch_size, 'n_iter': images // batch_size,
+            'override_settings': {'sd_model_checkpoint': MODEL}, 'override_settings_restore_afterwards': False,
+        },
+    }
+
+def test_retry_keeps_below_a_cached_batch_size_that_no_longer_fits(backend, tmp_path):
+    server, endpoint = backend
+    job = make_job(tmp_path / 'out')
+    assert main.run_job(endpoint, job)
+    assert sorted(os.listdir(job['iteration_dir'])) == [f'Hero_1_{index}.png' for index in job['indices']]
+    assert server.state.errors_injected == 1  # Only the first batch of 4
+    assert main.batch_cache.limits(endpoint, MODEL, 512, 512)['max_batch_size'] == 2
+
+def test_async_engine_retries_an_oom_in_smaller_batches(backend, tmp_path, monkeypatch):
+    server, endpoint = backend
+    monkeypatch.setattr(main, 'batch_cache', None)  # The job is sent as it is
+    job = make_job(tmp_path / 'out', batch_size=4)
+    main.run_jobs_async([job], [endpoint], in_flight=2)
+    assert sorted(os.listdir(job['iteration_dir'])) == [f'Hero_1_{index}.png' for index in job['indices']]
+    assert server.state.errors_injected == 1
@@ -0,0 +1,16 @@
+from output_cache import OutputCache, image_payload
+
+def job(batch_size, n_iter, indices, seed=100):
+    # With the base seed 100; `seed` is the one the request starts at
+    payload = {'prompt': 'hero', 'seed': seed, 'batch_size': batch_size, 'n_iter': n_iter, 'send_images': True}
+    return {'payload': payload, 'indices': indices, 'base_seed': 100}
+
+def test_an_image_keeps_its_key_across_iterations(tmp_path):
+    cache = OutputCache(str(tmp_path))
+    def key(j, index):
+        return cache.key(image_payload(j, index), 'abc')
+    whole = job(2, 3, [1, 2, 3, 4, 5, 6])
+    split = job(2, 1, [5, 6], seed=104)  # The last iteration of `whole` on its own
+    assert key(whole, 5) == key(split, 5) and key(whole, 6) == key(split, 6)
+    assert key(whole, 5) != key(whole, 6)  # Other seed and batch position
+    assert key(job(1, 6, [1, 2, 3, 4, 5, 6]), 5) != key(whole, 5)  # Other batch_size
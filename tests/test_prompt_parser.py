@@ -0,0 +1,56 @@
+from prompt_parser import PromptFormatError, iter_prompt_blocks, iter_prompts
+
+def write(tmp_path, text):
+    path = tmp_path / 'prompts.txt'
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+def parse(path):
+    problems = []
+    blocks = list(iter_prompt_blocks(path, on_problem=problems.append))
+    return blocks, problems
+
+def test_blocks_with_line_numbers(tmp_path):
+    path = write(tmp_path, "Name: Hero\nPositive prompt: a hero\n---\n\nName: Villain\nPositive prompt: a villain\n")
+    blocks, problems = parse(path)
+    assert blocks == [(1, {'Name': 'Hero', 'Positive prompt': 'a hero'}),
+                      (5, {'Name': 'Villain', 'Positive prompt': 'a villain'})]
+    assert problems == []
+
+def test_continuation_lines_join_the_previous_field(tmp_path):
+    path = write(tmp_path, "Name: Hero\nPositive prompt: a hero,\n  red cape\n---\n")
+    assert list(iter_prompts(path)) == [{'Name': 'Hero', 'Positive prompt': 'a hero, red cape'}]
+
+def test_three_dashes_inside_a_prompt(tmp_path):
+    path = write(tmp_path, "Name: Hero\nPositive prompt: before --- after\n")
+    assert list(iter_prompts(path))[0]['Positive prompt'] == 'before --- after'
+
+def test_value_keeps_later_colons(tmp_path):
+    path = write(tmp_path, "Name: Hero\nPositive prompt: (style:1.2), hero\n")
+    assert list(iter_prompts(path))[0]['Positive prompt'] == '(style:1.2), hero'
+
+def test_missing_required_key_is_reported(tmp_path):
+    path = write(tmp_path, "Name: Hero\n---\nName: Villain\nPositive prompt: a villain\n")
+    blocks, problems = parse(path)
+    assert len(blocks) == 2
+    assert [(p.line_no, str(p)) for p in problems] == [(1, f"{path}:1: block has no 'Positive prompt'")]
+    assert all(isinstance(p, PromptFormatError) and isinstance(p, ValueError) for p in problems)
+
+def test_duplicate_key_last_one_wins(tmp_path):
+    path = write(tmp_path, "Name: Hero\nPositive prompt: one\nPositive prompt: two\n")
+    blocks, problems = parse(path)
+    assert blocks[0][1]['Positive prompt'] == 'two'
+    assert [p.line_no for p in problems] == [3]
+
+def test_stray_line_and_empty_block(tmp_path):
+    path = write(tmp_path, "no key here\n---\n---\nName: Hero\nPositive prompt: a hero\n")
+    blocks, problems = parse(path)
+    assert [data['Name'] for _, data in blocks] == ['Hero']
+    assert [p.line_no for p in problems] == [1, 1]
+    assert "outside of any 'Key:' field" in str(problems[0])
+    assert "no 'Key: value' lines" in str(problems[1])
+
+def test_blocks_are_yielded_before_the_file_ends(tmp_path):
+    path = write(tmp_path, "Name: Hero\nPositive prompt: a hero\n---\nName: Villain\nPositive prompt: a villain\n")
+    blocks = iter_prompts(path)
+    assert next(blocks)['Name'] == 'Hero'
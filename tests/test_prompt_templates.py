@@ -0,0 +1,76 @@
+import pytest
+
+from prompt_parser import PromptFormatError
+from prompt_templates import (PromptTemplate, PromptTemplateError, count_variations, expand_block, expand_blocks,
+                              parse_option)
+
+def block(prompt, **fields):
+    data = {'Name': 'Hero', 'Positive prompt': prompt}
+    data.update(fields)
+    return data
+
+def names_and_prompts(data, **kwargs):
+    return [(v['Name'], v['Positive prompt']) for v in expand_block(data, **kwargs)]
+
+def test_plain_block_is_passed_through():
+    data = block('a hero')
+    assert list(expand_block(data)) == [data]
+    assert count_variations(data) == 1
+
+def test_alternations_expand_in_mixed_radix_order():
+    assert names_and_prompts(block('{red|green} {cape|hat}')) == [
+        ('Hero v1', 'red cape'), ('Hero v2', 'red hat'), ('Hero v3', 'green cape'), ('Hero v4', 'green hat')]
+
+def test_render_straight_from_the_index():
+    template = PromptTemplate({'Positive prompt': '{a|b|c} x {1|2}'})
+    assert template.size == 6
+    assert template.choices(5) == [2, 1]
+    assert template.render(3) == {'Positive prompt': 'b x 2'}
+
+def test_negative_prompt_slots_count_too():
+    data = block('{red|green}', **{'Negative prompt': '{blurry|dark}'})
+    assert count_variations(data) == 4
+    assert [v['Negative prompt'] for v in expand_block(data)] == ['blurry', 'dark', 'blurry', 'dark']
+
+def test_identical_renderings_are_dropped():
+    assert names_and_prompts(block('{red|red} cape')) == [('Hero v1', 'red cape')]
+
+def test_weighted_options():
+    assert parse_option(' 3::rain ') == ('rain', 3.0)
+    assert parse_option('clear') == ('clear', 1.0)
+    assert names_and_prompts(block('{3::rain|1::clear}')) == [('Hero v1', 'rain'), ('Hero v2', 'clear')]
+
+def test_variations_are_drawn_with_the_seed():
+    data = block('{a|b|c|d} {e|f|g|h}', Variations='3', **{'Variation seed': '7'})
+    first = names_and_prompts(data)
+    assert len(first) == 3 and len(set(first)) == 3
+    assert names_and_prompts(data) == first
+    assert count_variations(data) == 3
+    assert all('Variations' not in v and 'Variation seed' not in v for v in expand_block(data))
+
+def test_more_variations_than_combinations():
+    data = block('{a|b}', Variations='5')
+    assert len(names_and_prompts(data)) == 2
+    assert count_variations(data) == 2
+
+@pytest.mark.parametrize('fields, message', [
+    ({'Variations': 'many'}, "'Variations' must be a number or 'all'"),
+    ({'Variations': '0'}, "'Variations' must be at least 1"),
+    ({'Variation seed': 'abc'}, "'Variation seed' must be a number"),
+])
+def test_bad_variation_fields(fields, message):
+    with pytest.raises(PromptTemplateError, match=message):
+        list(expand_block(block('{a|b}', **fields)))
+
+def test_wildcards(tmp_path):
+    (tmp_path / 'hair.txt').write_text("# colours\nred\n\n2::black\n", encoding='utf-8')
+    assert names_and_prompts(block('__hair__ hair'), wildcard_dir=str(tmp_path)) == [
+        ('Hero v1', 'red hair'), ('Hero v2', 'black hair')]
+
+def test_missing_wildcard_skips_the_block(tmp_path):
+    problems = []
+    blocks = [(1, block('__nothing__')), (4, block('{a|b}', Name='Villain'))]
+    expanded = list(expand_blocks(blocks, 'scenes.txt', str(tmp_path), on_problem=problems.append))
+    assert [v['Name'] for v in expanded] == ['Villain v1', 'Villain v2']
+    assert len(problems) == 1 and isinstance(problems[0], PromptFormatError)
+    assert problems[0].line_no == 1 and 'not found; block skipped' in str(problems[0])
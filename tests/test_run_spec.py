@@ -0,0 +1,94 @@
+import json
+import argparse
+
+import pytest
+
+from run_spec import SETTING_DEFAULTS, SpecError, add_spec_arguments, build_stories, resolve_settings, validate_settings
+
+OPTIONS = {
+    'models': [{'title': 'dreamshaper_8.safetensors [879db523c3]', 'model_name': 'dreamshaper_8',
+                'filename': 'C:\\sd\\models\\Stable-diffusion\\dreamshaper_8.safetensors'}],
+    'samplers': [{'name': 'Euler a', 'aliases': ['k_euler_a']}],
+    'schedulers': [{'name': 'karras', 'label': 'Karras'}],
+    'loras': [{'name': 'hero', 'alias': 'hero_v2', 'path': '/sd/models/Lora/hero.safetensors'}],
+}
+VALID = dict(SETTING_DEFAULTS, model='dreamshaper_8', sampling_method='Euler a', scheduler='Karras')
+
+def parse_args(*argv):
+    parser = argparse.ArgumentParser()
+    add_spec_arguments(parser)
+    return parser.parse_args(list(argv))
+
+def write_spec(tmp_path, spec, name='spec.json'):
+    path = tmp_path / name
+    path.write_text(json.dumps(spec) if name.endswith('.json') else spec)
+    return str(path)
+
+def test_defaults_story_values_and_flags_in_that_order(tmp_path):
+    spec = {'defaults': {'model': 'dreamshaper_8', 'sampling_steps': '30', 'seed': 42},
+            'prompts_dir': 'prompts', 'num_images': 2,
+            'stories': ['Chapter_1', {'name': 'Chapter_2', 'width': 768, 'mode': 'resume', 'prompts_dir': 'chapter2'}]}
+    stories = build_stories(parse_args('--spec', write_spec(tmp_path, spec), '--seed', '7', '--story', 'Extra'))
+    assert [(s['name'], s['mode'], s['prompts_dir'], s['num_images']) for s in stories] == [
+        ('Chapter_1', 'all', 'prompts', 2), ('Chapter_2', 'resume', 'chapter2', 2), ('Extra', 'all', 'prompts', 2)]
+    assert stories[0]['settings'] == {'model': 'dreamshaper_8', 'sampling_steps': 30, 'seed': 7}
+    assert stories[1]['settings']['width'] == 768
+
+def test_story_flag_alone():
+    stories = build_stories(parse_args('--story', 'Chapter_1', '--num-iterations', '3'))
+    assert [(s['name'], s['num_iterations'], s['settings']) for s in stories] == [('Chapter_1', 3, {})]
+
+@pytest.mark.parametrize('spec, message', [
+    ({'stories': []}, 'does not list any stories'),
+    ({'stories': [{'width': 512}]}, 'Story #1 needs a name'),
+    ({'stories': [{'name': 'A', 'mode': 'fast'}]}, 'mode must be one of'),
+    ({'stories': ['A', 'A']}, 'listed more than once: A'),
+    ({'defaults': {'steps': 30}, 'stories': ['A']}, "unknown setting 'steps'"),
+    ({'defaults': {'width': 'wide'}, 'stories': ['A']}, "'width' must be a number"),
+    ({'defaults': ['seed'], 'stories': ['A']}, "'defaults' must be a mapping"),
+])
+def test_invalid_specs(tmp_path, spec, message):
+    with pytest.raises(SpecError, match=message):
+        build_stories(parse_args('--spec', write_spec(tmp_path, spec)))
+
+def test_unreadable_spec_files(tmp_path):
+    with pytest.raises(SpecError, match='not found'):
+        build_stories(parse_args('--spec', str(tmp_path / 'missing.json')))
+    with pytest.raises(SpecError, match='Could not parse'):
+        build_stories(parse_args('--spec', write_spec(tmp_path, '{"stories": [', name='bad.jsonx')))
+    with pytest.raises(SpecError, match='must contain a mapping'):
+        build_stories(parse_args('--spec', write_spec(tmp_path, ['A'])))
+
+def test_yaml_spec(tmp_path):
+    pytest.importorskip('yaml')
+    path = write_spec(tmp_path, "defaults:\n  seed: 3\nstories:\n  - Chapter_1\n", name='spec.yaml')
+    assert build_stories(parse_args('--spec', path))[0]['settings'] == {'seed': 3}
+
+def test_saved_settings_are_the_base():
+    story = {'settings': {'seed': 7}}
+    settings = resolve_settings(story, {'seed': 1, 'width': 640})
+    assert (settings['seed'], settings['width'], settings['height']) == (7, 640, SETTING_DEFAULTS['height'])
+
+def test_valid_settings_match_backend_names():
+    assert validate_settings(VALID, OPTIONS, 'A') == []
+    for model in ('dreamshaper_8.safetensors', 'dreamshaper_8.safetensors [879db523c3]', 'dreamshaper_8.safetensors [other]'):
+        assert validate_settings(dict(VALID, model=model), OPTIONS, 'A') == []
+    for lora in ('hero', 'hero_v2', 'hero.safetensors'):
+        assert validate_settings(dict(VALID, lora=lora, sampling_method='k_euler_a', scheduler='karras'), OPTIONS, 'A') == []
+
+def test_invalid_settings_are_all_reported():
+    settings = dict(VALID, model='sdxl', sampling_method='DPM', scheduler=None, lora='villain',
+                    width=500, sampling_steps=0, cfg_scale=0.5)
+    assert validate_settings(settings, OPTIONS, 'A') == [
+        "A: 'scheduler' is required.",
+        "A: 'sampling_steps' must be positive.",
+        "A: 'width' must be a multiple of 8.",
+        "A: 'cfg_scale' must be at least 1.",
+        "A: model 'sdxl' is not available on the backend.",
+        "A: sampler 'DPM' is not available on the backend.",
+        "A: LoRA 'villain' is not available on the backend.",
+    ]
+
+def test_unknown_backend_lists_are_not_checked():
+    settings = dict(VALID, model='anything', lora='anything')
+    assert validate_settings(settings, dict.fromkeys(OPTIONS), 'A') == []
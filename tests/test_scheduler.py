@@ -0,0 +1,67 @@
+import threading
+
+from scheduler import JobScheduler, item_dependencies, item_priority, matching_items, resolve_dependencies
+
+def job(name, prompt_type='scene', priority=0.0, depends_on=(), iteration=1, indices=(1, 2)):
+    return {'item_name': name, 'prompt_type': prompt_type, 'priority': priority, 'depends_on': list(depends_on),
+            'iteration': iteration, 'indices': list(indices)}
+
+def names(jobs):
+    return [(j['prompt_type'], j['item_name'], j['iteration']) for j in jobs]
+
+def test_priority_and_dependency_fields(capsys):
+    assert item_priority({'Priority': '5'}) == 5.0
+    assert item_priority({}) == 0.0
+    assert item_priority({'Priority': 'high'}) == 0.0
+    assert 'not a number' in capsys.readouterr().out
+    assert item_dependencies({'DependsOn': 'Hero, Dark Lord,'}) == ['Hero', 'Dark_Lord']
+    assert item_dependencies({'DependsOn': ['Hero']}) == ['Hero']
+
+def test_names_match_by_folder():
+    items = [('character', 'Hero'), ('scene', 'Hero'), ('scene', 'Castle')]
+    assert matching_items('Hero', items) == [('character', 'Hero'), ('scene', 'Hero')]
+    assert matching_items('Characters/Hero', items) == [('character', 'Hero')]
+    assert matching_items('Scenes/Castle', items) == [('scene', 'Castle')]
+    # A scene never depends on itself
+    assert resolve_dependencies(job('Hero', depends_on=['Hero', 'Nobody']), items) == ([('character', 'Hero')], ['Nobody'])
+
+def test_higher_priority_first_plan_order_within_a_priority():
+    jobs = [job('A'), job('B', priority=5), job('C'), job('D', priority=5)]
+    assert [j['item_name'] for j in JobScheduler(jobs).drain()] == ['B', 'D', 'A', 'C']
+
+def test_dependencies_wait_for_every_iteration():
+    jobs = [job('Scene', priority=10, depends_on=['Hero']),
+            job('Hero', 'character', iteration=1), job('Hero', 'character', iteration=2)]
+    assert names(JobScheduler(jobs).drain()) == [('character', 'Hero', 1), ('character', 'Hero', 2), ('scene', 'Scene', 1)]
+
+def test_blocked_job_is_released_when_the_last_image_finishes():
+    scheduler = JobScheduler([job('Hero', 'character'), job('Scene', depends_on=['Hero'])])
+    jobs = scheduler.jobs()
+    first = next(jobs)
+    assert first['item_name'] == 'Hero'
+    handed = []
+    thread = threading.Thread(target=lambda: handed.append(next(jobs)))
+    thread.start()
+    scheduler.finished(first, [1])
+    thread.join(0.2)
+    assert thread.is_alive()  # Image 2 is still outstanding
+    scheduler.finished(first, [2])
+    thread.join(2)
+    assert [j['item_name'] for j in handed] == ['Scene']
+
+def test_cycle_is_given_up(capsys):
+    jobs = [job('A', depends_on=['B']), job('B', depends_on=['A'])]
+    assert [j['item_name'] for j in JobScheduler(jobs).drain()] == ['A', 'B']
+    assert 'Dependency cycle among A, B' in capsys.readouterr().out
+
+def test_reprioritize_applies_to_jobs_not_handed_out():
+    scheduler = JobScheduler([job('A', priority=1), job('B'), job('C')])
+    jobs = scheduler.jobs()
+    assert next(jobs)['item_name'] == 'A'
+    assert scheduler.reprioritize('C', 3)
+    assert not scheduler.reprioritize('Nobody', 3)
+    assert [j['item_name'] for j in jobs] == ['C', 'B']
+
+def test_wait_running_stops_the_schedule():
+    scheduler = JobScheduler([job('A'), job('B')])
+    assert list(scheduler.jobs(wait_running=lambda: False)) == []
@@ -0,0 +1,64 @@
+import os
+import zlib
+import struct
+
+import pytest
+
+from shared_output import PNG_SIGNATURE, SharedOutput, file_name_regex, png_info_seed
+
+def png(parameters=None):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    text = chunk(b'tEXt', b'parameters\0' + parameters.encode('utf-8')) if parameters is not None else b''
+    return (PNG_SIGNATURE + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) + text
+            + chunk(b'IDAT', zlib.compress(b'\0\0')) + chunk(b'IEND', b''))
+
+@pytest.mark.parametrize('pattern, options, name, seed', [
+    ('', {}, '00012-1234.png', 1234),
+    ('', {'save_to_dirs': False}, '00012-1234-a 56 cat.png', 1234),
+    ('', {'save_images_add_number': False}, '1234.png', 1234),
+    ('[seed]-[prompt_spaces]', {}, '00003-77-a 12 b.png', 77),
+    ('[prompt]-[seed]', {}, '00001-hero 2-3 cats-1234.png', 1234),
+    ('[date]/[seed]_[model_name]', {}, '00004-99_sd-1-5.png', 99),
+])
+def test_seed_is_read_from_its_field(pattern, options, name, seed):
+    regex, _ = file_name_regex(pattern, options.get('save_to_dirs', True), options.get('save_images_add_number', True))
+    assert int(regex.match(name).group('seed')) == seed
+
+def test_free_text_before_the_seed_is_ambiguous():
+    assert file_name_regex('[prompt]-[seed]')[1]
+    assert not file_name_regex('[seed]-[prompt]')[1]
+    assert file_name_regex('[seed]')[0].match('1234.png') is None  # The number prefix is missing
+
+def test_png_info_seed(tmp_path):
+    path = tmp_path / 'a.png'
+    path.write_bytes(png('a 12 cat\nSteps: 20, Seed: 98765, Size: 512x512'))
+    assert png_info_seed(str(path)) == 98765
+    path.write_bytes(png())
+    assert png_info_seed(str(path)) is None
+    path.write_bytes(b'not a png')
+    assert png_info_seed(str(path)) is None
+
+def test_collect_moves_the_file_of_each_seed(tmp_path):
+    output_dir = tmp_path / 'out'
+    day = output_dir / '2026-01-01'
+    day.mkdir(parents=True)
+    # The prompt holds the other image's seed
+    (day / '00001-hero 42 times-41.png').write_bytes(png('Seed: 41'))
+    (day / '00002-hero 42 times-42.png').write_bytes(png('Seed: 42'))
+    shared = SharedOutput(str(tmp_path))
+    shared.names[str(output_dir)] = file_name_regex('[prompt_spaces]-[seed]')
+    dests = [str(tmp_path / 'a.png'), str(tmp_path / 'b.png')]
+    assert shared.collect(str(output_dir), [42, 41], dests, since=0) == [0, 1]
+    assert png_info_seed(dests[0]) == 42 and png_info_seed(dests[1]) == 41
+    assert os.listdir(day) == [] and shared.images == 2
+
+def test_png_info_decides_when_the_name_is_ambiguous(tmp_path):
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    (output_dir / '00001-x-5-y-7-model.png').write_bytes(png('Seed: 7'))
+    shared = SharedOutput(str(tmp_path))
+    regex, ambiguous = file_name_regex('[prompt_spaces]-[seed]-[model_name]')
+    assert regex.match('00001-x-5-y-7-model.png').group('seed') == '5'
+    shared.names[str(output_dir)] = (regex, ambiguous)
+    assert shared.collect(str(output_dir), [7], [str(tmp_path / 'a.png')], since=0) == [0]
@@ -0,0 +1,107 @@
+import io
+import json
+import base64
+
+import pytest
+
+from stream_decode import StreamDecodeError, Txt2ImgStreamParser, stream_txt2img_response
+
+IMAGES = [bytes(range(256)) * 3, b'\x89PNG second image', b'']
+
+class MemoryFile(io.BytesIO):
+    def __init__(self, store, index):
+        super().__init__()
+        self.store = store
+        self.index = index
+        self.discarded = False
+
+    def close(self):
+        if not self.closed:
+            self.store[self.index] = self.getvalue()
+        super().close()
+
+    def discard(self):
+        self.discarded = True
+        self.store[self.index] = None
+        super().close()
+
+class FakeResponse:
+    def __init__(self, body, chunk):
+        self.body = body
+        self.chunk = chunk
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), self.chunk):
+            yield self.body[start:start + self.chunk]
+
+    def close(self):
+        self.closed = True
+
+def body(images=IMAGES, info=None, escape_slashes=False):
+    encoded = [base64.b64encode(image).decode('ascii') for image in images]
+    text = json.dumps({'images': encoded, 'parameters': {'prompt': 'a "hero", {x}', 'seed': [1, 2]},
+                       'info': json.dumps(info or {'seed': 42, 'all_seeds': [42, 43, 44]})})
+    if escape_slashes:
+        text = text.replace('/', '\\/')
+    return text.encode('utf-8')
+
+def decode(data, chunk):
+    store = {}
+    parser = Txt2ImgStreamParser(lambda index: MemoryFile(store, index))
+    for start in range(0, len(data), chunk):
+        parser.feed(data[start:start + chunk])
+    return parser.close(), store
+
+@pytest.mark.parametrize('chunk', [1, 2, 3, 5, 7, 64, 1 << 20])
+def test_any_chunking_gives_the_same_result(chunk):
+    fields, store = decode(body(escape_slashes=True), chunk)
+    assert store == dict(enumerate(IMAGES))
+    assert fields['images'] == 3
+    assert fields['parameters'] == {'prompt': 'a "hero", {x}', 'seed': [1, 2]}
+    assert json.loads(fields['info'])['all_seeds'] == [42, 43, 44]
+
+@pytest.mark.parametrize('chunk', [1, 4, 16, 30, 1024])
+def test_data_uri_prefix_is_stripped(chunk):
+    data = b'{"images": ["data:image\\/png;base64,' + base64.b64encode(b'png bytes') + b'"]}'
+    fields, store = decode(data, chunk)
+    assert store == {0: b'png bytes'} and fields == {'images': 1}
+
+def test_null_and_empty_images():
+    assert decode(b'{"images": null, "info": "x"}', 3)[0] == {'images': 0, 'info': 'x'}
+    assert decode(b'{"images": [], "info": 1}', 3)[0] == {'images': 0, 'info': 1}
+
+def test_images_done_callback():
+    done = []
+    parser = Txt2ImgStreamParser(lambda index: MemoryFile({}, index), on_image_done=done.append)
+    parser.feed(body())
+    parser.close()
+    assert done == [1, 2, 3]
+
+@pytest.mark.parametrize('data, message', [
+    (b'{"images": ["AAAA"', 'ended before'),
+    (b'{"images": []} x', 'Trailing data'),
+    (b'{"images": [1]}', 'inside the images array'),
+    (b'{"images": ["A$$A"]}', 'Invalid base64'),
+    (b'[]', 'Expected'),
+])
+def test_malformed_bodies(data, message):
+    with pytest.raises(StreamDecodeError, match=message):
+        decode(data, 3)
+
+def test_stream_response_counts_bytes_and_closes():
+    data = body()
+    response = FakeResponse(data, 100)
+    chunks = []
+    store = {}
+    fields = stream_txt2img_response(response, lambda index: MemoryFile(store, index), on_chunk=chunks.append)
+    assert fields['bytes_received'] == len(data) and b''.join(chunks) == data
+    assert store == dict(enumerate(IMAGES)) and response.closed
+
+def test_half_written_image_is_discarded():
+    data = body()
+    response = FakeResponse(data[:len(data) // 2], 50)
+    store = {}
+    with pytest.raises(StreamDecodeError):
+        stream_txt2img_response(response, lambda index: MemoryFile(store, index))
+    assert store == {0: None} and response.closed
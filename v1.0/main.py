@@ -4,24 +4,35 @@ import os
 import sys
 import json
 import time
-import requests
-import base64
 import argparse
 import logging
-from tqdm import tqdm  # For progress bar
-
-# For keyboard listener
-try:
-    import pynput
-    from pynput import keyboard
-except ImportError:
-    print("The 'pynput' module is required for pause functionality. Installing it now...")
-    os.system(f"{sys.executable} -m pip install pynput")
-    import pynput
-    from pynput import keyboard
+
+# Shared modules live next to the top-level main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lazy_imports import lazy_import
+from sd_client import configure_clients, get_client, print_latency_report
+from planner import (CheckpointTracker, coalesce_jobs, job_checkpoint, job_group, plan_by_affinity, print_checkpoint_loads,
+                     print_coalescing_summary, print_gpu_time_saved, print_plan_summary, summarize_coalescing, summarize_plan)
+from output_cache import link_or_copy
+from journal import AtomicFile
+from telemetry import payload_hash, seed_from_info
+from stream_decode import StreamDecodeError, stream_txt2img_response
+from model_catalog import ModelCatalog, describe, lora_mismatch
+from prompt_parser import iter_prompt_blocks
+from prompt_templates import expand_blocks
+from run_spec import (EXIT_BACKEND_DOWN, EXIT_IMAGES_FAILED, EXIT_INTERRUPTED, EXIT_INVALID_SPEC, EXIT_OK, SpecError,
+                      add_spec_arguments, build_stories, fetch_backend_options, is_headless, print_spec_errors,
+                      resolve_settings, validate_settings)
+
+# Heavy or optional modules are only loaded when their feature is used
+requests = lazy_import('requests')
+keyboard = None  # pynput.keyboard, imported by start_keyboard_listener()
 
 paused = False  # Global variable to control pause state
 keyboard_listener = None  # Global variable for keyboard listener
+generation_seconds = 0.0  # Time spent in txt2img requests, for the GPU time estimate
+generated_images = 0
+model_catalog = None  # Indexed checkpoints and LoRAs, see get_model_catalog()
 
 def on_press(key):
     global paused
@@ -34,9 +45,17 @@ def on_press(key):
         pass
 
 def start_keyboard_listener():
-    global keyboard_listener
-    keyboard_listener = keyboard.Listener(on_press=on_press)
-    keyboard_listener.start()
+    # The pause key is optional: pynput may be missing or have no display
+    global keyboard_listener, keyboard
+    try:
+        from pynput import keyboard
+        keyboard_listener = keyboard.Listener(on_press=on_press)
+        keyboard_listener.start()
+    except Exception as e:
+        keyboard_listener = None
+        print(f"Pause key unavailable ({e or type(e).__name__}). Install pynput to pause with F8.")
+        return False
+    return True
 
 def stop_keyboard_listener():
     global keyboard_listener
@@ -53,53 +72,64 @@ def load_sd_settings():
     with open(sd_settings_path, 'r') as f:
         return json.load(f)
 
-def load_prompts(file_path):
-    if not os.path.exists(file_path):
-        return []
-    with open(file_path, 'r') as f:
-        content = f.read()
-    return [block.strip() for block in content.split('---') if block.strip()]
-
-def parse_prompt_block(block):
-    lines = block.strip().split('\n')
-    data = {}
-    current_key = None
-    for line in lines:
-        if ':' in line:
-            key, value = line.split(':', 1)
-            current_key = key.strip()
-            data[current_key] = value.strip()
-        else:
-            if current_key:
-                data[current_key] += ' ' + line.strip()
-    return data
-
 def create_prompts(prompt_type, folder_path):
     if prompt_type == 'character':
         prompts_file = os.path.join(folder_path, 'characters.txt')
     else:
         prompts_file = os.path.join(folder_path, 'scenes.txt')
 
-    prompt_blocks = load_prompts(prompts_file)
-    prompts = []
-    for block in prompt_blocks:
-        data = parse_prompt_block(block)
-        prompts.append(data)
-    return prompts
+    if not os.path.exists(prompts_file):
+        return []
+    # Lazily parsed and template-expanded: prompts come out one by one while the file is read
+    return expand_blocks(iter_prompt_blocks(prompts_file), prompts_file, folder_path)
+
+def get_model_catalog():
+    global model_catalog
+    if model_catalog is None:
+        model_catalog = ModelCatalog()
+    return model_catalog
+
+def model_paths(sd_settings):
+    sd_folder = sd_settings.get('sd_folder', '')
+    return os.path.join(sd_folder, 'models/Stable-diffusion'), os.path.join(sd_folder, 'models/Lora')
 
 def get_available_models(sd_models_path):
-    model_extensions = ('.ckpt', '.safetensors', '.pt')
-    models = [f for f in os.listdir(sd_models_path) if os.path.isfile(os.path.join(sd_models_path, f)) and f.lower().endswith(model_extensions)]
-    return models
+    # Listed from the catalog index, only rescanned when the directory changed
+    return get_model_catalog().names(sd_models_path)
 
 def get_available_loras(sd_loras_path):
-    lora_extensions = ('.ckpt', '.safetensors', '.pt')
-    loras = [f for f in os.listdir(sd_loras_path) if os.path.isfile(os.path.join(sd_loras_path, f)) and f.lower().endswith(lora_extensions)]
-    return loras
+    return get_model_catalog().names(sd_loras_path)
+
+def lora_problem(sd_settings, checkpoint, lora):
+    # Why `lora` cannot be used on `checkpoint`, or None when it can (or nobody knows)
+    if not checkpoint or not lora:
+        return None
+    catalog = get_model_catalog()
+    models_path, loras_path = model_paths(sd_settings)
+    return lora_mismatch(catalog.info(models_path, checkpoint), catalog.info(loras_path, lora), checkpoint, lora)
+
+def reject_mismatched_loras(sd_settings, jobs):
+    # Jobs whose LoRA was made for another architecture than their checkpoint
+    # are dropped before any request is sent; returns (kept, rejected count)
+    problems = {}
+    kept = []
+    rejected = 0
+    for job in jobs:
+        group = job_group(job)
+        if group not in problems:
+            problems[group] = lora_problem(sd_settings, *group)
+            if problems[group]:
+                print(f"Skipping jobs: {problems[group]}.")
+                logging.error(problems[group])
+        if problems[group]:
+            rejected += 1
+        else:
+            kept.append(job)
+    return kept, rejected
 
 def get_available_samplers(api_endpoint):
     try:
-        response = requests.get(f'{api_endpoint}/sdapi/v1/samplers')
+        response = get_client(api_endpoint).get('/sdapi/v1/samplers')
         response.raise_for_status()
         samplers = response.json()
         return [sampler['name'] for sampler in samplers]
@@ -109,7 +139,7 @@ def get_available_samplers(api_endpoint):
 
 def get_available_schedulers(api_endpoint):
     try:
-        response = requests.get(f'{api_endpoint}/sdapi/v1/schedulers')
+        response = get_client(api_endpoint).get('/sdapi/v1/schedulers')
         response.raise_for_status()
         schedulers = response.json()
         return [scheduler['name'] for scheduler in schedulers]
@@ -122,7 +152,7 @@ def check_stable_diffusion_running(api_endpoint):
     test_url = f'{api_endpoint}/sdapi/v1/sd-models'
     print(f"Checking if Stable Diffusion web UI is running at {test_url}...")
     try:
-        response = requests.get(test_url)
+        response = get_client(api_endpoint).get('/sdapi/v1/sd-models', retries=0)
         if response.status_code == 200:
             print("Stable Diffusion web UI is running.")
             return True
@@ -155,14 +185,12 @@ def generate_json_files(prompts, prompt_type, story_name, default_seed, num_imag
         json_files.append(prompt_path)
     return json_files
 
-def generate_images(settings, prompt_type, story_name, num_images, num_iterations, output_dir):
-    api_url = settings.get('api_endpoint', 'http://localhost:7860') + '/sdapi/v1/txt2img'
-    headers = {'Content-Type': 'application/json'}
-
+def collect_jobs(settings, prompt_type, story_name, num_images, num_iterations, output_dir):
     base_dir = os.path.join(output_dir, story_name, 'Characters' if prompt_type == 'character' else 'Scenes')
     if not os.path.exists(base_dir):
         print(f"No {prompt_type}s to process in {story_name}.")
-        return
+        return []
+    jobs = []
     items = os.listdir(base_dir)
     for item_name in items:
         item_dir = os.path.join(base_dir, item_name)
@@ -174,20 +202,14 @@ def generate_images(settings, prompt_type, story_name, num_images, num_iteration
 
         seed = int(data.get('Seed', settings['seed']))
 
-        print(f"\nGenerating images for {prompt_type}: {item_name}")
-        print(f"Settings:")
-        print(f"  Model: {settings['model']}")
-        print(f"  LoRA: {settings['lora']}")
-        print(f"  LoRA Weight: {settings['lora_weight']}")
-        print(f"  Sampler: {settings['sampling_method']}")
-        print(f"  Scheduler: {settings['scheduler']}")
-        print(f"  Sampling Steps: {settings['sampling_steps']}")
-        print(f"  Width: {settings['width']}")
-        print(f"  Height: {settings['height']}")
-        print(f"  CFG Scale: {settings['cfg_scale']}")
-        print(f"  Seed: {seed}")
-        print(f"  Number of Images: {num_images}")
-        print(f"  Number of Iterations: {num_iterations}")
+        # A prompt.json may pick its own checkpoint or LoRA for this item
+        item_settings = dict(settings)
+        if data.get('Model'):
+            item_settings['model'] = data['Model']
+        if 'LoRA' in data:
+            item_settings['lora'] = data['LoRA'] or ''
+        if 'LoRA Weight' in data:
+            item_settings['lora_weight'] = float(data['LoRA Weight'])
 
         for iteration in range(1, num_iterations + 1):
             iteration_dir = os.path.join(item_dir, f'Iteration_{iteration}')
@@ -197,84 +219,109 @@ def generate_images(settings, prompt_type, story_name, num_images, num_iteration
             negative_prompt = data.get('Negative prompt', '')
 
             # Include LoRA settings at the end of the positive prompt
-            if settings['lora']:
-                lora_name = os.path.splitext(settings['lora'])[0]  # Remove file extension
-                positive_prompt += f" <lora:{lora_name}:{settings['lora_weight']}>"
-
-            # Check for pause
-            while paused:
-                time.sleep(0.5)
+            if item_settings['lora']:
+                lora_name = os.path.splitext(item_settings['lora'])[0]  # Remove file extension
+                positive_prompt += f" <lora:{lora_name}:{item_settings['lora_weight']}>"
 
             payload = {
                 "prompt": positive_prompt,
                 "negative_prompt": negative_prompt,
-                "steps": settings["sampling_steps"],
-                "cfg_scale": settings["cfg_scale"],
-                "width": settings["width"],
-                "height": settings["height"],
-                "sampler_name": settings["sampling_method"],
+                "steps": item_settings["sampling_steps"],
+                "cfg_scale": item_settings["cfg_scale"],
+                "width": item_settings["width"],
+                "height": item_settings["height"],
+                "sampler_name": item_settings["sampling_method"],
                 "seed": seed,
                 "batch_size": 1,
                 "n_iter": num_images,
-                "scheduler": settings["scheduler"],
+                "scheduler": item_settings["scheduler"],
                 "override_settings": {
-                    "sd_model_checkpoint": settings["model"]
-                }
+                    "sd_model_checkpoint": item_settings["model"]
+                },
+                # Keep the checkpoint loaded after the request instead of swapping back
+                "override_settings_restore_afterwards": False
             }
+            jobs.append({
+                "story_name": story_name,
+                "prompt_type": prompt_type,
+                "item_name": item_name,
+                "iteration": iteration,
+                "iteration_dir": iteration_dir,
+                "lora": item_settings['lora'],
+                "payload": payload,
+            })
+    return jobs
+
+def copy_to_duplicates(job, image_count):
+    # Fan the images of a coalesced request out to the identical jobs
+    for duplicate in job.get('duplicates', []):
+        for idx in range(image_count):
+            src = os.path.join(job['iteration_dir'], f"{job['item_name']}_{job['iteration']}_{idx + 1}.png")
+            dest = os.path.join(duplicate['iteration_dir'], f"{duplicate['item_name']}_{duplicate['iteration']}_{idx + 1}.png")
+            link_or_copy(src, dest)
+        print(f"{duplicate['story_name']} / {duplicate['item_name']} - Iteration {duplicate['iteration']}: "
+              f"{image_count} images copied from {job['story_name']} / {job['item_name']}")
+
+def run_job(client, job, tracker=None):
+    global generation_seconds, generated_images
+    item_name = job['item_name']
+    iteration = job['iteration']
+    payload = job['payload']
+
+    if tracker is not None:
+        tracker.ensure_loaded(client.endpoint, job_checkpoint(job))
+
+    # Summaries only: payloads and base64 bodies would swamp the log
+    logging.info(f"Generating images for {job['story_name']}/{item_name}, Iteration {iteration} "
+                 f"(payload {payload_hash(payload)[:12]})")
+
+    print(f"\n{job['story_name']} / {item_name} - Iteration {iteration}: Generating {payload['n_iter']} images...")
+    start = time.perf_counter()
+    try:
+        response = client.post('/sdapi/v1/txt2img', json=payload, stream=True)
+        response.raise_for_status()
 
-            # Log the payload
-            logging.info(f"Generating images for {item_name}, Iteration {iteration}")
-            logging.info(f"Payload: {json.dumps(payload, indent=4)}")
-
-            print(f"\nIteration {iteration}: Generating {num_images} images...")
-            try:
-                response = requests.post(api_url, headers=headers, json=payload)
-                response.raise_for_status()
-                r = response.json()
-
-                # Log the response
-                logging.info(f"Response: {response.text}")
-
-                for idx, img_data in enumerate(tqdm(r['images'], desc=f"Saving images for {item_name}")):
-                    img_bytes = base64.b64decode(img_data)
-                    img_path = os.path.join(iteration_dir, f'{item_name}_{iteration}_{idx + 1}.png')
-                    with open(img_path, 'wb') as img_file:
-                        img_file.write(img_bytes)
-                print(f"Iteration {iteration}: Completed generating images for {item_name}")
-            except requests.exceptions.RequestException as e:
-                print(f"Error generating images for {item_name} in iteration {iteration}: {e}")
-                logging.error(f"Error generating images for {item_name} in iteration {iteration}: {e}")
-                continue
-
-            # Check for pause
-            while paused:
-                time.sleep(0.5)
-
-def main():
-    # Configure logging
-    logging.basicConfig(filename='generation_log.txt', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
-
-    # Load Stable Diffusion settings
-    sd_settings = load_sd_settings()
-
-    # Check if Stable Diffusion web UI is running
-    api_endpoint = sd_settings.get("api_endpoint", "http://localhost:7860")
-    if not check_stable_diffusion_running(api_endpoint):
-        print("Stable Diffusion web UI is not running.")
-        print("Please start the web UI manually before running this script.")
-        sys.exit(1)
-
-    # Use the input directory in the same directory as the script
-    script_dir = os.getcwd()
-    input_dir = os.path.join(script_dir, 'input')
+        from tqdm import tqdm  # For progress bar
+        progress = tqdm(total=payload['n_iter'] * payload['batch_size'], desc=f"Saving images for {item_name}")
+
+        def open_image(idx):
+            # Decoded from the stream straight into the file, which appears once complete
+            return AtomicFile(os.path.join(job['iteration_dir'], f'{item_name}_{iteration}_{idx + 1}.png'))
+
+        try:
+            r = stream_txt2img_response(response, open_image, on_image_done=lambda count: progress.update(1))
+        finally:
+            progress.close()
+        latency = time.perf_counter() - start
+        generation_seconds += latency
+        generated_images += r['images']
+        logging.info(f"Generated {r['images']} images for {job['story_name']}/{item_name}, Iteration {iteration} "
+                     f"in {latency:.1f}s ({r['bytes_received']} bytes, seed {seed_from_info(r.get('info'))})")
+        print(f"Iteration {iteration}: Completed generating images for {item_name}")
+        copy_to_duplicates(job, r['images'])
+        return True
+    except (requests.exceptions.RequestException, StreamDecodeError) as e:
+        print(f"Error generating images for {item_name} in iteration {iteration}: {e}")
+        logging.error(f"Error generating images for {item_name} in iteration {iteration}: {e}")
+        return False
+
+def run_jobs(settings, jobs, tracker=None):
+    # Returns the number of failed jobs (a coalesced request fails for all of them)
+    client = get_client(settings.get('api_endpoint', 'http://localhost:7860'))
+    failed = 0
+    for job in jobs:
+        # Check for pause
+        while paused:
+            time.sleep(0.5)
+        if not run_job(client, job, tracker):
+            failed += 1 + len(job.get('duplicates', []))
+    return failed
+
+def prompt_stories(sd_settings, api_endpoint, input_dir, output_dir):
     if not os.path.exists(input_dir):
         print(f"Input directory '{input_dir}' does not exist.")
         sys.exit(1)
 
-    # Create the output directory if it doesn't exist
-    output_dir = os.path.join(script_dir, 'output')
-    os.makedirs(output_dir, exist_ok=True)
-
     # Get list of folders in the input directory
     available_folders = [d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d))]
     if not available_folders:
@@ -301,24 +348,29 @@ def main():
 
     # Get global settings from user input
     # Get available models and LoRAs
-    sd_folder = sd_settings['sd_folder']
-    models_path = os.path.join(sd_folder, 'models/Stable-diffusion')
-    loras_path = os.path.join(sd_folder, 'models/Lora')
+    models_path, loras_path = model_paths(sd_settings)
+    catalog = get_model_catalog()
 
     models = get_available_models(models_path)
-    loras = get_available_loras(loras_path)
 
     # Select model
     print("\nAvailable Models:")
     for idx, model in enumerate(models):
-        print(f"{idx + 1}: {model}")
+        print(f"{idx + 1}: {model}{describe(catalog.info(models_path, model))}")
     model_choice = int(input("Select a model by number: ")) - 1
     model = models[model_choice]
 
+    # Only offer LoRAs that can work with the chosen model
+    loras = [lora for lora in get_available_loras(loras_path)
+             if not lora_mismatch(catalog.info(models_path, model), catalog.info(loras_path, lora), model, lora)]
+    hidden = len(get_available_loras(loras_path)) - len(loras)
+
     # Select LoRA
     print("\nAvailable LoRAs:")
     for idx, lora in enumerate(loras):
-        print(f"{idx + 1}: {lora}")
+        print(f"{idx + 1}: {lora}{describe(catalog.info(loras_path, lora))}")
+    if hidden:
+        print(f"({hidden} LoRAs for other architectures are hidden)")
     lora_choice_input = input("Select a LoRA by number (press Enter to skip): ")
     if lora_choice_input.strip():
         lora_choice = int(lora_choice_input) - 1
@@ -376,41 +428,126 @@ def main():
         "api_endpoint": api_endpoint
     }
 
+    return [{'name': story_name, 'prompts_dir': os.path.join(input_dir, story_name), 'output_dir': output_dir,
+             'num_images': num_images, 'num_iterations': num_iterations, 'settings': settings}
+            for story_name in selected_folders]
+
+def main():
+    # Configure logging
+    logging.basicConfig(filename='generation_log.txt', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
+    # Load Stable Diffusion settings
+    sd_settings = load_sd_settings()
+    configure_clients(sd_settings)
+
+    parser = argparse.ArgumentParser(description='Generate images for the story folders in ./input.')
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    headless = is_headless(args)
+
+    # Check if Stable Diffusion web UI is running
+    api_endpoint = sd_settings.get("api_endpoint", "http://localhost:7860")
+    if not check_stable_diffusion_running(api_endpoint):
+        print("Stable Diffusion web UI is not running.")
+        print("Please start the web UI manually before running this script.")
+        sys.exit(EXIT_BACKEND_DOWN)
+
+    # Use the input directory in the same directory as the script
+    script_dir = os.getcwd()
+    input_dir = os.path.join(script_dir, 'input')
+
+    # Create the output directory if it doesn't exist
+    output_dir = os.path.join(script_dir, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+
+    if headless:
+        # Story names are folders in ./input unless the spec gives a prompts_dir
+        try:
+            stories = build_stories(args)
+            options = fetch_backend_options(api_endpoint)
+            errors = []
+            for story in stories:
+                story['prompts_dir'] = story['prompts_dir'] or os.path.join(input_dir, story['name'])
+                story['output_dir'] = story['output_dir'] or output_dir
+                story['settings'] = resolve_settings(story)
+                story['settings']['api_endpoint'] = api_endpoint
+                errors += validate_settings(story['settings'], options, f"Story {story['name']}")
+                problem = lora_problem(sd_settings, story['settings'].get('model'), story['settings'].get('lora'))
+                if problem:
+                    errors.append(f"Story {story['name']}: {problem}.")
+                if not os.path.isdir(story['prompts_dir']):
+                    errors.append(f"Story {story['name']}: folder {story['prompts_dir']} not found.")
+                if story['mode'] != 'all':
+                    errors.append(f"Story {story['name']}: mode '{story['mode']}' needs the journal of the top-level main.py.")
+            if errors:
+                raise SpecError(*errors)
+        except SpecError as e:
+            print_spec_errors(e.args)
+            get_model_catalog().save()
+            sys.exit(EXIT_INVALID_SPEC)
+    else:
+        stories = prompt_stories(sd_settings, api_endpoint, input_dir, output_dir)
+
     # Process each selected folder
-    for story_name in selected_folders:
-        folder_path = os.path.join(input_dir, story_name)
+    for story in stories:
+        story_name = story['name']
+        folder_path = story['prompts_dir']
         print(f"\nProcessing folder: {story_name}")
 
-        # Output folder for this story
-        story_output_dir = os.path.join(output_dir, story_name)
-
         # Process prompts and generate JSON files
         print("\nProcessing character prompts...")
         character_prompts = create_prompts('character', folder_path)
-        character_json_files = generate_json_files(character_prompts, 'character', story_name, settings['seed'], num_images, num_iterations, output_dir)
+        character_json_files = generate_json_files(character_prompts, 'character', story_name, story['settings']['seed'], story['num_images'], story['num_iterations'], story['output_dir'])
 
         print("\nProcessing scene prompts...")
         scene_prompts = create_prompts('scene', folder_path)
-        scene_json_files = generate_json_files(scene_prompts, 'scene', story_name, settings['seed'], num_images, num_iterations, output_dir)
+        scene_json_files = generate_json_files(scene_prompts, 'scene', story_name, story['settings']['seed'], story['num_images'], story['num_iterations'], story['output_dir'])
 
-        print("\nJSON files for characters and scenes have been created.")
+    print("\nJSON files for characters and scenes have been created.")
+    if not headless:
         print("You can review and edit them before proceeding if needed.")
 
-        # Start keyboard listener
-        print("Press 'Space' at any time to pause/resume the script during image generation.")
-        start_keyboard_listener()
-
-        # Generate images
-        print("\nStarting image generation for characters...")
-        generate_images(settings, 'character', story_name, num_images, num_iterations, output_dir)
-
-        print("\nStarting image generation for scenes...")
-        generate_images(settings, 'scene', story_name, num_images, num_iterations, output_dir)
-
+    # Gather the jobs of every selected folder, send identical requests only
+    # once, then group them by checkpoint and LoRA so the web UI loads each
+    # model as few times as possible
+    jobs = []
+    for story in stories:
+        jobs += collect_jobs(story['settings'], 'character', story['name'], story['num_images'], story['num_iterations'], story['output_dir'])
+        jobs += collect_jobs(story['settings'], 'scene', story['name'], story['num_images'], story['num_iterations'], story['output_dir'])
+    jobs, rejected = reject_mismatched_loras(sd_settings, jobs)
+    get_model_catalog().save()
+    unique = coalesce_jobs(jobs)
+    coalescing = summarize_coalescing(jobs, unique)
+    print_coalescing_summary(coalescing)
+    tracker = CheckpointTracker([api_endpoint])
+    ordered = plan_by_affinity(unique, tracker.loaded[api_endpoint])
+    print_plan_summary(summarize_plan(unique, ordered, tracker.loaded[api_endpoint]))
+
+    # Start keyboard listener
+    if not headless and start_keyboard_listener():
+        print("Press 'F8' at any time to pause/resume the script during image generation.")
+
+    print("\nStarting image generation...")
+    try:
+        failed = rejected + run_jobs(stories[0]['settings'], [job for _, group in ordered for job in group], tracker)
+    except KeyboardInterrupt:
+        print("\nInterrupted.")
+        sys.exit(EXIT_INTERRUPTED)
+    finally:
         # Stop keyboard listener after image generation
         stop_keyboard_listener()
 
-        print(f"\nImage generation completed for folder: {story_name}")
+    print_checkpoint_loads(tracker)
+    print_gpu_time_saved(coalescing, generation_seconds, generated_images)
+    print(f"\nImage generation completed for folders: {', '.join(story['name'] for story in stories)}")
+
+    print("\nAPI latency:")
+    print_latency_report()
+
+    if failed:
+        print(f"\n{failed} requests failed.")
+        sys.exit(EXIT_IMAGES_FAILED)
+    sys.exit(EXIT_OK)
 
 if __name__ == '__main__':
     main()